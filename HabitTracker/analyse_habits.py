@@ -1,22 +1,192 @@
 import datetime as dt
-from pandas import date_range
-from habit_db import get_habit_names, get_habit_tracker, get_periodicity, get_first_check_off_date
-
-
-def return_habit_names(db, periodicity: int = None):
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby, repeat
+from operator import itemgetter
+from typing import NamedTuple
+from clock import today
+from instrumentation import instrument
+from periods import analyse_rule, parse_periodicity, rule_grid
+from habit_db import (DEFAULT_USER, WEEKDAYS, HabitRecord, StreakRecord, get_habit_names, get_habits_snapshot,
+                      get_streak_summaries, get_db_path, get_read_only_db, get_check_off_bounds, get_rollups,
+                      get_rule_run_length, get_run_length, get_window_streaks, iter_check_offs, to_date_string)
+from streaks import (CompletionHistory, PeriodGrid, StreakAccumulator, StreakSummary, to_ordinals, analyse_check_offs,
+                     summarise, period_grid, missed_summary)
+
+
+# analysis backends of get_habit_summary_for_all_habits: 'python' reads the check-offs and analyses them in Python,
+# 'sql' computes the summaries inside SQLite with get_window_streaks
+BACKENDS = ('python', 'sql')
+
+
+def return_habit_names(db, periodicity: int = None, user: str = DEFAULT_USER):
     """
     returns a list of defined habits, if wanted only for a certain periodicity
 
     :param db: database where the data is stored
     :param periodicity: if periodicity is specified, only habits with this periodicity will be returned, otherwise all
     predefined habits will be returned
+    :param user: user the habits belong to
     :return: list with habits
     """
-    data = get_habit_names(db, periodicity)
+    data = get_habit_names(db, periodicity, user)
     return data
 
 
-def get_habit_streak(db, name: str, time_interval: float = None):
+def habit_grid(periodicity, first_check_off: int, start: int, end: int) -> PeriodGrid:
+    """
+    returns the periods of a habit within a window, see streaks.period_grid and periods.rule_grid
+
+    :param periodicity: periodicity of the habit as stored in the database
+    :param first_check_off: day ordinal of the first check-off, None if the habit has never been checked off
+    :param start: day ordinal of the first day that is analysed
+    :param end: day ordinal of the last day that is analysed
+    :return: PeriodGrid, its periodicity is a number of days or a periods.PeriodRule
+    """
+    rule = parse_periodicity(periodicity)
+    if isinstance(rule.spec, int):
+        return period_grid(first_check_off, start, end, rule.spec)
+    return rule_grid(first_check_off, start, end, rule)
+
+
+@instrument
+def analyse_habit_record(record: HabitRecord, start: int, end: int):
+    """
+    runs the streak engine for one habit: the check-off dates are converted into day ordinals once and the completed
+    periods, longest streak, current streak and reset count are computed from them. If the habit was not checked off
+    during the window, all periods are missed and the result is computed without looking at single periods.
+
+    :param record: HabitRecord of the habit, as returned by get_habits_snapshot for the window
+    :param start: day ordinal of the first day that is analysed
+    :param end: day ordinal of the last day that is analysed
+    :return: tuple with the PeriodGrid of the window and a StreakSummary
+    """
+    grid = habit_grid(record.periodicity, record.first_check_off_date, start, end)
+    if not grid.periods:
+        return grid, summarise([])
+    if not record.check_off_dates:
+        return grid, missed_summary(grid.periods)
+    if isinstance(grid.periodicity, int):
+        return grid, analyse_check_offs(to_ordinals(record.check_off_dates), grid.start, end, grid.periodicity)
+    return grid, analyse_rule(to_ordinals(record.check_off_dates), grid)
+
+
+@instrument
+def analyse_window(db, start_date: dt.date, end_date: dt.date = None, periodicity: int = None, name: str = None,
+                   workers: int = None, user: str = DEFAULT_USER):
+    """
+    analyses all habits for the window from start_date until end_date, both days included, the window may lie
+    completely in the past. Periods begin at the later of start_date and the first check-off of a habit.
+
+    :param db: database where the data is stored
+    :param start_date: first day of the window
+    :param end_date: last day of the window, if not provided today's date is used
+    :param periodicity: if periodicity is proved, only habits with this periodicity will be analysed
+    :param name: if supplied, only this habit will be analysed
+    :param workers: if more than one worker is requested, the habits are split into chunks that are analysed in
+    parallel by worker processes, each with its own read-only connection. Databases that only exist in memory are
+    always analysed serially.
+    :param user: user the habits belong to
+    :return: dictionary, key = habit name, value = tuple with PeriodGrid and StreakSummary
+    """
+    end_date = end_date or today()
+    if workers and workers > 1 and not name:
+        path = get_db_path(db)
+        if path:
+            return _analyse_window_parallel(path, start_date, end_date, periodicity, workers, user)
+
+    snapshot = get_habits_snapshot(db, start_date, periodicity, name, end_date, user=user)
+    start, end = start_date.toordinal(), end_date.toordinal()
+    return {habit_name: analyse_habit_record(record, start, end) for habit_name, record in snapshot.items()}
+
+
+@instrument
+def analyse_window_streaming(db, start_date: dt.date, end_date: dt.date = None, periodicity: int = None,
+                             name: str = None, user: str = DEFAULT_USER, batch_size: int = 10000):
+    """
+    computes the same StreakSummary values as analyse_window without loading the check-offs: they are read in date
+    order with iter_check_offs and fed into one StreakAccumulator per habit, which only keeps O(1) state. The memory
+    does not depend on the number of check-offs, but the summaries have no completion vector.
+
+    :param db: database where the data is stored
+    :param start_date: first day of the window
+    :param end_date: last day of the window, if not provided today's date is used
+    :param periodicity: if periodicity is proved, only habits with this periodicity will be analysed
+    :param name: if supplied, only this habit will be analysed
+    :param user: user the habits belong to
+    :param batch_size: number of check-offs that are read from the database at once
+    :return: dictionary, key = habit name, value = tuple with PeriodGrid and StreakSummary, completed is None
+    """
+    end_date = end_date or today()
+    start, end = start_date.toordinal(), end_date.toordinal()
+    accumulators = {habit_name: StreakAccumulator(habit_grid(habit_periodicity, first, start, end))
+                    for habit_name, (habit_periodicity, first, _) in get_check_off_bounds(db, periodicity, name,
+                                                                                            user).items()}
+    check_offs = iter_check_offs(db, start_date, end_date, periodicity, name, user, batch_size)
+    for habit_name, rows in groupby(check_offs, key=itemgetter(0)):
+        accumulators[habit_name].update(day for _, day in rows)
+    return {habit_name: (accumulator.grid, accumulator.summary()) for habit_name, accumulator in accumulators.items()}
+
+
+def _analyse_chunk(path: str, names: list, start_date: dt.date, end_date: dt.date, user: str):
+    """
+    analyses some habits in a worker process, see analyse_window
+    """
+    db = get_read_only_db(path)
+    try:
+        snapshot = get_habits_snapshot(db, start_date, end_date=end_date, names=names, user=user)
+    finally:
+        db.close()
+    start, end = start_date.toordinal(), end_date.toordinal()
+    return {habit_name: analyse_habit_record(record, start, end) for habit_name, record in snapshot.items()}
+
+
+@instrument
+def _analyse_window_parallel(path: str, start_date: dt.date, end_date: dt.date, periodicity: int, workers: int,
+                             user: str):
+    """
+    splits the habits into chunks and analyses them with a process pool, the result is the same as the one of the
+    serial path in analyse_window, but changes that have not been committed yet are not visible to the workers
+    """
+    db = get_read_only_db(path)
+    try:
+        names = get_habit_names(db, periodicity, user)
+    finally:
+        db.close()
+    chunk_size = max(1, -(-len(names) // (workers * 4)))
+    chunks = [names[i:i + chunk_size] for i in range(0, len(names), chunk_size)]
+
+    results = dict()
+    with ProcessPoolExecutor(workers) as pool:
+        for result in pool.map(_analyse_chunk, repeat(path), chunks, repeat(start_date), repeat(end_date),
+                                 repeat(user)):
+            results.update(result)
+    return {habit_name: results[habit_name] for habit_name in names}
+
+
+def _start_date(time_interval: float = None, as_of: dt.date = None):
+    """
+    returns the earliest date that is analysed for a time interval that ends on as_of or today
+    """
+    if not time_interval:
+        return dt.date(2000, 1, 1)
+    return (as_of or today()) - dt.timedelta(days=time_interval)
+
+
+def completion_history(grid: PeriodGrid, summary: StreakSummary):
+    """
+    turns the result of analyse_habit_record into a CompletionHistory
+
+    :param grid: PeriodGrid of the habit
+    :param summary: StreakSummary of the habit
+    :return: CompletionHistory
+    """
+    if summary.completed is None:
+        return CompletionHistory(grid.start, grid.periodicity, grid.periods)
+    return CompletionHistory.from_completed(grid.start, grid.periodicity, summary.completed)
+
+
+@instrument
+def get_habit_streak(db, name: str, time_interval: float = None, user: str = DEFAULT_USER, as_of: dt.date = None):
     """
     returns a dictionary with all dates where a habit was supposed to be checked off and a Boolean value whether the
     habit was checked-off on that date
@@ -25,89 +195,116 @@ def get_habit_streak(db, name: str, time_interval: float = None):
     :param name: habit for which the check-off data is extracted
     :param time_interval: if a time interval is provided, only data for a certain amount of time is extracted,
                       otherwise all data is extracted
+    :param user: user the habit belongs to
+    :param as_of: last day that is analysed, check-offs after it are ignored, if not provided today's date is used,
+    see clock
     :return: dictionary, key = date, value= True when habit was completed on this day, False if it was not completed
     """
-    periodicity = int(get_periodicity(db, name))
-    if not time_interval:
-        start_date = dt.date(2000, 1, 1)
-    else:
-        start_date = dt.date.today() - dt.timedelta(days=time_interval)
+    window = analyse_window(db, _start_date(time_interval, as_of), as_of, name=name, user=user)
+    return completion_history(*window[name]).to_dict()
 
-    data = get_habit_tracker(db, start_date, name)
 
-    if not data:
+def _summary_from_streak_record(record: StreakRecord):
+    """
+    turns a row of the streak summary table into the StreakSummary of all data until today in O(1), the completion
+    vector is not part of the table and therefore None
 
-        """
-          if data is empty, it is possible that either this habit has never been checked off, or that it just has not been
-          checked off in the specified time period and therefore missed to check it off during this time. If it has never 
-          been checked off an empty dictionary is returned, otherwise a dictionary with False as the value for each day 
-          where it was supposed to be checked off
-          """
-
-        first_date = get_first_check_off_date(db, name)
-        if first_date is None:
-            return dict()
-        else:
-            date_list_check = dict()
-            for i in range(time_interval):
-                date_list_check[i] = False
-            return date_list_check
+    :param record: StreakRecord of the habit
+    :return: StreakSummary, None if the row can not answer this, because the habit was checked off before the
+    analysis start date (2000-01-01) or after today, e.g. under clock.fixed_clock
+    """
+    if record.first_period_start is None:
+        return summarise([])
+    if record.first_period_start < _start_date().toordinal() or record.last_check_off > today().toordinal():
+        return None
 
+    if isinstance(record.periodicity, int):
+        today_period = (today().toordinal() - record.first_period_start) // record.periodicity
     else:
-        # data is split into a list with the habit name and a list when that habit was checked off
-        names_list, dates_list = zip(*data)
+        rule = parse_periodicity(record.periodicity).at(record.first_period_start)
+        today_period = rule.index(today().toordinal()) - rule.index(record.first_period_start)
+    # the streak is still alive while the ongoing period has not been checked off yet
+    current_streak = record.current_streak if record.last_period >= today_period - 1 else 0
+    return StreakSummary(None, record.longest_streak, current_streak,
+                         record.resets + today_period - record.last_period)
+
+
+@instrument
+def get_habit_summary_for_all_habits(db, timeframe: float = None, periodicity: int = None, name: str = None,
+                                     start_date: dt.date = None, end_date: dt.date = None, workers: int = None,
+                                     user: str = DEFAULT_USER, backend: str = 'python', as_of: dt.date = None):
+    """
+    returns a dictionary with the StreakSummary of every habit. With the python backend the summaries are read from
+    the streak summary table if there is no timeframe, window or as_of date, otherwise all habits are analysed with
+    analyse_window_streaming, or with analyse_window if several workers are requested. With the sql backend the
+    summaries are computed by one query, see habit_db.get_window_streaks. The summaries have no completion vector.
 
-        first_date = get_first_check_off_date(db, name)
-        if first_date == min(dates_list):
-            list_start_date = dt.datetime.strptime(min(dates_list), '%Y-%m-%d').date()
+    :param db: database where the data is stored
+    :param timeframe: if a timeframe is provided, only data for a certain amount of time is analysed,
+    otherwise all data is analysed
+    :param periodicity: if periodicity is proved, only habits with this periodicity will be analysed
+    :param name: if supplied, only this habit will be analysed
+    :param start_date: if provided, only data from this date on is analysed, replaces timeframe
+    :param end_date: if provided, only data until this date is analysed
+    :param workers: number of worker processes for the analysis of a timeframe or window, see analyse_window
+    :param user: user the habits belong to
+    :param backend: 'python' or 'sql', see BACKENDS
+    :param as_of: the date the analysis is done on: the timeframe ends on this date and check-offs after it are
+    ignored, if not provided today's date is used, see clock. end_date replaces it as end of the analysis.
+    :return: dictionary, key = habit name, value = StreakSummary
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend {backend!r}, use one of {BACKENDS}")
+    end_date = end_date or as_of
+    if backend == 'sql':
+        records = get_window_streaks(db, start_date or _start_date(timeframe, as_of), end_date, periodicity, name,
+                                     user)
+        return {habit_name: StreakSummary(None, record.longest_streak, record.current_streak, record.resets)
+                for habit_name, record in records.items()}
+
+    if timeframe or start_date or end_date:
+        start_date = start_date or _start_date(timeframe, as_of)
+        if workers and workers > 1:
+            window = analyse_window(db, start_date, end_date, periodicity, name, workers, user)
         else:
-            list_start_date = start_date
-
-        delta = dt.date.today() - list_start_date
-        date_list_check = dict()
-
-        day = list_start_date
-
-        # goes through the dates when the habit was supposed to be checked off, if it was checked of sets dictionary
-        # value for that fay as true, otherwise as False
+            window = analyse_window_streaming(db, start_date, end_date, periodicity, name, user)
+        return {habit_name: summary for habit_name, (grid, summary) in window.items()}
 
-        for day_iterator in range(int((delta.days + periodicity) / periodicity)):
-            # date_range returns all possible dates within a certain timeframe, mostly important when periodicity ==7,
-            # as the task can be completed on multiple days within this 7 days period.
+    summaries = dict()
+    for habit_name, record in get_streak_summaries(db, periodicity, name, user).items():
+        summaries[habit_name] = _summary_from_streak_record(record)
 
-            dates_range_list = date_range(day, day + dt.timedelta(days=periodicity - 1))
-            day_string = day.strftime('%Y-%m-%d')
-            dates_set_string = set(dates_range_list.strftime('%Y-%m-%d'))
+    for habit_name, summary in summaries.items():
+        if summary is None:
+            window = analyse_window_streaming(db, _start_date(), name=habit_name, user=user)
+            summaries[habit_name] = window[habit_name][1]
+    return summaries
 
-            # checks whether the check-off date has an overlap with the allowed check off dates
-            if not dates_set_string.isdisjoint(set(dates_list)):
-                date_list_check[day_string] = True
-            else:
-                date_list_check[day_string] = False
-            day = day + dt.timedelta(days=periodicity)
 
-        return date_list_check
-
-
-def get_habit_streak_for_all_habits(db, timeframe: float = None, periodicity: int = None):
+@instrument
+def get_habit_streak_for_all_habits(db, timeframe: float = None, periodicity: int = None, workers: int = None,
+                                    user: str = DEFAULT_USER, as_of: dt.date = None):
     """
-    returns a nested dictionary which includes a dictionary with all dates where a habit was supposed to be checked off
-    and a Boolean value whether the habit was checked-off on that date for each habit
+    returns a dictionary with the CompletionHistory of each habit, which can be used like a dictionary with all dates
+    where a habit was supposed to be checked off and a Boolean value whether the habit was checked-off on that date
 
     :param db: database where the data is stored
     :param timeframe: if a timeframe is provided, only data for a certain amount of time is extracted,
     otherwise all data is extracted
     :param periodicity: if periodicity is proved, only habits with this periodicity will be analysed
-    :return: nested dictionary
+    :param workers: number of worker processes, see analyse_window
+    :param user: user the habits belong to
+    :param as_of: last day that is analysed, if not provided today's date is used, see clock
+    :return: dictionary, key = habit name, value = CompletionHistory
     """
-    habit_name_list = get_habit_names(db, periodicity)
-    habits_streak_list = dict()
-    for habit_name in habit_name_list:
-        habits_streak_list[habit_name] = get_habit_streak(db, habit_name, timeframe)
-    return habits_streak_list
+    window = analyse_window(db, _start_date(timeframe, as_of), as_of, periodicity, workers=workers, user=user)
+    return {habit_name: completion_history(grid, summary) for habit_name, (grid, summary) in window.items()}
 
 
-def return_number_of_habit_streaks(db, name: str = None, time_interval: float = None, periodicity: int = None):
+@instrument
+def return_number_of_habit_streaks(db, name: str = None, time_interval: float = None, periodicity: int = None,
+                                   start_date: dt.date = None, end_date: dt.date = None, workers: int = None,
+                                   user: str = DEFAULT_USER, backend: str = 'python', as_of: dt.date = None):
     """
     returns the maximum habit streak for one habit if provided or checks the largest streak over all habits
 
@@ -116,6 +313,12 @@ def return_number_of_habit_streaks(db, name: str = None, time_interval: float =
     :param time_interval: if a timeframe is provided, only data for a certain amount of time is extracted,
     otherwise all data is extracted
     :param periodicity: if periodicity is proved, only habits with this periodicity will be analysed
+    :param start_date: if provided, only data from this date on is analysed, replaces time_interval
+    :param end_date: if provided, only data until this date is analysed
+    :param workers: number of worker processes for the analysis of all habits, see analyse_window
+    :param user: user the habits belong to
+    :param backend: 'python' or 'sql', see get_habit_summary_for_all_habits
+    :param as_of: the date the analysis is done on, see get_habit_summary_for_all_habits
     :return: name and maximum habit streak
     """
     if not name:
@@ -123,22 +326,10 @@ def return_number_of_habit_streaks(db, name: str = None, time_interval: float =
         if no name is provided, all habits will be checked for their longest streak and the longest overall streak will 
         be returned 
         """
-        data = get_habit_streak_for_all_habits(db, time_interval, periodicity)
-        longest_streak_dict = dict()
-
-        for habit_name, habit_tracker in data.items():
-            streak = 0
-            longest_streak = 0
-
-            for key, value in habit_tracker.items():
-                if value:
-                    streak += 1
-                    if streak > longest_streak:
-                        longest_streak = streak
-                else:
-                    streak = 0
-
-            longest_streak_dict[habit_name] = longest_streak
+        data = get_habit_summary_for_all_habits(db, time_interval, periodicity, start_date=start_date,
+                                                end_date=end_date, workers=workers, user=user, backend=backend,
+                                                as_of=as_of)
+        longest_streak_dict = {habit_name: summary.longest_streak for habit_name, summary in data.items()}
 
         max_longest_streak = max(longest_streak_dict.values())
         # checks whether there are multiple habits with the longest habit streak
@@ -151,23 +342,17 @@ def return_number_of_habit_streaks(db, name: str = None, time_interval: float =
         """
         if a specific habit is provided only this habit will be checked for the longest check off streak
         """
-        data = get_habit_streak(db, name, time_interval)
-
-        streak = 0
-        longest_streak = 0
-
-        for key, value in data.items():
-            if value:
-                streak += 1
-            else:
-                if streak > longest_streak:
-                    longest_streak = streak
-                streak = 0
+        data = get_habit_summary_for_all_habits(db, time_interval, name=name, start_date=start_date, end_date=end_date,
+                                                user=user, backend=backend, as_of=as_of)
+        longest_streak = data[name].longest_streak
 
         return name, longest_streak
 
 
-def return_number_of_habit_resets(db, name: str = None, time_interval: float = None, periodicity: int = None):
+@instrument
+def return_number_of_habit_resets(db, name: str = None, time_interval: float = None, periodicity: int = None,
+                                  start_date: dt.date = None, end_date: dt.date = None, workers: int = None,
+                                  user: str = DEFAULT_USER, backend: str = 'python', as_of: dt.date = None):
     """
     returns the amount of habit resets for one habit if provided or checks the largest reset number over all habits
 
@@ -177,26 +362,21 @@ def return_number_of_habit_resets(db, name: str = None, time_interval: float = N
     :param time_interval: if a timeframe is provided, only data for a certain amount of time is extracted,
     otherwise all data is extracted
     :param periodicity: if periodicity is proved, only habits with this periodicity will be analysed
+    :param start_date: if provided, only data from this date on is analysed, replaces time_interval
+    :param end_date: if provided, only data until this date is analysed
+    :param workers: number of worker processes for the analysis of all habits, see analyse_window
+    :param user: user the habits belong to
+    :param backend: 'python' or 'sql', see get_habit_summary_for_all_habits
+    :param as_of: the date the analysis is done on, see get_habit_summary_for_all_habits
     :return: name and count of habit resets
     """
 
     if not name:
         # if no name is provided, data for all habits will be extracted
-        data = get_habit_streak_for_all_habits(db, time_interval, periodicity)
-
-        # initialise dictionary to store reset count for the individual habits
-        reset_count_dict = dict()
-
-        # loop to go through all different habits
-        for name, date_check in data.items():
-            reset_count = 0
-
-            # loops through check-off dates
-            for key, value in date_check.items():
-                # if value == False, habit was not completed on this day, so reset count will be incremented
-                if not value:
-                    reset_count += 1
-            reset_count_dict[name] = reset_count
+        data = get_habit_summary_for_all_habits(db, time_interval, periodicity, start_date=start_date,
+                                                end_date=end_date, workers=workers, user=user, backend=backend,
+                                                as_of=as_of)
+        reset_count_dict = {habit_name: summary.resets for habit_name, summary in data.items()}
 
         # check for highest reset count
         max_reset_count = max(reset_count_dict.values())
@@ -207,11 +387,215 @@ def return_number_of_habit_resets(db, name: str = None, time_interval: float = N
 
     # checks resets for a specified habit
     else:
-        data = get_habit_streak(db, name, time_interval)
-        reset_count = 0
-
-        for key, value in data.items():
-            if not value:
-                reset_count += 1
+        data = get_habit_summary_for_all_habits(db, time_interval, name=name, start_date=start_date, end_date=end_date,
+                                                user=user, backend=backend, as_of=as_of)
+        reset_count = data[name].resets
         # returns habit name and its reset count
         return name, reset_count
+
+
+class CurrentStreak(NamedTuple):
+    """
+    streak of a habit that is still alive, as returned by current_streaks
+
+    current_streak: number of consecutive completed periods up to the current or the previous period
+    last_check_off: date of the most recent check-off in the form YYYY-MM-DD
+    due_date: last day of the current period in the form YYYY-MM-DD, the streak breaks if the habit is not checked
+    off until then
+    at_risk: True if the current period has not been completed yet
+    """
+    name: str
+    periodicity: int
+    current_streak: int
+    last_check_off: str
+    due_date: str
+    at_risk: bool
+
+
+@instrument
+def current_streaks(db, periodicity: int = None, name: str = None, user: str = DEFAULT_USER, as_of: dt.date = None):
+    """
+    returns the habits whose streak is still alive today or on the as_of date. Only the first and the most recent
+    check-off of every habit are read from the index. Every period rule maps the most recent check-off and the as_of
+    date to their period indices in O(1), so habits that were not checked off in the current or the previous period
+    are skipped without reading more. For the others the check-offs are read backwards until the streak ends, see
+    get_run_length and get_rule_run_length. The cost grows with the length of the streaks, not with the length of the
+    history. The periods and streaks are the same as in get_habit_summary_for_all_habits.
+
+    :param db: database where the data is stored
+    :param periodicity: if periodicity is provided, only habits with this periodicity will be returned
+    :param name: if supplied, only this habit will be returned
+    :param user: user the habits belong to
+    :param as_of: date the streaks are computed for, check-offs after it are ignored, if not provided today's date
+    is used, see clock
+    :return: dictionary, key = habit name, value = CurrentStreak, ordered like get_habit_names
+    """
+    as_of = as_of or today()
+    end = as_of.toordinal()
+    streaks = dict()
+    bounds = get_check_off_bounds(db, periodicity, name, user, as_of)
+    for habit_name, (habit_periodicity, first, last) in bounds.items():
+        if not isinstance(habit_periodicity, int):
+            streak = _rule_current_streak(db, habit_name, habit_periodicity, first, last, end, user)
+            if streak:
+                streaks[habit_name] = streak
+            continue
+        grid = period_grid(first, _start_date().toordinal(), end, habit_periodicity)
+        if not grid.periods or last > end:
+            continue
+        current_period = grid.periods - 1
+        last_period = (last - grid.start) // habit_periodicity
+        if last_period < current_period - 1:
+            continue
+        # the run can not go back further than the first period of the grid
+        streak = min(get_run_length(db, habit_name, grid.start, habit_periodicity, last_period, user), last_period + 1)
+        streaks[habit_name] = CurrentStreak(habit_name, habit_periodicity, streak, to_date_string(last),
+                                            to_date_string(grid.period_start(current_period) + habit_periodicity - 1),
+                                            last_period < current_period)
+    return streaks
+
+
+def _rule_current_streak(db, name: str, periodicity, first: int, last: int, end: int, user: str):
+    """
+    CurrentStreak of a habit with calendar or quota periods, the periods are anchored like in analyse_window
+
+    :return: CurrentStreak, None if the streak is not alive
+    """
+    start = _start_date().toordinal()
+    grid = rule_grid(first, start, end, parse_periodicity(periodicity))
+    if not grid.periods or last > end:
+        return None
+    rule = grid.periodicity
+    current_period = rule.index(end)
+    last_period = rule.index(last)
+    if last_period < current_period - 1:
+        return None
+    streak = 0
+    if last_period == current_period:
+        streak = get_rule_run_length(db, name, rule, start, end, current_period, user)
+    at_risk = not streak
+    if at_risk:
+        # the streak is still alive if it ends with the previous period
+        streak = get_rule_run_length(db, name, rule, start, end, current_period - 1, user)
+        if not streak:
+            return None
+    return CurrentStreak(name, periodicity, streak, to_date_string(last),
+                         to_date_string(rule.start(current_period + 1) - 1), at_risk)
+
+
+@instrument
+def habits_at_risk(db, periodicity: int = None, user: str = DEFAULT_USER, as_of: dt.date = None):
+    """
+    returns the habits with a live streak that breaks if they are not checked off in the current period, see
+    current_streaks
+
+    :param db: database where the data is stored
+    :param periodicity: if periodicity is provided, only habits with this periodicity will be returned
+    :param user: user the habits belong to
+    :param as_of: date the streaks are computed for, see current_streaks
+    :return: list with CurrentStreak tuples, the habit that is due first comes first, then the longest streak
+    """
+    at_risk = [streak for streak in current_streaks(db, periodicity, user=user, as_of=as_of).values()
+               if streak.at_risk]
+    return sorted(at_risk, key=lambda streak: (streak.due_date, -streak.current_streak, streak.name))
+
+
+class CompletionRate(NamedTuple):
+    """
+    check-offs of a habit in one calendar week or month, expected is the number of check-offs that complete the
+    periods of the habit on the days of the week or month from the first check-off until the end of the analysis,
+    see periods.PeriodRule.expected, rate is check_offs / expected, at most 1.0
+    """
+    period_start: str
+    check_offs: int
+    expected: float
+    rate: float
+
+
+@instrument
+def completion_rates(db, grain: str = 'week', start_date: dt.date = None, end_date: dt.date = None,
+                     periodicity: int = None, name: str = None, user: str = DEFAULT_USER):
+    """
+    returns the completion rate of every habit per calendar week or month. The rates are computed from the rollups
+    (see habit_db.get_rollups) and not from the check-offs, so a range of years costs one row per week or month.
+    Weeks and months are counted as a whole, start_date and end_date select the ones that contain them.
+
+    :param db: database where the data is stored
+    :param grain: 'week' or 'month'
+    :param start_date: first day of the analysis, if not provided all data is analysed
+    :param end_date: last day of the analysis, if not provided today's date is used
+    :param periodicity: if periodicity is provided, only habits with this periodicity will be analysed
+    :param name: if supplied, only this habit will be analysed
+    :param user: user the habits belong to
+    :return: dictionary, key = habit name, value = list with a CompletionRate for every week or month from the first
+    check-off until end_date, also for the ones without check-offs
+    """
+    end_date = end_date or today()
+    start, end = (start_date or _start_date()).toordinal(), end_date.toordinal()
+    rollups = get_rollups(db, grain, start_date or _start_date(), end_date, periodicity, name, user)
+    bucket_rule = parse_periodicity(grain)
+
+    rates = dict()
+    for habit_name, (habit_periodicity, first, _) in get_check_off_bounds(db, periodicity, name, user).items():
+        habit_rates = rates[habit_name] = []
+        if first is None or first > end:
+            continue
+        first = max(first, bucket_rule.start(bucket_rule.index(start)))
+        rule = parse_periodicity(habit_periodicity)
+        check_offs = {record.period_start: record.check_offs for record in rollups[habit_name]}
+        for index in range(bucket_rule.index(first), bucket_rule.index(end) + 1):
+            period_start = bucket_rule.start(index)
+            expected = rule.expected(max(period_start, first), min(bucket_rule.start(index + 1) - 1, end))
+            count = check_offs.get(period_start, 0)
+            habit_rates.append(CompletionRate(to_date_string(period_start), count, expected,
+                                              min(1.0, count / expected)))
+    return rates
+
+
+@instrument
+def weekday_heatmap(db, start_date: dt.date = None, end_date: dt.date = None, periodicity: int = None,
+                    name: str = None, user: str = DEFAULT_USER):
+    """
+    counts the check-offs of every habit per weekday, summed up from the weekly rollups, see completion_rates
+
+    :param db: database where the data is stored
+    :param start_date: if provided, only the weeks from the one that contains this date on are counted
+    :param end_date: if provided, only the weeks until the one that contains this date are counted
+    :param periodicity: if periodicity is provided, only habits with this periodicity will be counted
+    :param name: if supplied, only this habit will be counted
+    :param user: user the habits belong to
+    :return: dictionary, key = habit name, value = dictionary with the number of check-offs per weekday from
+    'monday' to 'sunday'
+    """
+    heatmap = dict()
+    for habit_name, records in get_rollups(db, 'week', start_date, end_date, periodicity, name, user).items():
+        counts = map(sum, zip(*(record.weekdays for record in records))) if records else repeat(0)
+        heatmap[habit_name] = dict(zip(WEEKDAYS, counts))
+    return heatmap
+
+
+@instrument
+def periodicity_trends(db, grain: str = 'month', start_date: dt.date = None, end_date: dt.date = None,
+                       user: str = DEFAULT_USER):
+    """
+    returns the mean completion rate of the habits of every periodicity per calendar week or month, see
+    completion_rates
+
+    :param db: database where the data is stored
+    :param grain: 'week' or 'month'
+    :param start_date: first day of the analysis, if not provided all data is analysed
+    :param end_date: last day of the analysis, if not provided today's date is used
+    :param user: user the habits belong to
+    :return: dictionary, key = periodicity, value = list with (first day of the week or month in the form
+    YYYY-MM-DD, mean completion rate) tuples in ascending order, only weeks or months in which at least one habit of
+    the periodicity was tracked are listed
+    """
+    periodicities = {habit_name: habit_periodicity for habit_name, (habit_periodicity, _, _)
+                     in get_check_off_bounds(db, user=user).items()}
+    buckets = dict()
+    for habit_name, habit_rates in completion_rates(db, grain, start_date, end_date, user=user).items():
+        periodicity_buckets = buckets.setdefault(periodicities[habit_name], dict())
+        for rate in habit_rates:
+            periodicity_buckets.setdefault(rate.period_start, []).append(rate.rate)
+    return {periodicity: [(period_start, sum(rates) / len(rates)) for period_start, rates in sorted(bucket.items())]
+            for periodicity, bucket in buckets.items()}
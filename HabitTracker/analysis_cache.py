@@ -0,0 +1,167 @@
+"""
+Result cache for the analysis functions of analyse_habits.
+
+Results are stored per function, user, habit and arguments together with the data version of the habit (or of all
+habits of the user if the function analyses all habits, see habit_db.get_data_version). A result is only returned
+while the version in the database is unchanged, so a check-off of one habit only invalidates the results of that
+habit and of the functions that analyse all habits, also if it was stored by another process. The cache holds at
+most maxsize results, the least recently used one is dropped first, and results expire after ttl seconds.
+
+    streaks = default_cache.wrap(analyse_habits.return_number_of_habit_streaks)
+    streaks(db, "Study")  # computed
+    streaks(db, "Study")  # read from the cache
+"""
+import functools
+import inspect
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+import analyse_habits
+from clock import today
+from habit_db import DEFAULT_USER, get_data_version, get_db_path
+
+# arguments that do not change the result of an analysis
+_IGNORED_ARGUMENTS = ('db', 'workers', 'backend')
+
+
+class CacheStats(NamedTuple):
+    """
+    hit and miss statistics of an AnalysisCache, misses include expired and outdated results
+    """
+    hits: int
+    misses: int
+    evictions: int
+    size: int
+    maxsize: int
+
+    @property
+    def hit_rate(self) -> float:
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+
+class AnalysisCache:
+    """
+    LRU cache for results of the analyse_habits functions, see the module documentation. It can be shared by several
+    threads. The cached results are returned as they are and must not be modified.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 300.0, clock=time.monotonic):
+        """
+        :param maxsize: maximal number of results in the cache
+        :param ttl: seconds after which a result expires, None if results do not expire
+        :param clock: function that returns the current time in seconds
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = self._misses = self._evictions = 0
+
+    def get(self, key, version):
+        """
+        returns a cached result, if it exists for this data version and has not expired
+
+        :param key: key of the result
+        :param version: current data version
+        :return: tuple with True and the result or with False and None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_version, expires, result = entry
+                if entry_version == version and (expires is None or self._clock() < expires):
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return True, result
+                del self._entries[key]
+            self._misses += 1
+            return False, None
+
+    def put(self, key, version, result, expires: bool = True):
+        """
+        stores a result, if the cache is full the least recently used result is dropped
+
+        :param key: key of the result
+        :param version: data version the result was computed from
+        :param result: result
+        :param expires: False for results that stay valid while the data version is unchanged, they do not expire
+        after ttl seconds
+        """
+        expires = None if self.ttl is None or not expires else self._clock() + self.ttl
+        with self._lock:
+            self._entries[key] = (version, expires, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, user: str = None, name: str = None):
+        """
+        drops cached results, the versions in the database make this unnecessary after writes, it only frees memory
+
+        :param user: if supplied, only the results of this user are dropped
+        :param name: if supplied, only the results of this habit and of the analyses of all habits are dropped
+        """
+        with self._lock:
+            for key in list(self._entries):
+                _, key_user, key_name, _ = key
+                if (user is None or key_user == user) and (name is None or key_name in (name, None)):
+                    del self._entries[key]
+
+    def clear(self):
+        """
+        drops all results and resets the statistics
+        """
+        with self._lock:
+            self._entries.clear()
+            self._hits = self._misses = self._evictions = 0
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(self._hits, self._misses, self._evictions, len(self._entries), self.maxsize)
+
+    def wrap(self, function):
+        """
+        returns a version of an analyse_habits function that uses the cache. The function has to take the database as
+        first argument and may take the arguments name, user and as_of. Results of analyses with a window relative to
+        today are only reused on the same day, see clock. Results of analyses with an as_of date only depend on the
+        data, they do not expire.
+
+        :param function: analysis function
+        :return: cached function with the same signature
+        """
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def cached(db, *args, **kwargs):
+            arguments = signature.bind(db, *args, **kwargs)
+            arguments.apply_defaults()
+            name = arguments.arguments.get('name')
+            user = arguments.arguments.get('user', DEFAULT_USER)
+            window = tuple((argument, value) for argument, value in arguments.arguments.items()
+                           if argument not in _IGNORED_ARGUMENTS + ('name', 'user'))
+            as_of = arguments.arguments.get('as_of')
+            database = get_db_path(db) or id(db)
+            key = (function.__qualname__, user, name or None, (database, None if as_of else today(), window))
+
+            version = get_data_version(db, name, user)
+            found, result = self.get(key, version)
+            if not found:
+                result = function(*arguments.args, **arguments.kwargs)
+                self.put(key, version, result, not as_of)
+            return result
+
+        cached.cache = self
+        return cached
+
+
+default_cache = AnalysisCache()
+
+get_habit_streak = default_cache.wrap(analyse_habits.get_habit_streak)
+get_habit_summary_for_all_habits = default_cache.wrap(analyse_habits.get_habit_summary_for_all_habits)
+return_number_of_habit_streaks = default_cache.wrap(analyse_habits.return_number_of_habit_streaks)
+return_number_of_habit_resets = default_cache.wrap(analyse_habits.return_number_of_habit_resets)
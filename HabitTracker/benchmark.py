@@ -0,0 +1,165 @@
+"""
+Benchmark suite for habit_db and analyse_habits.
+
+A deterministic generator fills a SQLite database with synthetic habits, then the data access and analysis functions
+are timed for several size tiers. The results are written to a JSON file, so they can be compared between releases:
+
+    python benchmark.py --tiers small medium --output benchmark_results.json
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+
+import analyse_habits
+import habit_db
+from clock import fixed_clock, today
+
+# tier name: (number of habits, years of history)
+TIERS = {
+    'small': (10, 1),
+    'medium': (100, 5),
+    'large': (1000, 10),
+}
+
+
+def generate_check_offs(habits: int, years: int, completion_rate: float = 0.8, weekly_share: float = 0.3,
+                        seed: int = 0, end_date: dt.date = None):
+    """
+    generates synthetic habits and their check-off dates, the same arguments always generate the same data
+
+    :param habits: number of habits
+    :param years: years of history until end_date
+    :param completion_rate: probability that a habit is completed in a period
+    :param weekly_share: share of weekly habits, all other habits are daily habits
+    :param seed: seed of the random number generator
+    :param end_date: last day of the history, if not provided today's date is used
+    :return: tuple with a list of (habit name, periodicity) pairs and a generator of (habit name, date) pairs
+    """
+    rng = random.Random(seed)
+    end_date = end_date or today()
+    start_date = end_date - dt.timedelta(days=365 * years)
+    habit_list = [(f'habit_{i:05d}', 7 if rng.random() < weekly_share else 1) for i in range(habits)]
+
+    def check_offs():
+        for name, periodicity in habit_list:
+            habit_rng = random.Random(f'{seed}-{name}')
+            day = start_date
+            while day <= end_date:
+                check_off_date = day + dt.timedelta(days=habit_rng.randrange(periodicity))
+                if habit_rng.random() < completion_rate and check_off_date <= end_date:
+                    yield name, check_off_date
+                day += dt.timedelta(days=periodicity)
+
+    return habit_list, check_offs()
+
+
+def populate_db(db, habits: int, years: int, completion_rate: float = 0.8, weekly_share: float = 0.3,
+                seed: int = 0, end_date: dt.date = None):
+    """
+    stores synthetic habits and check-offs in a database, see generate_check_offs
+
+    :param db: database where the data is stored
+    :return: number of stored check-offs
+    """
+    habit_list, check_offs = generate_check_offs(habits, years, completion_rate, weekly_share, seed, end_date)
+    start_date = (end_date or today()) - dt.timedelta(days=365 * years)
+    for name, periodicity in habit_list:
+        habit_db.add_habit(db, name, periodicity, start_date)
+    inserted, skipped = habit_db.increment_habits_bulk(db, check_offs)
+    return inserted
+
+
+def time_call(function, repeat: int):
+    """
+    calls function repeat times
+
+    :return: dictionary with the best and the mean time in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return {'best_s': min(timings), 'mean_s': sum(timings) / len(timings), 'repeat': repeat}
+
+
+def run_tier(tier: str, repeat: int, directory: str):
+    """
+    creates the database of a tier and times all benchmarks on it
+
+    :return: list with one result dictionary per benchmark
+    """
+    habits, years = TIERS[tier]
+    path = os.path.join(directory, f'benchmark_{tier}.db')
+    db = habit_db.get_db(path)
+
+    start = time.perf_counter()
+    check_offs = populate_db(db, habits, years)
+    duration = time.perf_counter() - start
+    results = [{'benchmark': 'populate_db', 'best_s': duration, 'mean_s': duration, 'repeat': 1}]
+
+    name = habit_db.get_habit_names(db)[0]
+    start_date = today() - dt.timedelta(days=365 * years)
+
+    def rebuild_summaries():
+        db.execute("UPDATE habit_streaks SET stale = 1")
+        analyse_habits.return_number_of_habit_streaks(db)
+
+    benchmarks = {
+        'get_habit_tracker': lambda: habit_db.get_habit_tracker(db, start_date, name),
+        'get_habit_streak': lambda: analyse_habits.get_habit_streak(db, name),
+        'return_number_of_habit_streaks': lambda: analyse_habits.return_number_of_habit_streaks(db, name),
+        'return_number_of_habit_streaks_all': lambda: analyse_habits.return_number_of_habit_streaks(db),
+        'return_number_of_habit_streaks_all_30_days': lambda: analyse_habits.return_number_of_habit_streaks(
+            db, time_interval=30),
+        'return_number_of_habit_resets': lambda: analyse_habits.return_number_of_habit_resets(db, name),
+        'return_number_of_habit_resets_all': lambda: analyse_habits.return_number_of_habit_resets(db),
+        'get_habit_streak_for_all_habits': lambda: analyse_habits.get_habit_streak_for_all_habits(db),
+        'streak_summary_rebuild': rebuild_summaries,
+    }
+    for benchmark, function in benchmarks.items():
+        results.append({'benchmark': benchmark, **time_call(function, repeat)})
+
+    db.close()
+    os.remove(path)
+    for result in results:
+        result.update(tier=tier, habits=habits, years=years, check_offs=check_offs)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for habit_db and analyse_habits')
+    parser.add_argument('--tiers', nargs='+', choices=list(TIERS), default=['small', 'medium'])
+    parser.add_argument('--repeat', type=int, default=5, help='how often each benchmark is repeated')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file the results are written to')
+    parser.add_argument('--as-of', type=dt.date.fromisoformat, default=dt.date(2022, 6, 30),
+                        help='date the data is generated and analysed for, YYYY-MM-DD, the same date gives the same '
+                             'data and windows on every run')
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory, fixed_clock(args.as_of):
+        for tier in args.tiers:
+            results.extend(run_tier(tier, args.repeat, directory))
+            for result in results:
+                if result['tier'] == tier:
+                    print(f"{tier:8} {result['benchmark']:45} {result['best_s'] * 1000:10.2f} ms")
+
+    report = {
+        'created': dt.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'as_of': args.as_of.isoformat(),
+        'results': results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+"""
+Buffered write mode for check-offs.
+
+A CheckOffQueue acknowledges a check-off as soon as it was appended to a queue in memory and, if a journal file is
+given, to that append-only file. A background thread stores the queued check-offs in SQLite in one transaction per
+batch, when batch_size check-offs are waiting or the oldest one waited flush_interval seconds. Under bursts of
+check-offs only one commit is made per batch instead of one per check-off.
+
+Every flush starts a new journal segment and deletes the segment of the batch once the batch was committed. If the
+process dies, the segments that are left are replayed the next time a queue is opened with the same journal. Storing
+a check-off twice has no effect, so a batch that was committed right before a crash can be replayed safely. close
+flushes all check-offs, so nothing is lost on a clean shutdown. Without a journal, check-offs that were not flushed
+yet are lost if the process dies.
+
+    with ConnectionManager("main.db") as connections, CheckOffQueue(connections, "check_offs.journal") as queue:
+        queue.put("Study", dt.date.today())
+        HabitTracker("Study", queue=queue).add_event(None, dt.date.today())
+
+Check-offs of habits that do not exist are dropped by the flusher and counted as rejected, see stats. If a batch can
+not be stored, e.g. because the database is locked, the batch is queued again and retried, the error is counted and
+raised by the flush calls that are waiting for it.
+"""
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+from itertools import count
+from typing import NamedTuple
+
+from habit_db import DEFAULT_USER, ConnectionManager, increment_habits_batch, to_day_number
+from instrumentation import measure
+
+
+class QueueStats(NamedTuple):
+    """
+    metrics of a CheckOffQueue
+
+    pending: check-offs that were acknowledged but are not stored yet
+    flushed: check-offs that were handed to SQLite, stored: the ones of them that were not stored before
+    rejected: check-offs of habits that do not exist
+    recovered: check-offs replayed from the journal when the queue was opened
+    batches: committed batches, errors: failed flushes, their batches were queued again
+    last_flush_seconds, max_flush_seconds: duration of the transactions of the batches
+    mean_latency_seconds, max_latency_seconds: time from put until the check-off was committed
+    last_error: exception of the last failed flush, None if no flush failed
+    """
+    pending: int
+    flushed: int
+    stored: int
+    rejected: int
+    recovered: int
+    batches: int
+    errors: int
+    last_flush_seconds: float
+    max_flush_seconds: float
+    mean_latency_seconds: float
+    max_latency_seconds: float
+    last_error: Exception
+
+
+class CheckOffQueue:
+    """
+    write-ahead queue for check-offs with a background flusher, see the module documentation
+    """
+
+    def __init__(self, connections: ConnectionManager, journal: str = None, batch_size: int = 1000,
+                 flush_interval: float = 0.5, sync: bool = False):
+        """
+        :param connections: ConnectionManager, the check-offs are stored with its writer connection
+        :param journal: path of the append-only journal, None to keep the queue in memory only
+        :param batch_size: number of waiting check-offs that starts a flush
+        :param flush_interval: seconds the oldest check-off waits at most before it is flushed
+        :param sync: if True, every put waits for os.fsync of the journal, so check-offs also survive a power failure
+        """
+        self.connections = connections
+        self.journal = journal
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sync = sync
+        self._condition = threading.Condition()
+        self._pending = []
+        self._segments = []
+        self._file = None
+        self._sequence = self._flushed_sequence = 0
+        self._flush_requested = self._stopping = False
+        self._flushed = self._stored = self._rejected = self._recovered = self._batches = self._errors = 0
+        self._last_flush = self._max_flush = self._latency = self._max_latency = 0.0
+        self._last_error = None
+        if journal:
+            self._recover()
+            self._segment_numbers = count()
+            self._file = open(journal, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name='check-off-flusher', daemon=True)
+        self._thread.start()
+
+    def _segment_files(self):
+        """
+        :return: the journal segments that have not been flushed, oldest first, the current journal last
+        """
+        segments = [path for path in glob.glob(glob.escape(self.journal) + '.*') if path.rsplit('.', 1)[1].isdigit()]
+        segments.sort(key=lambda path: int(path.rsplit('.', 1)[1]))
+        return segments + [self.journal] if os.path.exists(self.journal) else segments
+
+    def _recover(self):
+        """
+        stores the check-offs of the journal segments that were left by a process that did not close its queue
+        """
+        rows = []
+        segments = self._segment_files()
+        for path in segments:
+            with open(path, encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        user, name, day = json.loads(line)
+                        if not isinstance(day, int):
+                            raise ValueError(day)
+                    except (ValueError, TypeError):
+                        # the last line is incomplete if the process died while it was written
+                        continue
+                    rows.append((user, name, day))
+        if rows:
+            self._store(rows)
+            self._recovered = len(rows)
+        for path in segments:
+            os.remove(path)
+
+    def put(self, name: str, event_date, user: str = DEFAULT_USER) -> int:
+        """
+        queues a check-off and returns as soon as it is written to the journal, a ValueError is raised at once if the
+        date is invalid
+
+        :param name: habit name
+        :param event_date: date like in habit_db.increment_habit
+        :param user: user the habit belongs to
+        :return: sequence number of the check-off
+        """
+        day = to_day_number(event_date)
+        with self._condition:
+            if self._stopping:
+                raise RuntimeError('the queue is closed')
+            if self._file is not None:
+                self._file.write(json.dumps([user, name, day]) + '\n')
+                self._file.flush()
+                if self.sync:
+                    os.fsync(self._file.fileno())
+            self._sequence += 1
+            self._pending.append((user, name, day, time.perf_counter()))
+            # the flusher waits without timeout while the queue is empty
+            if len(self._pending) == 1 or len(self._pending) >= self.batch_size:
+                self._condition.notify_all()
+            return self._sequence
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        waits until all check-offs that were queued before are stored. If a flush fails meanwhile, its error is raised,
+        the check-offs stay queued and are retried.
+
+        :param timeout: seconds to wait at most, None to wait until they are stored
+        :return: True if they were stored, False if the timeout expired
+        """
+        with self._condition:
+            target, errors = self._sequence, self._errors
+            self._flush_requested = True
+            self._condition.notify_all()
+            if not self._condition.wait_for(lambda: self._flushed_sequence >= target or self._errors > errors,
+                                            timeout):
+                return False
+            if self._flushed_sequence < target:
+                raise self._last_error
+            return True
+
+    def close(self):
+        """
+        flushes all queued check-offs, stops the flusher and removes the journal. If the last flush fails, its error is
+        raised, the check-offs that were not stored stay in the journal.
+        """
+        with self._condition:
+            if self._stopping:
+                return
+            self._stopping = True
+            self._condition.notify_all()
+        self._thread.join()
+        if self._file is not None:
+            self._file.close()
+            # the journal only holds queued check-offs, it is empty once all of them are stored
+            if not self._pending and os.path.exists(self.journal):
+                os.remove(self.journal)
+        if self._pending:
+            raise self._last_error
+
+    def stats(self) -> QueueStats:
+        with self._condition:
+            mean_latency = self._latency / self._flushed if self._flushed else 0.0
+            return QueueStats(len(self._pending), self._flushed, self._stored, self._rejected, self._recovered,
+                              self._batches, self._errors, self._last_flush, self._max_flush, mean_latency,
+                              self._max_latency, self._last_error)
+
+    def _due(self) -> bool:
+        if not self._pending:
+            return False
+        return (self._stopping or self._flush_requested or len(self._pending) >= self.batch_size or
+                time.perf_counter() - self._pending[0][3] >= self.flush_interval)
+
+    def _take(self):
+        """
+        takes all queued check-offs and starts a new journal segment, called with the lock held
+
+        :return: tuple with the check-offs, their last sequence number and the journal segments that hold them
+        """
+        if self._file is not None:
+            segment = f'{self.journal}.{next(self._segment_numbers)}'
+            self._file.close()
+            try:
+                os.replace(self.journal, segment)
+            finally:
+                # if the journal could not be renamed, the check-offs stay queued and are written on
+                self._file = open(self.journal, 'a', encoding='utf-8')
+            self._segments.append(segment)
+        batch, self._pending = self._pending, []
+        segments, self._segments = self._segments, []
+        return batch, self._sequence, segments
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._due():
+                    if self._stopping:
+                        return
+                    if self._flush_requested:
+                        # nothing is queued, so everything that was queued is stored already
+                        self._flush_requested = False
+                        self._flushed_sequence = self._sequence
+                        self._condition.notify_all()
+                    timeout = None
+                    if self._pending:
+                        timeout = max(0.0, self._pending[0][3] + self.flush_interval - time.perf_counter())
+                    self._condition.wait(timeout)
+                try:
+                    batch, sequence, segments = self._take()
+                except Exception as error:
+                    batch = None
+                    self._failed(error)
+            if batch is None or not self._flush(batch, sequence, segments):
+                if self._stopping:
+                    # the check-offs stay in the journal and are replayed when the queue is opened again
+                    return
+                # every error keeps the flusher running, it waits before the batch is retried
+                time.sleep(self.flush_interval)
+
+    def _failed(self, error: Exception):
+        """
+        counts a failed flush and wakes the flush calls that wait for it, called with the lock held
+        """
+        self._errors += 1
+        self._last_error = error
+        self._condition.notify_all()
+
+    def _flush(self, batch: list, sequence: int, segments: list) -> bool:
+        """
+        stores a batch and deletes its journal segments, if it can not be stored the batch is queued again
+
+        :return: True if the batch was stored
+        """
+        start = time.perf_counter()
+        try:
+            with measure('check_off_queue.flush'):
+                stored, rejected = self._store([row[:3] for row in batch])
+        except Exception as error:
+            with self._condition:
+                self._pending[:0] = batch
+                self._segments[:0] = segments
+                self._failed(error)
+            return False
+        end = time.perf_counter()
+        for segment in segments:
+            try:
+                os.remove(segment)
+            except OSError:
+                # the batch is stored, a segment that is left is replayed without effect
+                pass
+        with self._condition:
+            self._flushed += len(batch)
+            self._stored += stored
+            self._rejected += rejected
+            self._batches += 1
+            self._last_flush = end - start
+            self._max_flush = max(self._max_flush, self._last_flush)
+            self._latency += sum(end - row[3] for row in batch)
+            self._max_latency = max(self._max_latency, end - batch[0][3])
+            self._flushed_sequence = sequence
+            if not self._pending:
+                self._flush_requested = False
+            self._condition.notify_all()
+        return True
+
+    def _store(self, rows: list):
+        """
+        stores check-offs in one transaction, if a habit does not exist the check-offs are stored one by one and the
+        ones of habits that do not exist are dropped
+
+        :return: tuple with the number of stored and rejected check-offs
+        """
+        with self.connections.write() as db:
+            try:
+                return increment_habits_batch(db, rows), 0
+            except sqlite3.IntegrityError:
+                stored = rejected = 0
+                for row in rows:
+                    try:
+                        stored += increment_habits_batch(db, [row])
+                    except sqlite3.IntegrityError:
+                        rejected += 1
+                return stored, rejected
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,52 @@
+"""
+Clock of the HabitTracker app: the date that is treated as today.
+
+Every function that needs today's date calls today(), so a test, a batch job that backfills reports for past dates or
+a benchmark can fix the date for the whole process:
+
+    with fixed_clock(dt.date(2022, 6, 24)):
+        analyse_habits.return_number_of_habit_resets(db, 'Study')
+
+The analysis functions also take an as_of date, which replaces the clock for one call. The result of an analysis with
+as_of only depends on the data and as_of, so analysis_cache keeps it as long as the data version is unchanged.
+"""
+import datetime as dt
+from contextlib import contextmanager
+
+_clock = dt.date.today
+
+
+def today() -> dt.date:
+    """
+    :return: today's date according to the current clock
+    """
+    return _clock()
+
+
+def set_clock(clock=None):
+    """
+    replaces the clock of the process
+
+    :param clock: function without arguments that returns a dt.date, None restores the system clock
+    :return: the previous clock
+    """
+    global _clock
+    previous = _clock
+    _clock = clock or dt.date.today
+    return previous
+
+
+@contextmanager
+def fixed_clock(date: dt.date):
+    """
+    context manager that makes today() return date while the block runs
+
+    :param date: dt.date or a string in the form YYYY-MM-DD
+    """
+    if isinstance(date, str):
+        date = dt.date.fromisoformat(date)
+    previous = set_clock(lambda: date)
+    try:
+        yield date
+    finally:
+        set_clock(previous)
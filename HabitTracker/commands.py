@@ -0,0 +1,188 @@
+"""
+Command layer of the HabitTracker app, used by the command line interface and by the interactive menu of main.py.
+
+Every command takes the database connection and returns a dictionary that can be printed as JSON. Errors that the
+user can fix are raised as CommandError. The analyses are cached with analysis_cache, so the interactive menu does
+not compute the same result twice while the data is unchanged.
+"""
+import datetime as dt
+import sqlite3
+
+from analyse_habits import habits_at_risk, return_habit_names
+from analysis_cache import return_number_of_habit_streaks, return_number_of_habit_resets
+from habit_db import DEFAULT_USER, get_habit_names, get_habit_periodicities, increment_habits
+from habit_io import export_file, import_file
+from habit_tracker import HabitTracker
+from periods import normalise_periodicity, period_length
+
+
+class CommandError(Exception):
+    """
+    raised when a command can not be executed, the message is shown to the user
+    """
+
+
+def _check_habits_exist(db, name: str = None, periodicity: int = None, user: str = DEFAULT_USER):
+    habit_names = get_habit_names(db, None if name else periodicity, user)
+    if name and name not in habit_names:
+        raise CommandError(f'there is no habit "{name}"')
+    if not habit_names:
+        raise CommandError('there are no habits to analyse')
+
+
+def add(db, name: str, periodicity: int = 1, user: str = DEFAULT_USER, store=None):
+    """
+    stores a new habit
+
+    :param db: database where the data is stored
+    :param name: habit name
+    :param periodicity: habit periodicity in days, 'week', 'month' or a quota like '3/7', see periods
+    :param user: user the habit belongs to
+    :param store: habit_store.HabitStore that is kept up to date, if provided
+    :return: dictionary with the habit and its periodicity
+    """
+    try:
+        periodicity = normalise_periodicity(periodicity)
+        HabitTracker(name, periodicity, user, store).store(db)
+    except ValueError as error:
+        raise CommandError(str(error)) from None
+    except sqlite3.IntegrityError:
+        raise CommandError(f'the habit "{name}" already exists') from None
+    return {'habit': name, 'periodicity': periodicity}
+
+
+def check_off(db, events, user: str = DEFAULT_USER, store=None):
+    """
+    stores check-offs in one transaction, the streak summaries are kept up to date
+
+    :param db: database where the data is stored
+    :param events: iterable with (habit name, check-off date) pairs, dates as dt.date or strings in the form YYYY-MM-DD
+    :param user: user the habits belong to
+    :param store: habit_store.HabitStore that is kept up to date, if provided
+    :return: dictionary with the number of stored check-offs and the number of check-offs that were already stored
+    """
+    events = list(events)
+    try:
+        stored = increment_habits(db, events, user)
+    except ValueError as error:
+        raise CommandError(f'invalid date: {error}') from None
+    except sqlite3.IntegrityError:
+        unknown = sorted({name for name, _ in events} - set(get_habit_names(db, user=user)))
+        raise CommandError(f'unknown habit(s): {", ".join(unknown)}, nothing was checked off') from None
+    if store is not None:
+        store.checked_off(events, user, stored > 0)
+    return {'stored': stored, 'skipped': len(events) - stored}
+
+
+def delete(db, name: str, user: str = DEFAULT_USER, store=None):
+    """
+    deletes a habit and its check-offs
+
+    :param db: database where the data is stored
+    :param name: habit name
+    :param user: user the habit belongs to
+    :param store: habit_store.HabitStore that is kept up to date and answers whether the habit exists, if provided
+    :return: dictionary with the deleted habit
+    """
+    if name not in (store.names() if store is not None else get_habit_names(db, user=user)):
+        raise CommandError(f'there is no habit "{name}"')
+    HabitTracker(name, user=user, habit_store=store).delete_habit(db)
+    return {'deleted': name}
+
+
+def habit_list(db, periodicity: int = None, user: str = DEFAULT_USER, store=None, length: int = None):
+    """
+    :param db: database where the data is stored
+    :param periodicity: if provided, only habits with this periodicity are listed
+    :param user: user the habits belong to
+    :param store: habit_store.HabitStore of the user, if provided the names are read from it
+    :param length: if provided, only habits whose periods last this number of days are listed, e.g. 7 lists the
+    habits with the periodicities 7, 'week' and '3/7', see periods.period_length
+    :return: dictionary with the habit names
+    """
+    if store is not None:
+        names = store.names(periodicity)
+        if length is not None:
+            names = [name for name in names if period_length(store.periodicity(name)) == length]
+        return {'habits': names}
+    if length is None:
+        return {'habits': return_habit_names(db, periodicity, user)}
+    return {'habits': [name for name, spec in get_habit_periodicities(db, periodicity, user)
+                       if period_length(spec) == length]}
+
+
+def streak(db, name: str = None, days: int = None, periodicity: int = None, user: str = DEFAULT_USER):
+    """
+    longest streak of a habit, or the habits with the longest streak
+
+    :param db: database where the data is stored
+    :param name: if supplied, only this habit is analysed
+    :param days: if provided, only the last days days are analysed
+    :param periodicity: if provided and no name is supplied, only habits with this periodicity are analysed
+    :param user: user the habits belong to
+    :return: dictionary with the habit names and their longest streak
+    """
+    _check_habits_exist(db, name, periodicity, user)
+    habits, longest_streak = return_number_of_habit_streaks(db, name, days, periodicity, user=user)
+    return {'habits': [habits] if name else habits, 'longest_streak': longest_streak}
+
+
+def resets(db, name: str = None, days: int = None, periodicity: int = None, user: str = DEFAULT_USER,
+           start_date: dt.date = None, end_date: dt.date = None):
+    """
+    reset count of a habit, or the habits that were reset most often
+
+    :param db: database where the data is stored
+    :param name: if supplied, only this habit is analysed
+    :param days: if provided, only the last days days are analysed
+    :param periodicity: if provided and no name is supplied, only habits with this periodicity are analysed
+    :param user: user the habits belong to
+    :param start_date: if provided, only data from this date on is analysed, replaces days
+    :param end_date: if provided, only data until this date is analysed
+    :return: dictionary with the habit names and their reset count
+    """
+    _check_habits_exist(db, name, periodicity, user)
+    habits, reset_count = return_number_of_habit_resets(db, name, days, periodicity, start_date=start_date,
+                                                        end_date=end_date, user=user)
+    return {'habits': [habits] if name else habits, 'resets': reset_count}
+
+
+def at_risk(db, periodicity: int = None, user: str = DEFAULT_USER):
+    """
+    habits with a live streak that breaks if they are not checked off in the current period
+
+    :param db: database where the data is stored
+    :param periodicity: if provided, only habits with this periodicity are returned
+    :param user: user the habits belong to
+    :return: dictionary with a list of the habits, their current streak and the last day of the current period
+    """
+    return {'habits': [{'habit': streak.name, 'current_streak': streak.current_streak, 'due_date': streak.due_date}
+                       for streak in habits_at_risk(db, periodicity, user)]}
+
+
+def export(db, path: str, file_format: str = None, user: str = None):
+    """
+    writes the history to a file, see habit_io.export_file
+
+    :return: dictionary with the file and the number of exported records
+    """
+    try:
+        return {'file': path, 'records': export_file(db, path, file_format, user)}
+    except (OSError, ValueError) as error:
+        raise CommandError(str(error)) from None
+
+
+def import_history(db, path: str, file_format: str = None):
+    """
+    reads the history from a file, see habit_io.import_file
+
+    :return: dictionary with the number of new habits, stored check-offs and skipped check-offs
+    """
+    try:
+        habits, stored, skipped = import_file(db, path, file_format)
+    except (OSError, ValueError, KeyError) as error:
+        raise CommandError(f'{path} can not be imported: {error}') from None
+    except sqlite3.IntegrityError:
+        raise CommandError(f'{path} contains check-offs of habits that are not part of it, nothing was imported') \
+            from None
+    return {'file': path, 'habits': habits, 'stored': stored, 'skipped': skipped}
@@ -1,112 +1,715 @@
+import logging
 import sqlite3
 import datetime as dt
+import threading
+from contextlib import contextmanager
+from itertools import chain, groupby, islice
+from operator import itemgetter
 from sqlite3 import Connection
+from typing import NamedTuple
+from urllib.request import pathname2url
+
+from clock import today
+from instrumentation import instrument, watch
+from periods import MONTH, WEEK, completed_indices, normalise_periodicity, parse_periodicity
+
+
+# day numbers are stored as date ordinals (see dt.date.toordinal), SQLite's julian day of ordinal 0 is 1721424.5
+JULIAN_DAY_OFFSET = 1721424.5
+SCHEMA_VERSION = 5
+# user of the habits that were stored before the database had users
+DEFAULT_USER = 'default'
+# grains of the rollups in habit_rollups, periods of the period engine, and the SQL expression of the first day of the
+# period that contains the day number day
+ROLLUP_GRAINS = {
+    WEEK: "{day} - ({day} - 1) % 7",
+    MONTH: f"CAST(julianday({{day}} + {JULIAN_DAY_OFFSET}, 'start of month') - {JULIAN_DAY_OFFSET} AS INTEGER)",
+}
+# weekday columns of habit_rollups, the day number 1 is a Monday
+WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+logger = logging.getLogger(__name__)
 
 
 def get_db(name="main.db"):
-    db = sqlite3.connect(name)
+    db = watch(sqlite3.connect(name))
+    db.execute("PRAGMA foreign_keys = ON")
     create_tables(db)
     return db
 
 
+def get_db_path(db: Connection):
+    """
+    returns the file of a database
+
+    :param db: database connection
+    :return: path of the database file, None for in-memory databases
+    """
+    path = db.execute("PRAGMA database_list").fetchone()[2]
+    return path or None
+
+
+def get_read_only_db(path: str):
+    """
+    opens a database file read-only, the schema has to be up to date already
+
+    :param path: path of the database file
+    :return: database connection
+    """
+    return watch(sqlite3.connect(f"file:{pathname2url(path)}?mode=ro", uri=True))
+
+
+class ConnectionManager:
+    """
+    hands out connections to one database for programs with several threads: every thread reads with its own
+    connection, all writes go through one dedicated writer connection. The database is switched to WAL mode, so
+    readers never wait for the writer and the writer does not wait for readers.
+
+    with ConnectionManager("main.db") as connections:
+        with connections.read() as db:
+            return_number_of_habit_streaks(db)
+        with connections.write() as db:
+            increment_habit(db, "Study", dt.date.today())
+    """
+
+    def __init__(self, name="main.db", mmap_size: int = 256 * 1024 * 1024, cache_size: int = 64 * 1024 * 1024,
+                 busy_timeout: float = 5.0):
+        """
+        :param name: database file
+        :param mmap_size: bytes of the database file that are read through memory-mapped I/O
+        :param cache_size: bytes of the page cache of each connection
+        :param busy_timeout: seconds a connection waits for a lock before it raises an OperationalError
+        """
+        self.name = name
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._readers = []
+        self._lock = threading.Lock()
+        self._writer_lock = threading.Lock()
+        self._writer = self._connect()
+        self._writer.execute("PRAGMA journal_mode = WAL")
+        create_tables(self._writer)
+
+    def _connect(self):
+        # connections are used by one thread at a time, but closed by the thread that calls close
+        db = watch(sqlite3.connect(self.name, timeout=self.busy_timeout, check_same_thread=False))
+        db.execute("PRAGMA foreign_keys = ON")
+        db.execute("PRAGMA synchronous = NORMAL")
+        db.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        db.execute(f"PRAGMA cache_size = {-int(self.cache_size) // 1024}")
+        return db
+
+    @contextmanager
+    def read(self):
+        """
+        yields the connection of the current thread, it is created on first use
+        """
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = self._connect()
+            with self._lock:
+                self._readers.append(db)
+        yield db
+
+    @contextmanager
+    def write(self):
+        """
+        yields the writer connection, only one thread can use it at a time. Changes that have not been committed yet
+        are committed when the block ends, or rolled back if it raises an exception, so the next writer never finds an
+        open transaction
+        """
+        with self._writer_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                self._writer.rollback()
+                raise
+            if self._writer.in_transaction:
+                self._writer.commit()
+
+    def close(self):
+        """
+        closes the writer and all reader connections
+        """
+        with self._lock:
+            for db in self._readers:
+                db.close()
+            self._readers.clear()
+        self._local = threading.local()
+        with self._writer_lock:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def to_day_number(value):
+    """
+    converts a date into the day number that is stored in the database
+
+    :param value: dt.date, dt.datetime, a string in the form YYYY-MM-DD or a day number, which is returned unchanged
+    :return: date ordinal
+    """
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        value = dt.date.fromisoformat(value)
+    elif isinstance(value, dt.datetime):
+        value = value.date()
+    return value.toordinal()
+
+
+def to_date_string(day_number: int):
+    """
+    converts a stored day number back into a string in the form YYYY-MM-DD
+
+    :param day_number: date ordinal
+    :return: date string
+    """
+    return dt.date.fromordinal(day_number).strftime('%Y-%m-%d')
+
+
 def create_tables(db: Connection):
     """
-    creates a table to store the habits and a table to store the check-off dates if they do not already exist
+    creates a table to store the habits and a table to store the check-off dates if they do not already exist, and
+    upgrades databases created with an older schema version in place. The schema version is stored in
+    PRAGMA user_version.
 
     :param db: database where habit tracker data is stored
     :return: None
     """
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+
     cur = db.cursor()
+    cur.execute("BEGIN")
+    try:
+        for migration in MIGRATIONS[version:]:
+            migration(cur)
+        # migrated habits get their summaries here, so reading never has to write
+        _rebuild_stale(cur)
+        cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    except Exception:
+        db.rollback()
+        raise
+    db.commit()
+
 
+def _migrate_to_v1(cur):
+    """
+    schema version 1: check-off dates are stored as day numbers, each date can only be stored once per habit and the
+    primary key (habit, date) serves as index for range and MIN lookups, check-offs are deleted with their habit.
+    Legacy check-offs that match no habit, not even when the case is ignored, or whose date is invalid are moved to
+    the table habits_tracker_orphans.
+    """
     cur.execute("""CREATE TABLE IF NOT EXISTS habits (
         name TEXT PRIMARY KEY,
         periodicity INT,
         creation_date DATE)""")
 
-    cur.execute("""CREATE TABLE IF NOT EXISTS habits_tracker (
-        habitsName TEXT,
-        check_off_date DATE,
-        FOREIGN KEY (habitsName) REFERENCES habits(name))""")
+    legacy = cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='habits_tracker'").fetchone()
+    if legacy:
+        cur.execute("ALTER TABLE habits_tracker RENAME TO habits_tracker_v0")
 
-    db.commit()
+    cur.execute("""CREATE TABLE habits_tracker (
+        habitsName TEXT NOT NULL,
+        check_off_date INTEGER NOT NULL,
+        PRIMARY KEY (habitsName, check_off_date),
+        FOREIGN KEY (habitsName) REFERENCES habits(name) ON DELETE CASCADE) WITHOUT ROWID""")
 
+    if legacy:
+        # names of the log that differ from the habit name only in case belong to that habit, if it is the only one
+        habit = """COALESCE((SELECT name FROM habits WHERE name = v.habitsName),
+            (SELECT MIN(name) FROM habits WHERE name = v.habitsName COLLATE NOCASE HAVING COUNT(*) = 1))"""
+        day = f"CAST(julianday(v.check_off_date) - {JULIAN_DAY_OFFSET} AS INTEGER)"
+        # duplicates are dropped
+        cur.execute(f"""INSERT OR IGNORE INTO habits_tracker
+            SELECT {habit}, {day} FROM habits_tracker_v0 v WHERE {habit} IS NOT NULL AND {day} IS NOT NULL""")
+        # check-offs of unknown habits or with invalid dates are kept as they were
+        cur.execute(f"""CREATE TABLE habits_tracker_orphans AS SELECT v.habitsName, v.check_off_date
+            FROM habits_tracker_v0 v WHERE {habit} IS NULL OR {day} IS NULL""")
+        orphans = cur.execute("SELECT COUNT(*) FROM habits_tracker_orphans").fetchone()[0]
+        if orphans:
+            logger.warning("%d check-offs without a matching habit or with an invalid date were moved to "
+                           "habits_tracker_orphans", orphans)
+        else:
+            cur.execute("DROP TABLE habits_tracker_orphans")
+        cur.execute("DROP TABLE habits_tracker_v0")
 
-def add_habit(db: Connection, name: str, periodicity: int, creation_date: dt.date = None):
+
+def _migrate_to_v2(cur):
+    """
+    schema version 2: table with a streak summary per habit, rows are created by rebuild_streak_summary when they are
+    first needed
+    """
+    cur.execute("""CREATE TABLE habit_streaks (
+        habitsName TEXT PRIMARY KEY,
+        first_period_start INTEGER,
+        last_period INTEGER,
+        current_streak INTEGER NOT NULL,
+        longest_streak INTEGER NOT NULL,
+        resets INTEGER NOT NULL,
+        stale INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (habitsName) REFERENCES habits(name) ON DELETE CASCADE)""")
+
+
+def _migrate_to_v3(cur):
+    """
+    schema version 3: every habit belongs to a user and the user is the first column of every key and index, so the
+    habits of many users are stored in one database and a query only reads the rows of one user. Existing habits
+    belong to DEFAULT_USER. Every habit gets a row in habit_streaks when it is added, the index on the longest streaks
+    serves leaderboards over all users.
+    """
+    tables = ('habit_streaks', 'habits_tracker', 'habits')
+    for table in tables:
+        cur.execute(f"ALTER TABLE {table} RENAME TO {table}_v2")
+
+    cur.execute("""CREATE TABLE habits (
+        user TEXT NOT NULL,
+        name TEXT NOT NULL,
+        periodicity INT,
+        creation_date DATE,
+        PRIMARY KEY (user, name))""")
+    cur.execute("CREATE INDEX habits_periodicity ON habits (user, periodicity, name)")
+    cur.execute("""CREATE TABLE habits_tracker (
+        user TEXT NOT NULL,
+        habitsName TEXT NOT NULL,
+        check_off_date INTEGER NOT NULL,
+        PRIMARY KEY (user, habitsName, check_off_date),
+        FOREIGN KEY (user, habitsName) REFERENCES habits(user, name) ON DELETE CASCADE) WITHOUT ROWID""")
+    cur.execute("""CREATE TABLE habit_streaks (
+        user TEXT NOT NULL,
+        habitsName TEXT NOT NULL,
+        first_period_start INTEGER,
+        last_period INTEGER,
+        current_streak INTEGER NOT NULL,
+        longest_streak INTEGER NOT NULL,
+        resets INTEGER NOT NULL,
+        stale INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user, habitsName),
+        FOREIGN KEY (user, habitsName) REFERENCES habits(user, name) ON DELETE CASCADE)""")
+    cur.execute("CREATE INDEX habit_streaks_longest ON habit_streaks (longest_streak DESC, user, habitsName)")
+    cur.execute("CREATE INDEX habit_streaks_stale ON habit_streaks (user, habitsName) WHERE stale")
+
+    cur.execute("""INSERT INTO habits SELECT ?, name, periodicity, creation_date FROM habits_v2
+        WHERE name IS NOT NULL""", (DEFAULT_USER,))
+    cur.execute("INSERT INTO habits_tracker SELECT ?, habitsName, check_off_date FROM habits_tracker_v2",
+                (DEFAULT_USER,))
+    cur.execute("INSERT INTO habit_streaks SELECT ?, * FROM habit_streaks_v2", (DEFAULT_USER,))
+    # every habit has a summary row from now on, the missing ones are rebuilt the next time they are read
+    cur.execute("""INSERT INTO habit_streaks (user, habitsName, current_streak, longest_streak, resets, stale)
+        SELECT user, name, 0, 0, 0, 1 FROM habits
+        WHERE NOT EXISTS (SELECT 1 FROM habit_streaks s WHERE s.user = habits.user AND s.habitsName = habits.name)""")
+    for table in tables:
+        cur.execute(f"DROP TABLE {table}_v2")
+
+
+def _migrate_to_v4(cur):
+    """
+    schema version 4: data versions for caches. Every write increments the version of the user in user_versions and
+    stores it in the version column of the habits it changed, so a cache can check with one lookup whether a result
+    is still valid, also if the data was changed by another process. The version of a user never decreases, so a
+    habit that is deleted and added again gets a new version.
+    """
+    cur.execute("ALTER TABLE habits ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    cur.execute("""CREATE TABLE user_versions (
+        user TEXT PRIMARY KEY,
+        version INTEGER NOT NULL)""")
+
+
+def _migrate_to_v5(cur):
+    """
+    schema version 5: rollups with the number of check-offs per habit and calendar week or month, in total and per
+    weekday, see get_rollups. The rollups of a habit are updated with every check-off. Habits whose rollups are
+    marked with rollups_stale, the existing ones and the habits changed by bulk imports, get their rollups rebuilt
+    at the end of the migration or the import, see _rebuild_stale.
+    """
+    cur.execute("ALTER TABLE habits ADD COLUMN rollups_stale INTEGER NOT NULL DEFAULT 1")
+    cur.execute(f"""CREATE TABLE habit_rollups (
+        user TEXT NOT NULL,
+        habitsName TEXT NOT NULL,
+        grain TEXT NOT NULL,
+        period_start INTEGER NOT NULL,
+        check_offs INTEGER NOT NULL,
+        {', '.join(f'{weekday} INTEGER NOT NULL DEFAULT 0' for weekday in WEEKDAYS)},
+        PRIMARY KEY (user, habitsName, grain, period_start),
+        FOREIGN KEY (user, habitsName) REFERENCES habits(user, name) ON DELETE CASCADE) WITHOUT ROWID""")
+
+
+MIGRATIONS = [_migrate_to_v1, _migrate_to_v2, _migrate_to_v3, _migrate_to_v4, _migrate_to_v5]
+
+
+@instrument
+def add_habit(db: Connection, name: str, periodicity: int, creation_date: dt.date = None, user: str = DEFAULT_USER):
     """
     stores a new habit in a database
 
     :param db: database to store the habit
     :param name: habit name
-    :param periodicity:habit periodicity
+    :param periodicity: habit periodicity, number of days or a rule of the period engine like 'week', 'month' or
+    '3/7', see periods
     :param creation_date: habit creation date, if not provided today's date will be stored
+    :param user: user the habit belongs to
     :return: None
     """
+    periodicity = normalise_periodicity(periodicity)
     cur = db.cursor()
     if not creation_date:
-        creation_date = dt.date.today()
+        creation_date = today()
 
-    cur.execute("INSERT INTO habits VALUES (?, ?, ?)", (name, periodicity, creation_date))
+    cur.execute("INSERT INTO habits (user, name, periodicity, creation_date, rollups_stale) VALUES (?, ?, ?, ?, 0)",
+                (user, name, periodicity, creation_date))
+    _store_streak_summary(cur, name, _EMPTY_SUMMARY, user)
+    _bump_versions(cur, [(user, name)])
     db.commit()
 
 
-def increment_habit(db: Connection, name: str, event_date: dt.date):
+@instrument
+def increment_habit(db: Connection, name: str, event_date: dt.date, user: str = DEFAULT_USER):
     """
     stores a new check-off date for a defined habit
 
     :param db: database where habits are stored
     :param name: habit name for which the date will be stored
-    :param event_date: date when the habit was completed
-    :return: None
+    :param event_date: date when the habit was completed, a date that is already stored for this habit is ignored
+    :param user: user the habit belongs to
+    :return: True if the check-off was stored, False if it was already stored
+    """
+    cur = db.cursor()
+    stored = _store_check_off(cur, name, event_date, user)
+    if stored:
+        _bump_versions(cur, [(user, name)])
+    db.commit()
+    return stored
+
+
+@instrument
+def increment_habits(db: Connection, events, user: str = DEFAULT_USER):
+    """
+    stores a few check-off dates in one transaction, the streak summaries are kept up to date like with
+    increment_habit. For large imports use increment_habits_bulk. If one of the check-offs can not be stored, none
+    of them is stored and the exception is raised.
+
+    :param db: database where habits are stored
+    :param events: iterable with (habit name, check-off date) pairs
+    :param user: user the habits belong to
+    :return: number of check-offs that were stored, dates that were already stored are skipped
+    """
+    cur = db.cursor()
+    try:
+        stored = [name for name, event_date in events if _store_check_off(cur, name, event_date, user)]
+        _bump_versions(cur, ((user, name) for name in stored))
+    except Exception:
+        db.rollback()
+        raise
+    db.commit()
+    return len(stored)
+
+
+@instrument
+def increment_habits_batch(db: Connection, rows):
+    """
+    stores check-offs of several users in one transaction, like increment_habits. If one of the check-offs can not be
+    stored, none of them is stored and the exception is raised.
+
+    :param db: database where habits are stored
+    :param rows: iterable with (user, habit name, check-off date) tuples, dates like in increment_habit
+    :return: number of check-offs that were stored, dates that were already stored are skipped
+    """
+    cur = db.cursor()
+    try:
+        stored = [(user, name) for user, name, event_date in rows if _store_check_off(cur, name, event_date, user)]
+        _bump_versions(cur, stored)
+    except Exception:
+        db.rollback()
+        raise
+    db.commit()
+    return len(stored)
+
+
+def _store_check_off(cur, name: str, event_date, user: str = DEFAULT_USER):
+    """
+    inserts a check-off and updates the streak summary and the rollups of the habit without committing
+
+    :return: True if the check-off was stored, False if it was already stored
+    """
+    day = to_day_number(event_date)
+    cur.execute("INSERT OR IGNORE INTO habits_tracker VALUES (?, ?, ?)", (user, name, day))
+    if not cur.rowcount:
+        return False
+    _update_streak_summary(cur, name, day, user)
+    _update_rollups(cur, name, day, user)
+    return True
+
+
+@instrument
+def increment_habits_bulk(db: Connection, events, chunk_size: int = 10000, user: str = DEFAULT_USER):
+    """
+    stores many check-off dates in a single transaction. The events are consumed lazily in chunks of chunk_size, so
+    generators of any length can be imported without holding them in memory. If an event refers to a habit that does
+    not exist, nothing is stored and the IntegrityError is raised.
+
+    :param db: database where habits are stored
+    :param events: iterable with (habit name, check-off date) pairs, dates like in increment_habit
+    :param chunk_size: number of events that are handed to SQLite at once
+    :param user: user the habits belong to
+    :return: tuple with the number of stored check-offs and the number of check-offs skipped as duplicates
+    """
+    cur = db.cursor()
+    rows = ((user, name, to_day_number(event_date)) for name, event_date in events)
+    inserted = skipped = 0
+    changed = set()
+    try:
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            chunk_inserted = _insert_check_offs(cur, chunk, changed)
+            inserted += chunk_inserted
+            skipped += len(chunk) - chunk_inserted
+        _rebuild_stale(cur, changed)
+    except Exception:
+        db.rollback()
+        raise
+    db.commit()
+    return inserted, skipped
+
+
+def _insert_check_offs(cur, rows: list, changed: set):
+    """
+    inserts (user, habit name, day number) rows without committing, the streak summaries and the rollups of their
+    habits are marked as stale until _rebuild_stale is called at the end of the transaction
+
+    :param changed: set the (user, habit name) pairs of the changed habits are added to
+    :return: number of rows that were stored, the others were already stored
+    """
+    cur.executemany("INSERT OR IGNORE INTO habits_tracker VALUES (?, ?, ?)", rows)
+    inserted = cur.rowcount
+    if inserted:
+        habits = {row[:2] for row in rows}
+        changed.update(habits)
+        cur.executemany("UPDATE habit_streaks SET stale = 1 WHERE user = ? AND habitsName = ?", habits)
+        cur.executemany("UPDATE habits SET rollups_stale = 1 WHERE user = ? AND name = ?", habits)
+        _bump_versions(cur, habits)
+    return inserted
+
+
+def _bump_versions(cur, habits):
+    """
+    increments the data version of the users of some habits and stores it as version of these habits without
+    committing, see _migrate_to_v4
+
+    :param habits: iterable with (user, habit name) pairs of the habits that were changed
+    """
+    for user, user_habits in groupby(sorted(set(habits)), key=itemgetter(0)):
+        cur.execute("INSERT INTO user_versions VALUES (?, 1) ON CONFLICT (user) DO UPDATE SET version = version + 1",
+                    (user,))
+        version = cur.execute("SELECT version FROM user_versions WHERE user = ?", (user,)).fetchone()[0]
+        cur.executemany("UPDATE habits SET version = ? WHERE user = ? AND name = ?",
+                        [(version, user, name) for _, name in user_habits])
+
+
+class ExportedHabit(NamedTuple):
+    """
+    habit as returned by export_history
+    """
+    user: str
+    name: str
+    periodicity: int
+    creation_date: str
+
+
+class ExportedCheckOff(NamedTuple):
+    """
+    check-off as returned by export_history, day is a day number
+    """
+    user: str
+    name: str
+    day: int
+
+
+def export_history(db: Connection, user: str = None):
+    """
+    yields all habits and then all check-offs, ordered by user, habit name and date. The rows are read one by one
+    while the cursor is iterated, so histories of any size can be exported without holding them in memory. The
+    check-offs are read in the order of the primary key and do not have to be sorted.
+
+    :param db: database where habits are stored
+    :param user: if supplied, only the habits of this user are exported, otherwise the habits of all users
+    :return: generator of ExportedHabit and ExportedCheckOff tuples, each habit comes before its check-offs
+    """
+    where, params = ("WHERE user = ?", (user,)) if user is not None else ("", ())
+    cur = db.cursor()
+    cur.execute(f"SELECT user, name, periodicity, creation_date FROM habits {where} ORDER BY user, name", params)
+    for row in cur:
+        yield ExportedHabit(*row)
+    cur.execute(f"""SELECT user, habitsName, check_off_date FROM habits_tracker {where}
+        ORDER BY user, habitsName, check_off_date""", params)
+    for row in cur:
+        yield ExportedCheckOff(*row)
+
+
+@instrument
+def import_history(db: Connection, records, chunk_size: int = 10000):
+    """
+    stores exported habits and check-offs in a single transaction, the records are consumed lazily and the
+    check-offs are handed to SQLite in chunks of chunk_size. Habits that already exist are kept and check-offs that
+    are already stored are skipped, so an export can be imported twice. If a check-off refers to a habit that does
+    not exist, nothing is stored and the IntegrityError is raised.
+
+    :param db: database where habits are stored
+    :param records: iterable with ExportedHabit and ExportedCheckOff tuples as returned by export_history, the day of
+    a check-off may also be a date like in increment_habit
+    :param chunk_size: number of check-offs that are handed to SQLite at once
+    :return: tuple with the number of new habits, stored check-offs and check-offs skipped as duplicates
     """
     cur = db.cursor()
-    cur.execute("INSERT INTO habits_tracker VALUES (?, ?)", (name, event_date))
+    habits = inserted = skipped = 0
+    chunk = []
+    changed = set()
+    try:
+        for record in records:
+            if not isinstance(record, ExportedCheckOff):
+                cur.execute("""INSERT OR IGNORE INTO habits (user, name, periodicity, creation_date, rollups_stale)
+                    VALUES (?, ?, ?, ?, 0)""", record)
+                if cur.rowcount:
+                    habits += 1
+                    _store_streak_summary(cur, record.name, _EMPTY_SUMMARY, record.user)
+                    _bump_versions(cur, [record[:2]])
+                continue
+            chunk.append((record.user, record.name, to_day_number(record.day)))
+            if len(chunk) == chunk_size:
+                chunk_inserted = _insert_check_offs(cur, chunk, changed)
+                inserted += chunk_inserted
+                skipped += len(chunk) - chunk_inserted
+                chunk = []
+        if chunk:
+            chunk_inserted = _insert_check_offs(cur, chunk, changed)
+            inserted += chunk_inserted
+            skipped += len(chunk) - chunk_inserted
+        _rebuild_stale(cur, changed)
+    except Exception:
+        db.rollback()
+        raise
     db.commit()
+    return habits, inserted, skipped
 
 
-def delete_habit(db: Connection, name: str):
+@instrument
+def delete_habit(db: Connection, name: str, user: str = DEFAULT_USER):
     """
-    deletes a habit
+    deletes a habit, its check-off dates, streak summary and rollups are deleted with it
 
     :param db: database where habits are stored
     :param name: habit to be deleted
-    :return: None
+    :param user: user the habit belongs to
+    :return: True if the habit was deleted, False if it did not exist
     """
     cur = db.cursor()
-    cur.execute("DELETE FROM habits WHERE name =?", (name,))
-    cur.execute("DELETE FROM habits_tracker WHERE habitsName = ?", (name,))
+    cur.execute("DELETE FROM habits WHERE user = ? AND name =?", (user, name))
+    deleted = cur.rowcount > 0
+    if deleted:
+        _bump_versions(cur, [(user, name)])
     db.commit()
+    return deleted
+
 
+@instrument
+def get_data_version(db: Connection, name: str = None, user: str = DEFAULT_USER):
+    """
+    returns the data version of a habit or of all habits of a user, the version changes whenever a habit is added,
+    checked off or deleted. The habit version only changes with the data of the habit, the user version changes with
+    the data of every habit of the user.
 
-def get_habit_names(db: Connection, periodicity: int = None):
+    :param db: database where habits are stored
+    :param name: if supplied, the version of this habit is returned, otherwise the version of the user
+    :param user: user the habits belong to
+    :return: version, None if the habit does not exist
+    """
+    cur = db.cursor()
+    if name:
+        cur.execute("SELECT version FROM habits WHERE user = ? AND name = ?", (user, name))
+        row = cur.fetchone()
+        return None if row is None else row[0]
+    cur.execute("SELECT version FROM user_versions WHERE user = ?", (user,))
+    row = cur.fetchone()
+    return 0 if row is None else row[0]
+
+
+@instrument
+def get_users(db: Connection):
+    """
+    returns all users that have at least one habit
+
+    :param db: database where habits are stored
+    :return: list with user names
+    """
+    cur = db.cursor()
+    cur.execute("SELECT DISTINCT user FROM habits ORDER BY user")
+    return [x[0] for x in cur.fetchall()]
+
+
+@instrument
+def get_habit_names(db: Connection, periodicity: int = None, user: str = DEFAULT_USER):
     """
     returns a list with defined habits, if periodicity is supplied, only habits with this periodicity will be returned
 
     :param db: database where habits are stored
     :param periodicity: if provided, only habits with this periodicity will be returned
+    :param user: user the habits belong to
     :return: list with habit names
     """
     cur = db.cursor()
     if not periodicity:
-        cur.execute("SELECT name FROM habits")
+        cur.execute("SELECT name FROM habits WHERE user=? ORDER BY name", (user,))
     else:
-        cur.execute("SELECT name FROM habits WHERE periodicity=?", (periodicity,))
+        cur.execute("SELECT name FROM habits WHERE user=? AND periodicity=? ORDER BY name", (user, periodicity))
     return [x[0] for x in cur.fetchall()]
 
 
-def get_periodicity(db: Connection, name: str):
+@instrument
+def get_habit_periodicities(db: Connection, periodicity: int = None, user: str = DEFAULT_USER):
+    """
+    returns the defined habits with their periodicities in one query, see get_habit_names
+
+    :param db: database where habits are stored
+    :param periodicity: if provided, only habits with this periodicity will be returned
+    :param user: user the habits belong to
+    :return: list with (habit name, periodicity) tuples, ordered by name
+    """
+    cur = db.cursor()
+    if not periodicity:
+        cur.execute("SELECT name, periodicity FROM habits WHERE user=? ORDER BY name", (user,))
+    else:
+        cur.execute("SELECT name, periodicity FROM habits WHERE user=? AND periodicity=? ORDER BY name",
+                    (user, periodicity))
+    return cur.fetchall()
+
+
+@instrument
+def get_periodicity(db: Connection, name: str, user: str = DEFAULT_USER):
     """
     return the periodicity for a certain habit
 
     :param db: database where habits are stored
     :param name: habit name for the wanted periodicity
+    :param user: user the habit belongs to
     :return: periodicity
     """
     cur = db.cursor()
-    cur.execute("SELECT periodicity FROM habits WHERE name=?", (name,))
+    cur.execute("SELECT periodicity FROM habits WHERE user=? AND name=?", (user, name))
     return cur.fetchone()[0]
 
 
-def get_habit_tracker(db: Connection, start_date: dt.date, name: str = None):
+@instrument
+def get_habit_tracker(db: Connection, start_date: dt.date, name: str = None, user: str = DEFAULT_USER,
+                      as_of: dt.date = None):
     """
     Returns a tuple with habits and check off dates for a defined period of time. If a name is supplied, only data for
     this habit will be returned
@@ -114,28 +717,749 @@ def get_habit_tracker(db: Connection, start_date: dt.date, name: str = None):
     :param db: database where habits are stored
     :param start_date: earliest date for which data will be returned
     :param name: if supplied, only data for this habit will be returned
-    :return: tuple with habits and check off dates
+    :param user: user the habits belong to
+    :param as_of: latest date for which data will be returned, if not provided today's date is used, see clock
+    :return: tuple with habits and check off dates in the form YYYY-MM-DD
     """
-    date_today = dt.date.today()
+    date_today = as_of or today()
     cur = db.cursor()
     if not name:
-        cur.execute("SELECT * FROM habits_tracker WHERE check_off_date BETWEEN ? AND ?",
-                    (start_date, date_today,))
+        cur.execute(f"""SELECT habitsName, date(check_off_date + {JULIAN_DAY_OFFSET}) FROM habits_tracker
+            WHERE user=? AND check_off_date BETWEEN ? AND ?""",
+                    (user, to_day_number(start_date), to_day_number(date_today),))
     else:
-        cur.execute("SELECT * FROM habits_tracker WHERE habitsName=? AND check_off_date BETWEEN ? AND ?",
-                    (name, start_date, date_today,))
+        cur.execute(f"""SELECT habitsName, date(check_off_date + {JULIAN_DAY_OFFSET}) FROM habits_tracker
+            WHERE user=? AND habitsName=? AND check_off_date BETWEEN ? AND ?""",
+                    (user, name, to_day_number(start_date), to_day_number(date_today),))
     return cur.fetchall()
 
 
-def get_first_check_off_date(db: Connection, name: str):
+@instrument
+def get_first_check_off_date(db: Connection, name: str, user: str = DEFAULT_USER):
     """
     Returns the first check-off date for a specified habit
 
     :param db:database where habits are stored
     :param name: name for the table for which the first check off date should be returned
-    :return: first check off date
+    :param user: user the habit belongs to
+    :return: first check off date in the form YYYY-MM-DD, None if the habit has never been checked off
     """
 
     cur = db.cursor()
-    cur.execute('SELECT MIN(check_off_date) FROM habits_tracker WHERE habitsName=?', (name,))
-    return cur.fetchone()[0]
+    cur.execute('SELECT MIN(check_off_date) FROM habits_tracker WHERE user=? AND habitsName=?', (user, name))
+    first_date = cur.fetchone()[0]
+    return None if first_date is None else to_date_string(first_date)
+
+
+@instrument
+def get_check_off_bounds(db: Connection, periodicity: int = None, name: str = None, user: str = DEFAULT_USER,
+                         as_of: dt.date = None):
+    """
+    returns the first and the most recent check-off of every habit, each of them is one lookup in the primary key
+    index, so the cost does not depend on the number of check-offs
+
+    :param db: database where habits are stored
+    :param periodicity: if provided, only habits with this periodicity will be returned
+    :param name: if supplied, only this habit will be returned
+    :param user: user the habits belong to
+    :param as_of: if provided, check-offs after this date are left out
+    :return: dictionary, key = habit name, value = tuple with periodicity, first and last check-off as day numbers,
+    the days are None if the habit has never been checked off, ordered like get_habit_names
+    """
+    conditions, params = ["h.user = ?"], [user]
+    if periodicity:
+        conditions.append("h.periodicity = ?")
+        params.append(periodicity)
+    if name:
+        conditions.append("h.name = ?")
+        params.append(name)
+
+    until, until_params = ("AND t.check_off_date <= ?", [to_day_number(as_of)]) if as_of else ("", [])
+
+    cur = db.cursor()
+    cur.execute(f"""SELECT h.name, h.periodicity,
+        (SELECT MIN(t.check_off_date) FROM habits_tracker t WHERE t.user = h.user AND t.habitsName = h.name {until}),
+        (SELECT MAX(t.check_off_date) FROM habits_tracker t WHERE t.user = h.user AND t.habitsName = h.name {until})
+        FROM habits h WHERE {' AND '.join(conditions)} ORDER BY h.name""", until_params * 2 + params)
+    return {habit: (normalise_periodicity(habit_periodicity), first, last) for habit, habit_periodicity, first, last
+            in cur}
+
+
+@instrument
+def get_run_length(db: Connection, name: str, first_period_start: int, periodicity: int, period: int,
+                   user: str = DEFAULT_USER):
+    """
+    counts the consecutive completed periods that end with period, the check-offs are read backwards from the end of
+    that period and only until the first missed period
+
+    :param db: database where habits are stored
+    :param name: habit name
+    :param first_period_start: day number of the first day of period 0
+    :param periodicity: habit periodicity
+    :param period: index of the last period of the run, it has to be completed
+    :param user: user the habit belongs to
+    :return: number of completed periods
+    """
+    return _run_length(db.cursor(), name, first_period_start, periodicity, period + 1, -1, user)
+
+
+@instrument
+def get_rule_run_length(db: Connection, name: str, rule, start: int, end: int, period: int,
+                        user: str = DEFAULT_USER):
+    """
+    counts the consecutive completed periods of a habit with calendar or quota periods that end with period, like
+    get_run_length the check-offs are read backwards from the end of that period and only until the first period that
+    was not completed
+
+    :param db: database where habits are stored
+    :param name: habit name
+    :param rule: periods.PeriodRule of the habit, anchored like the analysed periods
+    :param start: day number of the first check-off that is counted
+    :param end: day number of the last check-off that is counted
+    :param period: index of the last period of the run
+    :param user: user the habit belongs to
+    :return: number of completed periods, 0 if period was not completed
+    """
+    cur = db.cursor()
+    cur.execute("""SELECT check_off_date FROM habits_tracker
+        WHERE user = ? AND habitsName = ? AND check_off_date BETWEEN ? AND ?
+        ORDER BY check_off_date DESC""", (user, name, start, min(end, rule.start(period + 1) - 1)))
+    run_length, count = 0, 0
+    for day, in cur:
+        index = rule.index(day)
+        if index > period - run_length:
+            # further check-offs of a period that is already completed
+            continue
+        if index < period - run_length:
+            break
+        count += 1
+        if count == rule.required:
+            run_length, count = run_length + 1, 0
+    return run_length
+
+
+class HabitRecord(NamedTuple):
+    """
+    everything that is stored about one habit, as returned by get_habits_snapshot, check-off dates are day numbers
+    """
+    periodicity: int
+    creation_date: str
+    first_check_off_date: int
+    check_off_dates: list
+
+
+@instrument
+def get_habits_snapshot(db: Connection, start_date: dt.date, periodicity: int = None, name: str = None,
+                        end_date: dt.date = None, names: list = None, user: str = DEFAULT_USER):
+    """
+    Loads periodicity, creation date, first check-off date and the check-off dates from start_date until end_date for
+    all habits with two queries, instead of querying every habit separately
+
+    :param db: database where habits are stored
+    :param start_date: earliest check-off date that will be returned
+    :param periodicity: if provided, only habits with this periodicity will be returned
+    :param name: if supplied, only data for this habit will be returned
+    :param end_date: latest check-off date that will be returned, if not provided today's date is used
+    :param names: if supplied, only data for these habits will be returned
+    :param user: user the habits belong to
+    :return: dictionary, key = habit name, value = HabitRecord, ordered like get_habit_names
+    """
+    conditions, params = ["h.user = ?"], [user]
+    if periodicity:
+        conditions.append("h.periodicity = ?")
+        params.append(periodicity)
+    if name:
+        conditions.append("h.name = ?")
+        params.append(name)
+    if names is not None:
+        conditions.append(f"h.name IN ({', '.join('?' * len(names))})")
+        params.extend(names)
+    where = f"WHERE {' AND '.join(conditions)}"
+
+    cur = db.cursor()
+    cur.execute(f"""SELECT h.name, h.periodicity, h.creation_date,
+        (SELECT MIN(t.check_off_date) FROM habits_tracker t WHERE t.user = h.user AND t.habitsName = h.name)
+        FROM habits h {where} ORDER BY h.name""", params)
+    habits = cur.fetchall()
+
+    cur.execute(f"""SELECT t.habitsName, t.check_off_date
+        FROM habits_tracker t JOIN habits h ON h.user = t.user AND h.name = t.habitsName
+        {where} AND t.check_off_date BETWEEN ? AND ?
+        ORDER BY t.habitsName, t.check_off_date""",
+                params + [to_day_number(start_date), to_day_number(end_date or today())])
+    check_offs = {habit: [row[1] for row in rows] for habit, rows in groupby(cur, key=itemgetter(0))}
+
+    return {habit: HabitRecord(habit_periodicity, creation_date, first_date, check_offs.get(habit, []))
+            for habit, habit_periodicity, creation_date, first_date in habits}
+
+
+def iter_check_offs(db: Connection, start_date: dt.date, end_date: dt.date = None, periodicity: int = None,
+                    name: str = None, user: str = DEFAULT_USER, batch_size: int = 10000):
+    """
+    yields the check-offs from start_date until end_date ordered by habit and date, like get_habits_snapshot, but the
+    rows are read from the primary key index with fetchmany, so only one batch is held in memory at a time
+
+    :param db: database where habits are stored
+    :param start_date: earliest check-off date that will be returned
+    :param end_date: latest check-off date that will be returned, if not provided today's date is used
+    :param periodicity: if provided, only check-offs of habits with this periodicity will be returned
+    :param name: if supplied, only check-offs of this habit will be returned
+    :param user: user the habits belong to
+    :param batch_size: number of rows that are fetched at once
+    :return: generator of (habit name, day number) tuples
+    """
+    conditions, params = ["t.user = ?", "t.check_off_date BETWEEN ? AND ?"], [user]
+    params += [to_day_number(start_date), to_day_number(end_date or today())]
+    join = ""
+    if periodicity:
+        join = "JOIN habits h ON h.user = t.user AND h.name = t.habitsName"
+        conditions.append("h.periodicity = ?")
+        params.append(periodicity)
+    if name:
+        conditions.append("t.habitsName = ?")
+        params.append(name)
+
+    cur = db.cursor()
+    cur.execute(f"""SELECT t.habitsName, t.check_off_date FROM habits_tracker t {join}
+        WHERE {' AND '.join(conditions)} ORDER BY t.habitsName, t.check_off_date""", params)
+    try:
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        cur.close()
+
+
+class StreakRecord(NamedTuple):
+    """
+    row of the streak summary table, periods are counted from first_period_start (the first check-off, or the start of
+    its period for calendar periods) on and resets only counts the missed periods up to the last completed period.
+    last_check_off is the day number of the most recent check-off, None if the habit has never been checked off.
+    """
+    periodicity: int
+    first_period_start: int
+    last_period: int
+    current_streak: int
+    longest_streak: int
+    resets: int
+    last_check_off: int
+
+
+class LeaderboardEntry(NamedTuple):
+    """
+    habit in the streak leaderboard of all users, as returned by get_streak_leaderboard
+    """
+    user: str
+    name: str
+    periodicity: int
+    longest_streak: int
+
+
+# summary of a habit that has never been checked off
+_EMPTY_SUMMARY = (None, None, 0, 0, 0)
+
+
+def _streak_step(summary: tuple, day: int, periodicity: int):
+    """
+    advances a streak summary (first_period_start, last_period, current_streak, longest_streak, resets) by one
+    check-off in O(1)
+
+    :return: the new summary, None if the check-off lies before the last checked-off period
+    """
+    first_period_start, last_period, current_streak, longest_streak, resets = summary
+    if first_period_start is None:
+        return day, 0, 1, 1, 0
+    if day < first_period_start:
+        return None
+
+    period = (day - first_period_start) // periodicity
+    if period == last_period:
+        return summary
+    if period < last_period:
+        return None
+    if period == last_period + 1:
+        current_streak += 1
+    else:
+        resets += period - last_period - 1
+        current_streak = 1
+    return first_period_start, period, current_streak, max(longest_streak, current_streak), resets
+
+
+def _run_length(cur, name: str, first_period_start: int, periodicity: int, period: int, step: int, user: str):
+    """
+    counts the completed periods right before (step=-1) or right after (step=1) a period, only the check-offs of that
+    run are read
+    """
+    if step < 0:
+        cur.execute("""SELECT check_off_date FROM habits_tracker
+            WHERE user = ? AND habitsName = ? AND check_off_date < ? ORDER BY check_off_date DESC""",
+                    (user, name, first_period_start + period * periodicity))
+    else:
+        cur.execute("""SELECT check_off_date FROM habits_tracker
+            WHERE user = ? AND habitsName = ? AND check_off_date >= ? ORDER BY check_off_date""",
+                    (user, name, first_period_start + (period + 1) * periodicity))
+
+    run_length, expected = 0, period + step
+    for day, in cur:
+        day_period = (day - first_period_start) // periodicity
+        if day_period == expected:
+            run_length += 1
+            expected += step
+        elif day_period != expected - step:
+            break
+    return run_length
+
+
+def _fill_streak_gap(cur, name: str, summary: tuple, day: int, periodicity: int, user: str):
+    """
+    merges a late check-off that lies before the last checked-off period into a streak summary, only the runs of
+    completed periods next to it are read
+    """
+    first_period_start, last_period, current_streak, longest_streak, resets = summary
+    period = (day - first_period_start) // periodicity
+    period_start = first_period_start + period * periodicity
+    cur.execute("""SELECT 1 FROM habits_tracker
+        WHERE user = ? AND habitsName = ? AND check_off_date BETWEEN ? AND ? AND check_off_date != ? LIMIT 1""",
+                (user, name, period_start, period_start + periodicity - 1, day))
+    if cur.fetchone():
+        # the period had already been completed
+        return summary
+
+    before = _run_length(cur, name, first_period_start, periodicity, period, -1, user)
+    after = _run_length(cur, name, first_period_start, periodicity, period, 1, user)
+    run_length = before + 1 + after
+    if period + after == last_period:
+        current_streak = run_length
+    return first_period_start, last_period, current_streak, max(longest_streak, run_length), resets - 1
+
+
+def _rule_streak_step(cur, name: str, summary: tuple, day: int, rule, user: str):
+    """
+    advances a streak summary of a habit with calendar or quota periods, see _rule_streak_summary, by a check-off that
+    was just stored. Periods after the last completed one are incomplete, so only the period of the check-off is read,
+    and only if more than one check-off completes a period.
+
+    :return: the new summary, None if the check-off lies before the first period or the last completed period
+    """
+    first_period_start, last_period, current_streak, longest_streak, resets = summary
+    if first_period_start is None:
+        return _rule_streak_summary([day], rule)
+    if day < first_period_start:
+        return None
+    rule = rule.at(first_period_start)
+    index = rule.index(day)
+    period = index - rule.index(first_period_start)
+    if period == last_period:
+        return summary
+    if period < last_period:
+        return None
+    if rule.required > 1:
+        cur.execute("""SELECT COUNT(*) FROM habits_tracker
+            WHERE user = ? AND habitsName = ? AND check_off_date >= ? AND check_off_date < ?""",
+                    (user, name, rule.start(index), rule.start(index + 1)))
+        if cur.fetchone()[0] < rule.required:
+            return summary
+    if period == last_period + 1:
+        current_streak += 1
+    else:
+        resets += period - last_period - 1
+        current_streak = 1
+    return first_period_start, period, current_streak, max(longest_streak, current_streak), resets
+
+
+def _store_streak_summary(cur, name: str, summary: tuple, user: str):
+    cur.execute("INSERT OR REPLACE INTO habit_streaks VALUES (?, ?, ?, ?, ?, ?, ?, 0)", (user, name, *summary))
+
+
+def _update_streak_summary(cur, name: str, day: int, user: str):
+    """
+    updates the streak summary of a habit after a new check-off was stored
+    """
+    cur.execute("""SELECT h.periodicity, s.first_period_start, s.last_period, s.current_streak, s.longest_streak,
+        s.resets, s.stale FROM habits h LEFT JOIN habit_streaks s ON s.user = h.user AND s.habitsName = h.name
+        WHERE h.user = ? AND h.name = ?""", (user, name))
+    periodicity, *summary, stale = cur.fetchone()
+    if stale is None or stale:
+        # the summary does not exist yet or is outdated, it is rebuilt the next time it is read
+        return
+
+    periodicity = normalise_periodicity(periodicity)
+    summary = tuple(summary)
+    if not isinstance(periodicity, int):
+        new_summary = _rule_streak_step(cur, name, summary, day, parse_periodicity(periodicity), user)
+        if new_summary is None:
+            # a late check-off before the last completed period can close a gap anywhere
+            rebuild_streak_summary(cur, name, periodicity, user)
+        elif new_summary != summary:
+            _store_streak_summary(cur, name, new_summary, user)
+        return
+    new_summary = _streak_step(summary, day, periodicity)
+    if new_summary is None:
+        first_period_start, last_period, current_streak, longest_streak, resets = summary
+        if day < first_period_start:
+            shift, misaligned = divmod(first_period_start - day, periodicity)
+            if misaligned:
+                # the first period moves and the periods do not line up anymore
+                rebuild_streak_summary(cur, name, periodicity, user)
+                return
+            # the new first period is added in front as missed period and then filled like a gap
+            summary = (day, last_period + shift, current_streak, longest_streak, resets + shift)
+        new_summary = _fill_streak_gap(cur, name, summary, day, periodicity, user)
+    _store_streak_summary(cur, name, new_summary, user)
+
+
+@instrument
+def rebuild_streak_summary(cur, name: str, periodicity: int, user: str = DEFAULT_USER):
+    """
+    recomputes the streak summary of a habit from all of its check-offs and stores it without committing
+
+    :param cur: cursor of the database where habits are stored
+    :param name: habit name
+    :param periodicity: habit periodicity
+    :param user: user the habit belongs to
+    :return: None
+    """
+    _store_streak_summary(cur, name, _compute_streak_summary(cur, name, periodicity, user), user)
+
+
+def _compute_streak_summary(cur, name: str, periodicity: int, user: str):
+    """
+    computes the streak summary of a habit from all of its check-offs, see rebuild_streak_summary
+
+    :return: summary (first_period_start, last_period, current_streak, longest_streak, resets)
+    """
+    periodicity = normalise_periodicity(periodicity)
+    summary = _EMPTY_SUMMARY
+    cur.execute("""SELECT check_off_date FROM habits_tracker WHERE user = ? AND habitsName = ?
+        ORDER BY check_off_date""", (user, name))
+    if isinstance(periodicity, int):
+        for day, in cur:
+            summary = _streak_step(summary, day, periodicity)
+    else:
+        summary = _rule_streak_summary((day for day, in cur), parse_periodicity(periodicity))
+    return summary
+
+
+def _rule_streak_summary(days, rule):
+    """
+    computes a streak summary like _streak_step for a habit with calendar or quota periods, the sorted check-offs are
+    read once. last_period is -1 while no period has been completed.
+
+    :param days: iterable with sorted check-off day numbers
+    :param rule: periods.PeriodRule of the habit
+    :return: summary (first_period_start, last_period, current_streak, longest_streak, resets)
+    """
+    days = iter(days)
+    first_day = next(days, None)
+    if first_day is None:
+        return _EMPTY_SUMMARY
+    rule = rule.at(first_day)
+    first_period = rule.index(first_day)
+    last_period, current_streak, longest_streak, resets = -1, 0, 0, 0
+    for index in completed_indices(chain([first_day], days), rule):
+        period = index - first_period
+        if period == last_period + 1:
+            current_streak += 1
+        else:
+            resets += period - last_period - 1
+            current_streak = 1
+        longest_streak = max(longest_streak, current_streak)
+        last_period = period
+    return rule.start(first_period), last_period, current_streak, longest_streak, resets
+
+
+def _rebuild_stale(cur, habits: set = None):
+    """
+    rebuilds the streak summaries that are missing or marked as stale and the stale rollups without committing. It
+    is called at the end of the writes that mark them, so the functions that read them never have to write.
+
+    :param habits: set with the (user, habit name) pairs that are checked, None to check all habits
+    """
+    if habits is None:
+        cur.execute("""SELECT h.user, h.name, h.periodicity FROM habits h
+            LEFT JOIN habit_streaks s ON s.user = h.user AND s.habitsName = h.name
+            WHERE s.habitsName IS NULL OR s.stale""")
+    else:
+        # the stale summaries are found through a partial index
+        cur.execute("""SELECT s.user, s.habitsName, h.periodicity FROM habit_streaks s
+            JOIN habits h ON h.user = s.user AND h.name = s.habitsName WHERE s.stale""")
+    outdated = [row for row in cur.fetchall() if habits is None or row[:2] in habits]
+    for habit_user, habit, habit_periodicity in outdated:
+        rebuild_streak_summary(cur, habit, habit_periodicity, habit_user)
+
+    if habits is None:
+        habits = cur.execute("SELECT user, name FROM habits WHERE rollups_stale").fetchall()
+    for habit_user, habit in sorted(habits):
+        rebuild_rollups(cur, habit, habit_user)
+
+
+@instrument
+def get_streak_summaries(db: Connection, periodicity: int = None, name: str = None, user: str = DEFAULT_USER):
+    """
+    returns the streak summaries of all habits. Summaries that are missing or marked as stale, e.g. by an older
+    version of the app, are computed from the check-offs without storing them, so this only reads.
+
+    :param db: database where habits are stored
+    :param periodicity: if provided, only habits with this periodicity will be returned
+    :param name: if supplied, only the summary of this habit will be returned
+    :param user: user the habits belong to
+    :return: dictionary, key = habit name, value = StreakRecord, ordered like get_habit_names
+    """
+    conditions, params = ["h.user = ?"], [user]
+    if periodicity:
+        conditions.append("h.periodicity = ?")
+        params.append(periodicity)
+    if name:
+        conditions.append("h.name = ?")
+        params.append(name)
+    where = ' AND '.join(conditions)
+
+    cur = db.cursor()
+    cur.execute(f"""SELECT h.name, h.periodicity, s.first_period_start, s.last_period, s.current_streak,
+        s.longest_streak, s.resets,
+        (SELECT MAX(t.check_off_date) FROM habits_tracker t WHERE t.user = h.user AND t.habitsName = h.name),
+        s.stale IS NOT 0 FROM habits h LEFT JOIN habit_streaks s ON s.user = h.user AND s.habitsName = h.name
+        WHERE {where} ORDER BY h.name""", params)
+    records = dict()
+    for habit, habit_periodicity, *summary, last_check_off, outdated in cur.fetchall():
+        if outdated:
+            summary = _compute_streak_summary(cur, habit, habit_periodicity, user)
+        records[habit] = StreakRecord(normalise_periodicity(habit_periodicity), *summary, last_check_off)
+    return records
+
+
+class WindowStreakRecord(NamedTuple):
+    """
+    streak summary of a habit within a window as computed by get_window_streaks, periods is the number of periods
+    from the first period of the habit in the window until the period that contains the end of the window
+    """
+    periodicity: int
+    periods: int
+    longest_streak: int
+    current_streak: int
+    resets: int
+
+
+def _month_sql(day: str):
+    return (f"(CAST(strftime('%Y', {day} + {JULIAN_DAY_OFFSET}) AS INTEGER) * 12 "
+            f"+ CAST(strftime('%m', {day} + {JULIAN_DAY_OFFSET}) AS INTEGER))")
+
+
+def _period_index_sql(day: str):
+    """
+    SQL expression of the index of the period that contains day, counted from the period that starts on the first
+    day of the grid r.grid_start, see periods for the rules
+    """
+    return f"""CASE r.kind
+        WHEN 'week' THEN ({day} - 1) / 7 - (r.grid_start - 1) / 7
+        WHEN 'month' THEN {_month_sql(day)} - {_month_sql('r.grid_start')}
+        ELSE ({day} - r.grid_start) / r.days END"""
+
+
+@instrument
+def get_window_streaks(db: Connection, start_date: dt.date, end_date: dt.date = None, periodicity: int = None,
+                       name: str = None, user: str = DEFAULT_USER):
+    """
+    computes longest streak, current streak and missed periods of every habit within a window inside SQLite, the
+    result is the same as the one of analyse_habits.analyse_window, but only one row per habit leaves the database.
+    The check-offs are bucketed into periods with the rules of the period engine (see periods), the completed periods
+    are numbered with ROW_NUMBER() and consecutive periods form an island with the same period - row number, so every
+    island is one streak. Requires SQLite 3.25 or newer for window functions.
+
+    :param db: database where habits are stored
+    :param start_date: first day of the window
+    :param end_date: last day of the window, if not provided today's date is used
+    :param periodicity: if provided, only habits with this periodicity will be analysed
+    :param name: if supplied, only this habit will be analysed
+    :param user: user the habits belong to
+    :return: dictionary, key = habit name, value = WindowStreakRecord, ordered like get_habit_names
+    """
+    start, end = to_day_number(start_date), to_day_number(end_date or today())
+    conditions, params = ["h.user = :user"], {'user': user, 'start': start, 'end': end}
+    if periodicity:
+        conditions.append("h.periodicity = :periodicity")
+        params['periodicity'] = periodicity
+    if name:
+        conditions.append("h.name = :name")
+        params['name'] = name
+
+    cur = db.cursor()
+    cur.execute(f"""WITH habit AS (
+            SELECT h.name, h.periodicity, instr(h.periodicity, '/') AS slash,
+                MAX(:start, (SELECT MIN(t.check_off_date) FROM habits_tracker t
+                             WHERE t.user = h.user AND t.habitsName = h.name)) AS first_day
+            FROM habits h WHERE {' AND '.join(conditions)}),
+        r AS (
+            SELECT name, periodicity,
+                CASE WHEN periodicity IN ('week', 'month') THEN periodicity ELSE 'days' END AS kind,
+                CASE WHEN slash THEN CAST(substr(periodicity, slash + 1) AS INTEGER)
+                    ELSE CAST(periodicity AS INTEGER) END AS days,
+                CASE WHEN slash THEN CAST(substr(periodicity, 1, slash - 1) AS INTEGER) ELSE 1 END AS required,
+                CASE WHEN first_day <= :end THEN first_day END AS grid_start
+            FROM habit),
+        completed AS (
+            SELECT t.habitsName AS name, {_period_index_sql('t.check_off_date')} AS period
+            FROM r JOIN habits_tracker t ON t.user = :user AND t.habitsName = r.name
+            WHERE t.check_off_date BETWEEN r.grid_start AND :end
+            GROUP BY t.habitsName, period HAVING COUNT(*) >= MAX(r.required)),
+        islands AS (
+            SELECT name, period, period - ROW_NUMBER() OVER (PARTITION BY name ORDER BY period) AS island
+            FROM completed),
+        runs AS (
+            SELECT name, COUNT(*) AS length, MAX(period) AS last_period FROM islands GROUP BY name, island),
+        ranked AS (
+            SELECT name, length, FIRST_VALUE(length) OVER latest AS last_length,
+                FIRST_VALUE(last_period) OVER latest AS last_period
+            FROM runs WINDOW latest AS (PARTITION BY name ORDER BY last_period DESC)),
+        streaks AS (
+            SELECT name, MAX(length) AS longest_streak, SUM(length) AS completed, MAX(last_length) AS last_length,
+                MAX(last_period) AS last_period
+            FROM ranked GROUP BY name)
+        SELECT r.name, r.periodicity, p.periods, COALESCE(s.longest_streak, 0),
+            -- the streak is still alive while the ongoing period has not been completed yet
+            CASE WHEN s.last_period >= p.periods - 2 THEN s.last_length ELSE 0 END,
+            p.periods - COALESCE(s.completed, 0)
+        FROM r JOIN (SELECT name, CASE WHEN grid_start IS NULL THEN 0 ELSE {_period_index_sql(':end')} + 1 END
+                     AS periods FROM r) p ON p.name = r.name
+        LEFT JOIN streaks s ON s.name = r.name
+        ORDER BY r.name""", params)
+    return {habit: WindowStreakRecord(normalise_periodicity(habit_periodicity), *summary)
+            for habit, habit_periodicity, *summary in cur}
+
+
+@instrument
+def get_streak_leaderboard(db: Connection, limit: int = 10, periodicity: int = None):
+    """
+    returns the habits with the longest streaks over all users. The summaries of all users are kept in one table, so
+    this is one scan of the index on the longest streaks, which stops after limit rows. Summaries that are marked as
+    stale, e.g. by an older version of the app, are found through a partial index and computed in memory without
+    storing them, so this only reads.
+
+    :param db: database where habits are stored
+    :param limit: maximal number of habits that are returned
+    :param periodicity: if provided, only habits with this periodicity are ranked
+    :return: list with LeaderboardEntry tuples, longest streak first, ties ordered by user and habit name
+    """
+    where, params = ("AND h.periodicity = ?", [periodicity]) if periodicity else ("", [])
+    cur = db.cursor()
+    cur.execute(f"""SELECT s.user, s.habitsName, h.periodicity FROM habit_streaks s
+        JOIN habits h ON h.user = s.user AND h.name = s.habitsName WHERE s.stale {where}""", params)
+    entries = [LeaderboardEntry(habit_user, habit, habit_periodicity,
+                                _compute_streak_summary(cur, habit, habit_periodicity, habit_user)[3])
+               for habit_user, habit, habit_periodicity in cur.fetchall()]
+
+    cur.execute(f"""SELECT s.user, s.habitsName, h.periodicity, s.longest_streak FROM habit_streaks s
+        JOIN habits h ON h.user = s.user AND h.name = s.habitsName WHERE NOT s.stale {where}
+        ORDER BY s.longest_streak DESC, s.user, s.habitsName LIMIT ?""", params + [limit])
+    entries.extend(LeaderboardEntry(*entry) for entry in cur)
+    entries.sort(key=lambda entry: (-entry.longest_streak, entry.user, entry.name))
+    return [entry._replace(periodicity=normalise_periodicity(entry.periodicity)) for entry in entries[:limit]]
+
+
+class RollupRecord(NamedTuple):
+    """
+    check-offs of a habit in one calendar week or month as returned by get_rollups, weekdays holds the check-offs on
+    each weekday from Monday to Sunday
+    """
+    period_start: int
+    check_offs: int
+    weekdays: tuple
+
+
+def _update_rollups(cur, name: str, day: int, user: str):
+    """
+    counts a new check-off in the week and month rollups of a habit, nothing is counted while the rollups of the
+    habit are stale
+    """
+    weekday = WEEKDAYS[(day - 1) % 7]
+    for grain in ROLLUP_GRAINS:
+        rule = parse_periodicity(grain)
+        cur.execute(f"""INSERT INTO habit_rollups (user, habitsName, grain, period_start, check_offs, {weekday})
+            SELECT user, name, ?, ?, 1, 1 FROM habits WHERE user = ? AND name = ? AND NOT rollups_stale
+            ON CONFLICT (user, habitsName, grain, period_start)
+            DO UPDATE SET check_offs = check_offs + 1, {weekday} = {weekday} + 1""",
+                    (grain, rule.start(rule.index(day)), user, name))
+
+
+@instrument
+def rebuild_rollups(cur, name: str, user: str = DEFAULT_USER):
+    """
+    recomputes the rollups of a habit from all of its check-offs with one aggregation per grain
+
+    :param cur: cursor of the database where habits are stored
+    :param name: habit name
+    :param user: user the habit belongs to
+    :return: None
+    """
+    cur.execute("DELETE FROM habit_rollups WHERE user = ? AND habitsName = ?", (user, name))
+    for grain in ROLLUP_GRAINS:
+        cur.execute(f"""INSERT INTO habit_rollups SELECT user, habitsName, ?, {_rollup_columns(grain)}
+            FROM habits_tracker WHERE user = ? AND habitsName = ? GROUP BY period_start""", (grain, user, name))
+    cur.execute("UPDATE habits SET rollups_stale = 0 WHERE user = ? AND name = ?", (user, name))
+
+
+def _rollup_columns(grain: str):
+    """
+    :return: SQL columns period_start, check-offs and check-offs per weekday of a rollup of habits_tracker rows that
+    are grouped by period_start
+    """
+    weekdays = ', '.join(f"SUM((check_off_date - 1) % 7 = {index})" for index in range(len(WEEKDAYS)))
+    return f"{ROLLUP_GRAINS[grain].format(day='check_off_date')} AS period_start, COUNT(*), {weekdays}"
+
+
+@instrument
+def get_rollups(db: Connection, grain: str, start_date: dt.date = None, end_date: dt.date = None,
+                periodicity: int = None, name: str = None, user: str = DEFAULT_USER):
+    """
+    returns the check-offs of every habit per calendar week or month, read from the rollups, so the cost depends on
+    the number of weeks or months and not on the number of check-offs. Rollups that are still stale, e.g. marked by
+    an older version of the app, are aggregated from the check-offs without storing them, so this only reads. Single
+    days do not need a rollup, they are the rows of habits_tracker.
+
+    :param db: database where habits are stored
+    :param grain: 'week' or 'month'
+    :param start_date: if provided, the weeks or months before the one that contains this date are left out
+    :param end_date: if provided, the weeks or months after the one that contains this date are left out
+    :param periodicity: if provided, only habits with this periodicity will be returned
+    :param name: if supplied, only this habit will be returned
+    :param user: user the habits belong to
+    :return: dictionary, key = habit name, value = list with a RollupRecord per week or month with check-offs in
+    ascending order, ordered like get_habit_names
+    """
+    if grain not in ROLLUP_GRAINS:
+        raise ValueError(f"invalid grain {grain!r}, use one of {', '.join(map(repr, ROLLUP_GRAINS))}")
+    conditions, params = ["h.user = ?"], [user]
+    if periodicity:
+        conditions.append("h.periodicity = ?")
+        params.append(periodicity)
+    if name:
+        conditions.append("h.name = ?")
+        params.append(name)
+    where = ' AND '.join(conditions)
+
+    cur = db.cursor()
+    cur.execute(f"SELECT h.name FROM habits h WHERE h.rollups_stale AND {where}", params)
+    stale = [habit for habit, in cur.fetchall()]
+
+    rule = parse_periodicity(grain)
+    first = rule.start(rule.index(to_day_number(start_date))) if start_date else 0
+    last = to_day_number(end_date) if end_date else dt.date.max.toordinal()
+    cur.execute(f"""SELECT h.name, r.period_start, r.check_offs, {', '.join(f'r.{day}' for day in WEEKDAYS)}
+        FROM habits h LEFT JOIN habit_rollups r ON r.user = h.user AND r.habitsName = h.name AND r.grain = ?
+            AND r.period_start BETWEEN ? AND ? AND NOT h.rollups_stale
+        WHERE {where} ORDER BY h.name, r.period_start""", [grain, first, last] + params)
+    rollups = dict()
+    for habit, period_start, check_offs, *weekdays in cur:
+        habit_rollups = rollups.setdefault(habit, [])
+        if period_start is not None:
+            habit_rollups.append(RollupRecord(period_start, check_offs, tuple(weekdays)))
+
+    for habit in stale:
+        cur.execute(f"""SELECT {_rollup_columns(grain)} FROM habits_tracker
+            WHERE user = ? AND habitsName = ? AND check_off_date >= ?
+            GROUP BY period_start HAVING period_start <= ? ORDER BY period_start""", (user, habit, first, last))
+        rollups[habit] = [RollupRecord(period_start, check_offs, tuple(weekdays))
+                          for period_start, check_offs, *weekdays in cur]
+    return rollups
@@ -0,0 +1,190 @@
+"""
+asyncio interface to habit_db and analyse_habits for async applications.
+
+The blocking functions run on a bounded thread pool, each thread reads with its own connection and all writes go
+through the writer connection of a ConnectionManager. Check-offs that arrive while the event loop is busy or while
+the previous batch is still being written are stored together in one transaction. Identical read calls that run at
+the same time are only executed once.
+
+    async with AsyncHabitDB("main.db") as habits:
+        await habits.increment_habit("Study", dt.date.today())
+        print(await habits.return_number_of_habit_streaks())
+"""
+import asyncio
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+
+import analyse_habits
+import habit_db
+
+
+class AsyncHabitDB:
+    """
+    async version of the habit_db and analyse_habits functions, the database argument is replaced by the instance
+    """
+
+    def __init__(self, name="main.db", max_workers: int = 4):
+        """
+        :param name: database file
+        :param max_workers: maximal number of threads that access the database at the same time
+        """
+        self._connections = habit_db.ConnectionManager(name)
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='habit_db')
+        self._pending_check_offs = []
+        self._flush_task = None
+        self._in_flight = dict()
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _read_in_thread(self, function, args, kwargs):
+        with self._connections.read() as db:
+            return function(db, *args, **kwargs)
+
+    def _write_in_thread(self, function, args):
+        with self._connections.write() as db:
+            return function(db, *args)
+
+    async def _read(self, function, *args, **kwargs):
+        """
+        runs a read-only function, if the same call is already running its result is shared
+        """
+        key = (function, args, tuple(sorted(kwargs.items())))
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._run(self._read_in_thread, function, args, kwargs))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda done: self._in_flight.pop(key, None)
+                                     if self._in_flight.get(key) is done else None)
+        return await asyncio.shield(future)
+
+    async def _write(self, function, *args):
+        # reads that started before the write must not be shared with callers that come after it
+        self._in_flight.clear()
+        await self.flush()
+        return await self._run(self._write_in_thread, function, args)
+
+    async def add_habit(self, name: str, periodicity: int, creation_date: dt.date = None,
+                        user: str = habit_db.DEFAULT_USER):
+        return await self._write(habit_db.add_habit, name, periodicity, creation_date, user)
+
+    async def delete_habit(self, name: str, user: str = habit_db.DEFAULT_USER):
+        return await self._write(habit_db.delete_habit, name, user)
+
+    async def increment_habits_bulk(self, events, chunk_size: int = 10000, user: str = habit_db.DEFAULT_USER):
+        return await self._write(habit_db.increment_habits_bulk, events, chunk_size, user)
+
+    async def increment_habit(self, name: str, event_date: dt.date, user: str = habit_db.DEFAULT_USER):
+        """
+        stores a check-off, it is written together with all other check-offs that are waiting at the same time
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending_check_offs.append((user, name, event_date, future))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_check_offs())
+        return await future
+
+    async def flush(self):
+        """
+        waits until all check-offs that are waiting are stored
+        """
+        if self._flush_task is not None:
+            await asyncio.shield(self._flush_task)
+
+    async def _flush_check_offs(self):
+        while self._pending_check_offs:
+            # lets the other tasks that are ready add their check-offs to this batch
+            await asyncio.sleep(0)
+            batch, self._pending_check_offs = self._pending_check_offs, []
+            self._in_flight.clear()
+            try:
+                results = await self._run(self._write_check_offs, [check_off[:3] for check_off in batch])
+            except asyncio.CancelledError:
+                for *_, future in batch:
+                    future.cancel()
+                raise
+            except Exception as exception:
+                # e.g. the executor was shut down, every check-off of the batch fails instead of waiting forever
+                results = [exception] * len(batch)
+            for (*_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(None)
+
+    def _write_check_offs(self, events):
+        """
+        stores a batch of check-offs with one transaction per user, if that fails they are stored one by one, so that
+        only the check-offs that caused the error fail
+
+        :param events: list with (user, habit name, check-off date) tuples
+        :return: list with None or the exception for each check-off
+        """
+        results = [None] * len(events)
+        users = dict()
+        for index, (user, name, event_date) in enumerate(events):
+            users.setdefault(user, []).append((index, name, event_date))
+
+        with self._connections.write() as db:
+            for user, user_events in users.items():
+                try:
+                    habit_db.increment_habits(db, [(name, event_date) for _, name, event_date in user_events], user)
+                except Exception:
+                    for index, name, event_date in user_events:
+                        try:
+                            habit_db.increment_habit(db, name, event_date, user)
+                        except Exception as exception:
+                            db.rollback()
+                            results[index] = exception
+        return results
+
+    async def get_users(self):
+        return await self._read(habit_db.get_users)
+
+    async def get_habit_names(self, periodicity: int = None, user: str = habit_db.DEFAULT_USER):
+        return await self._read(habit_db.get_habit_names, periodicity, user)
+
+    async def get_periodicity(self, name: str, user: str = habit_db.DEFAULT_USER):
+        return await self._read(habit_db.get_periodicity, name, user)
+
+    async def get_habit_tracker(self, start_date: dt.date, name: str = None, user: str = habit_db.DEFAULT_USER):
+        return await self._read(habit_db.get_habit_tracker, start_date, name, user)
+
+    async def get_first_check_off_date(self, name: str, user: str = habit_db.DEFAULT_USER):
+        return await self._read(habit_db.get_first_check_off_date, name, user)
+
+    async def get_habits_snapshot(self, start_date: dt.date, periodicity: int = None, name: str = None,
+                                  end_date: dt.date = None, user: str = habit_db.DEFAULT_USER):
+        return await self._read(habit_db.get_habits_snapshot, start_date, periodicity, name, end_date, user=user)
+
+    async def get_streak_leaderboard(self, limit: int = 10, periodicity: int = None):
+        return await self._read(habit_db.get_streak_leaderboard, limit, periodicity)
+
+    async def get_habit_streak(self, name: str, time_interval: float = None, user: str = habit_db.DEFAULT_USER):
+        return await self._read(analyse_habits.get_habit_streak, name, time_interval, user)
+
+    async def return_number_of_habit_streaks(self, name: str = None, time_interval: float = None,
+                                             periodicity: int = None, **kwargs):
+        return await self._read(analyse_habits.return_number_of_habit_streaks, name, time_interval, periodicity,
+                                **kwargs)
+
+    async def return_number_of_habit_resets(self, name: str = None, time_interval: float = None,
+                                            periodicity: int = None, **kwargs):
+        return await self._read(analyse_habits.return_number_of_habit_resets, name, time_interval, periodicity,
+                                **kwargs)
+
+    async def close(self):
+        """
+        stores the waiting check-offs and closes all connections
+        """
+        await self.flush()
+        self._executor.shutdown(wait=True)
+        self._connections.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
@@ -0,0 +1,271 @@
+"""
+Export and import of the complete habit history of a database.
+
+The history is streamed record by record between the database cursor and the file, so files of any size are written
+and read with constant memory. Three formats are supported:
+
+csv: one row per habit and per check-off with the columns type, user, habit, periodicity, creation_date and date
+jsonl: one JSON object per line, {"type": "habit", ...} or {"type": "check_off", ...}
+columnar: binary file with one array of little-endian int32 day numbers per habit, the arrays can be read directly
+    from the file with mmap, see ColumnarHistory
+
+    with open("history.csv", "w", newline="") as file:
+        write_csv(export_history(db), file)
+    import_file(other_db, "history.csv")
+"""
+import csv
+import json
+import mmap
+import struct
+import sys
+from array import array
+from itertools import groupby, islice
+
+from habit_db import ExportedCheckOff, ExportedHabit, export_history, import_history, to_date_string, to_day_number
+from periods import normalise_periodicity
+
+CSV_COLUMNS = ['type', 'user', 'habit', 'periodicity', 'creation_date', 'date']
+# the columnar file starts and ends with MAGIC, the end also contains the offset of the habit index
+COLUMNAR_MAGIC = b'HABITS01'
+_TRAILER = struct.Struct('<Q8s')
+# number of check-offs that are converted and written at once
+_CHUNK_SIZE = 65536
+
+
+def write_csv(records, file):
+    """
+    writes habits and check-offs as CSV
+
+    :param records: iterable with ExportedHabit and ExportedCheckOff tuples, see export_history
+    :param file: text file opened with newline=''
+    :return: number of written records
+    """
+    writer = csv.writer(file)
+    writer.writerow(CSV_COLUMNS)
+    count = 0
+    for count, record in enumerate(records, 1):
+        if isinstance(record, ExportedCheckOff):
+            writer.writerow(['check_off', record.user, record.name, '', '', to_date_string(record.day)])
+        else:
+            writer.writerow(['habit', record.user, record.name, record.periodicity, record.creation_date, ''])
+    return count
+
+
+def read_csv(file):
+    """
+    reads habits and check-offs written by write_csv
+
+    :param file: text file opened with newline=''
+    :return: generator of ExportedHabit and ExportedCheckOff tuples
+    """
+    for row in csv.DictReader(file):
+        if row['type'] == 'check_off':
+            yield ExportedCheckOff(row['user'], row['habit'], to_day_number(row['date']))
+        else:
+            yield ExportedHabit(row['user'], row['habit'], normalise_periodicity(row['periodicity']),
+                                row['creation_date'])
+
+
+def write_jsonl(records, file):
+    """
+    writes habits and check-offs as JSON Lines
+
+    :param records: iterable with ExportedHabit and ExportedCheckOff tuples, see export_history
+    :param file: text file
+    :return: number of written records
+    """
+    count = 0
+    for count, record in enumerate(records, 1):
+        if isinstance(record, ExportedCheckOff):
+            line = {'type': 'check_off', 'user': record.user, 'name': record.name, 'date': to_date_string(record.day)}
+        else:
+            line = {'type': 'habit', **record._asdict()}
+        file.write(json.dumps(line, default=str) + '\n')
+    return count
+
+
+def read_jsonl(file):
+    """
+    reads habits and check-offs written by write_jsonl, empty lines are skipped
+
+    :param file: text file
+    :return: generator of ExportedHabit and ExportedCheckOff tuples
+    """
+    for line in file:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if record['type'] == 'check_off':
+            yield ExportedCheckOff(record['user'], record['name'], to_day_number(record['date']))
+        else:
+            yield ExportedHabit(record['user'], record['name'], normalise_periodicity(record['periodicity']),
+                                record['creation_date'])
+
+
+def _int32_chunk(days):
+    chunk = array('i', days)
+    if sys.byteorder != 'little':
+        chunk.byteswap()
+    return chunk
+
+
+def write_columnar(records, file):
+    """
+    writes habits and check-offs in the columnar format: the day numbers of each habit are stored as one array of
+    int32 values, followed by an index with the habits and the position of their arrays. The check-offs of a habit
+    have to follow each other sorted by date, like export_history returns them.
+
+    :param records: iterable with ExportedHabit and ExportedCheckOff tuples, see export_history
+    :param file: binary file
+    :return: number of written records
+    """
+    file.write(COLUMNAR_MAGIC)
+    position = len(COLUMNAR_MAGIC)
+    index = dict()
+    count = 0
+    for is_check_off, group in groupby(records, key=lambda record: isinstance(record, ExportedCheckOff)):
+        if not is_check_off:
+            for habit in group:
+                index[habit.user, habit.name] = [*habit, 0, 0]
+                count += 1
+            continue
+        for key, check_offs in groupby(group, key=lambda record: (record.user, record.name)):
+            days = (check_off.day for check_off in check_offs)
+            entry = index[key]
+            entry[4] = position
+            while True:
+                chunk = _int32_chunk(islice(days, _CHUNK_SIZE))
+                if not chunk:
+                    break
+                chunk.tofile(file)
+                entry[5] += len(chunk)
+                position += chunk.itemsize * len(chunk)
+            count += entry[5]
+
+    index_data = json.dumps(list(index.values()), default=str).encode()
+    file.write(index_data)
+    file.write(_TRAILER.pack(position, COLUMNAR_MAGIC))
+    return count
+
+
+class ColumnarHistory:
+    """
+    reads a file in the columnar format through mmap, the arrays of day numbers are not copied, only the pages that
+    are accessed are read from disk
+
+    with ColumnarHistory("history.habits") as history:
+        days = history.check_offs("default", "Study")
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: path of the file
+        """
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        index_offset, magic = _TRAILER.unpack_from(self._map, len(self._map) - _TRAILER.size)
+        if magic != COLUMNAR_MAGIC or self._map[:len(COLUMNAR_MAGIC)] != COLUMNAR_MAGIC:
+            self.close()
+            raise ValueError(f'{path} is not a columnar habit history')
+        index = json.loads(self._map[index_offset:len(self._map) - _TRAILER.size])
+        self._index = {(user, name): (ExportedHabit(user, name, periodicity, creation_date), offset, count)
+                       for user, name, periodicity, creation_date, offset, count in index}
+
+    @property
+    def habits(self):
+        """
+        :return: list with an ExportedHabit per habit, ordered like in the file
+        """
+        return [habit for habit, _, _ in self._index.values()]
+
+    def check_offs(self, user: str, name: str):
+        """
+        returns the sorted day numbers of a habit, the returned memoryview has to be released before the file is
+        closed. On big-endian machines the day numbers are copied into an array instead.
+
+        :param user: user the habit belongs to
+        :param name: habit name
+        :return: memoryview or array of int32 day numbers, it can be passed to numpy.frombuffer
+        """
+        _, offset, count = self._index[user, name]
+        view = memoryview(self._map)[offset:offset + 4 * count]
+        if sys.byteorder == 'little':
+            return view.cast('i')
+        days = array('i', view.tobytes())
+        view.release()
+        days.byteswap()
+        return days
+
+    def records(self):
+        """
+        :return: generator of all habits and then all check-offs, like export_history
+        """
+        yield from self.habits
+        for user, name in self._index:
+            days = self.check_offs(user, name)
+            try:
+                for day in days:
+                    yield ExportedCheckOff(user, name, day)
+            finally:
+                if isinstance(days, memoryview):
+                    days.release()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# file extension: format
+FILE_FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.habits': 'columnar'}
+
+
+def _file_format(path: str, file_format: str = None):
+    if file_format:
+        return file_format
+    for extension, extension_format in FILE_FORMATS.items():
+        if path.endswith(extension):
+            return extension_format
+    raise ValueError(f'the format of {path} can not be derived from its extension, use one of {list(FILE_FORMATS)}')
+
+
+def export_file(db, path: str, file_format: str = None, user: str = None):
+    """
+    writes the history of a database to a file
+
+    :param db: database where habits are stored
+    :param path: path of the file
+    :param file_format: 'csv', 'jsonl' or 'columnar', if not provided it is derived from the file extension
+    :param user: if supplied, only the habits of this user are exported
+    :return: number of exported records
+    """
+    file_format = _file_format(path, file_format)
+    records = export_history(db, user)
+    if file_format == 'columnar':
+        with open(path, 'wb') as file:
+            return write_columnar(records, file)
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        return (write_csv if file_format == 'csv' else write_jsonl)(records, file)
+
+
+def import_file(db, path: str, file_format: str = None, chunk_size: int = 10000):
+    """
+    stores the history of a file in a database, see import_history
+
+    :param db: database where habits are stored
+    :param path: path of the file
+    :param file_format: 'csv', 'jsonl' or 'columnar', if not provided it is derived from the file extension
+    :param chunk_size: number of check-offs that are handed to SQLite at once
+    :return: tuple with the number of new habits, stored check-offs and check-offs skipped as duplicates
+    """
+    file_format = _file_format(path, file_format)
+    if file_format == 'columnar':
+        with ColumnarHistory(path) as history:
+            return import_history(db, history.records(), chunk_size)
+    with open(path, newline='', encoding='utf-8') as file:
+        return import_history(db, (read_csv if file_format == 'csv' else read_jsonl)(file), chunk_size)
@@ -0,0 +1,295 @@
+"""
+In-memory store of the habits of one user for long-running processes like the interactive menu.
+
+A HabitStore reads the habits and check-offs of a user once, in one read transaction, into an immutable HabitSnapshot:
+every habit keeps its check-offs as sorted array of day ordinals, so names and periodicities are dictionary lookups
+and ranges of check-offs are found with bisect. Writes made through HabitTracker objects that were given the store are
+applied as deltas, they replace the array of one habit and publish a new snapshot, a snapshot that was handed out
+before never changes.
+
+Writes made by other connections or processes are detected with PRAGMA data_version, which only changes when another
+connection committed. The store then compares the data version of its user (see habit_db.get_data_version) and only
+reloads if the habits of its user were changed. Writes made on the connection of the store without going through the
+store are not noticed, call reload after them.
+
+    store = HabitStore(db, "alice")
+    HabitTracker("Study", 1, "alice", habit_store=store).store(db)
+    store.names()                                   # no query
+    store.check_offs("Study", dt.date(2022, 1, 1))  # no query
+"""
+import datetime as dt
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import groupby
+from operator import itemgetter
+from sqlite3 import Connection
+from typing import NamedTuple
+
+from instrumentation import instrument
+from habit_db import DEFAULT_USER, get_data_version, to_day_number
+from periods import normalise_periodicity
+
+# type code of the check-off arrays, 4 bytes per day ordinal
+_TYPECODE = 'i'
+
+
+class StoredHabit(NamedTuple):
+    """
+    habit of a HabitSnapshot, check_offs is a sorted array with the day ordinals of its check-offs
+    """
+    periodicity: object
+    creation_date: str
+    check_offs: array
+
+
+class HabitSnapshot:
+    """
+    immutable state of the habits of a user, see the module documentation
+    """
+    __slots__ = ('version', '_habits', '_names', '_by_periodicity')
+
+    def __init__(self, habits: dict, version: int):
+        """
+        :param habits: dictionary, key = habit name, value = StoredHabit, it must not be modified afterwards
+        :param version: data version of the user the habits were read at
+        """
+        self.version = version
+        self._habits = habits
+        self._names = tuple(sorted(habits))
+        by_periodicity = dict()
+        for name in self._names:
+            by_periodicity.setdefault(habits[name].periodicity, []).append(name)
+        self._by_periodicity = {periodicity: tuple(names) for periodicity, names in by_periodicity.items()}
+
+    def __contains__(self, name):
+        return name in self._habits
+
+    def __len__(self):
+        return len(self._habits)
+
+    def names(self, periodicity=None) -> list:
+        """
+        :param periodicity: if provided, only habits with this periodicity are returned
+        :return: list with the habit names in alphabetical order, like habit_db.get_habit_names
+        """
+        if periodicity:
+            return list(self._by_periodicity.get(normalise_periodicity(periodicity), ()))
+        return list(self._names)
+
+    def periodicity(self, name: str):
+        """
+        :return: periodicity of a habit, None if the habit does not exist
+        """
+        habit = self._habits.get(name)
+        return None if habit is None else habit.periodicity
+
+    def habit(self, name: str) -> StoredHabit:
+        """
+        :return: StoredHabit, None if the habit does not exist
+        """
+        return self._habits.get(name)
+
+    def _range(self, name: str, start_date, end_date):
+        check_offs = self._habits[name].check_offs
+        first = 0 if start_date is None else bisect_left(check_offs, to_day_number(start_date))
+        last = len(check_offs) if end_date is None else bisect_right(check_offs, to_day_number(end_date))
+        return check_offs, first, max(first, last)
+
+    def check_offs(self, name: str, start_date: dt.date = None, end_date: dt.date = None) -> array:
+        """
+        returns the check-offs of a habit within a range, found with two binary searches
+
+        :param name: habit name, a KeyError is raised if the habit does not exist
+        :param start_date: if provided, check-offs before this date are left out, dates like in habit_db.to_day_number
+        :param end_date: if provided, check-offs after this date are left out
+        :return: sorted array with day ordinals
+        """
+        check_offs, first, last = self._range(name, start_date, end_date)
+        return check_offs[first:last]
+
+    def count(self, name: str, start_date: dt.date = None, end_date: dt.date = None) -> int:
+        """
+        :return: number of check-offs of a habit within a range, see check_offs
+        """
+        _, first, last = self._range(name, start_date, end_date)
+        return last - first
+
+    def is_checked_off(self, name: str, day: dt.date) -> bool:
+        """
+        :return: True if the habit was checked off on the day
+        """
+        return self.count(name, day, day) > 0
+
+    def first_check_off(self, name: str):
+        """
+        :return: day ordinal of the first check-off of a habit, None if it has never been checked off
+        """
+        check_offs = self._habits[name].check_offs
+        return check_offs[0] if check_offs else None
+
+    def last_check_off(self, name: str):
+        """
+        :return: day ordinal of the most recent check-off of a habit, None if it has never been checked off
+        """
+        check_offs = self._habits[name].check_offs
+        return check_offs[-1] if check_offs else None
+
+    def replace(self, changes: dict, version: int):
+        """
+        returns a new snapshot with some habits replaced, the habits that are not changed are shared
+
+        :param changes: dictionary, key = habit name, value = StoredHabit or None for a deleted habit
+        :param version: data version of the user after the changes
+        :return: HabitSnapshot
+        """
+        habits = dict(self._habits)
+        for name, habit in changes.items():
+            if habit is None:
+                habits.pop(name, None)
+            else:
+                habits[name] = habit
+        return HabitSnapshot(habits, version)
+
+
+class HabitStore:
+    """
+    keeps a HabitSnapshot of the habits of one user in sync with the database, see the module documentation. It can be
+    shared by several threads, the connection must only be used by one thread at a time.
+    """
+
+    def __init__(self, db: Connection, user: str = DEFAULT_USER):
+        """
+        :param db: database where habits are stored
+        :param user: user whose habits are kept
+        """
+        self.db = db
+        self.user = user
+        self.reloads = 0
+        self._lock = threading.Lock()
+        self._data_version = None
+        self._snapshot = None
+        self.reload()
+
+    @instrument
+    def reload(self):
+        """
+        reads all habits and check-offs of the user in one read transaction
+        """
+        with self._lock:
+            started = not self.db.in_transaction
+            if started:
+                self.db.execute("BEGIN")
+            try:
+                cur = self.db.cursor()
+                data_version = cur.execute("PRAGMA data_version").fetchone()[0]
+                version = get_data_version(self.db, user=self.user)
+                habits = {name: StoredHabit(normalise_periodicity(periodicity), creation_date, array(_TYPECODE))
+                          for name, periodicity, creation_date in cur.execute(
+                              "SELECT name, periodicity, creation_date FROM habits WHERE user = ?", (self.user,))}
+                cur.execute("SELECT habitsName, check_off_date FROM habits_tracker WHERE user = ? "
+                            "ORDER BY habitsName, check_off_date", (self.user,))
+                for name, rows in groupby(cur, key=itemgetter(0)):
+                    habits[name].check_offs.extend(day for _, day in rows)
+            finally:
+                if started:
+                    self.db.commit()
+            self._snapshot = HabitSnapshot(habits, version)
+            self._data_version = data_version
+            self.reloads += 1
+
+    def refresh(self):
+        """
+        reloads the habits if another connection changed the habits of the user since they were read, otherwise this
+        is one PRAGMA statement
+        """
+        data_version = self.db.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version:
+            return
+        if get_data_version(self.db, user=self.user) != self._snapshot.version:
+            self.reload()
+        else:
+            self._data_version = data_version
+
+    def snapshot(self) -> HabitSnapshot:
+        """
+        :return: the current HabitSnapshot, after changes by other connections were detected
+        """
+        self.refresh()
+        return self._snapshot
+
+    def names(self, periodicity=None) -> list:
+        return self.snapshot().names(periodicity)
+
+    def periodicity(self, name: str):
+        return self.snapshot().periodicity(name)
+
+    def check_offs(self, name: str, start_date: dt.date = None, end_date: dt.date = None) -> array:
+        return self.snapshot().check_offs(name, start_date, end_date)
+
+    def count(self, name: str, start_date: dt.date = None, end_date: dt.date = None) -> int:
+        return self.snapshot().count(name, start_date, end_date)
+
+    def _apply(self, changes, user: str, changed: bool):
+        """
+        publishes the changes of a write as new snapshot. Every write that changed the database increments the data
+        version of the user by one, if it moved further, other connections wrote as well and the habits are reloaded.
+        A write that changed nothing does not move the version, so if it moved, only other connections wrote.
+
+        :param changes: function that returns the changes for the current snapshot, see HabitSnapshot.replace
+        :param user: user of the changed habits
+        :param changed: True if the write changed the database and incremented the data version
+        """
+        if user != self.user:
+            return
+        with self._lock:
+            snapshot = self._snapshot
+            version = get_data_version(self.db, user=self.user)
+            if version == snapshot.version:
+                return
+            if changed and version == snapshot.version + 1:
+                self._snapshot = snapshot.replace(changes(snapshot), version)
+                return
+        self.reload()
+
+    def added(self, name: str, periodicity, creation_date, user: str = DEFAULT_USER):
+        """
+        applies a habit that was added, see HabitTracker.store
+        """
+        habit = StoredHabit(normalise_periodicity(periodicity), str(creation_date), array(_TYPECODE))
+        self._apply(lambda snapshot: {name: habit}, user, True)
+
+    def checked_off(self, events, user: str = DEFAULT_USER, stored: bool = True):
+        """
+        applies check-offs that were stored in one transaction, dates that are already known are skipped like in
+        habit_db.increment_habits
+
+        :param events: iterable with (habit name, check-off date) pairs
+        :param user: user the habits belong to
+        :param stored: False if the transaction stored none of the check-offs, see habit_db.increment_habit
+        """
+        events = [(name, to_day_number(event_date)) for name, event_date in events]
+
+        def changes(snapshot):
+            changed = dict()
+            for name, day in events:
+                habit = changed.get(name) or snapshot.habit(name)
+                if habit is None:
+                    continue
+                index = bisect_left(habit.check_offs, day)
+                if index < len(habit.check_offs) and habit.check_offs[index] == day:
+                    continue
+                if name not in changed:
+                    # copy on write, the array of the published snapshot stays unchanged
+                    habit = changed[name] = habit._replace(check_offs=array(_TYPECODE, habit.check_offs))
+                habit.check_offs.insert(index, day)
+            return changed
+        self._apply(changes, user, stored)
+
+    def deleted(self, name: str, user: str = DEFAULT_USER, deleted: bool = True):
+        """
+        applies a habit that was deleted, see HabitTracker.delete_habit
+
+        :param deleted: False if the habit did not exist, see habit_db.delete_habit
+        """
+        self._apply(lambda snapshot: {name: None}, user, deleted)
@@ -1,21 +1,46 @@
-from habit_db import add_habit, increment_habit, delete_habit
+from clock import today
+from habit_db import DEFAULT_USER, add_habit, increment_habit, increment_habits_bulk, delete_habit
 from datetime import date
 
 
 class HabitTracker:
     """
-    HabitTracker class, enables to add a new habit, a new event, or delete a habit
+    HabitTracker class, enables to add a new habit, a new event, or delete a habit. If a habit_store.HabitStore is
+    given, the changes are applied to it as well. If a check_off_queue.CheckOffQueue is given, add_event queues the
+    check-off and returns before it is stored.
     """
 
-    def __init__(self, name: str, periodicity: int = None):
+    def __init__(self, name: str, periodicity: int = None, user: str = DEFAULT_USER, habit_store=None, queue=None):
         self.name = name
         self.periodicity = periodicity
+        self.user = user
+        self.habit_store = habit_store
+        self.queue = queue
 
     def store(self, db):
-        add_habit(db, self.name, self.periodicity)
+        creation_date = today()
+        add_habit(db, self.name, self.periodicity, creation_date, self.user)
+        if self.habit_store is not None:
+            self.habit_store.added(self.name, self.periodicity, creation_date, self.user)
 
     def add_event(self, db, event_date: date):
-        increment_habit(db, self.name, event_date)
+        if self.queue is not None:
+            # the store notices the check-off through PRAGMA data_version once the queue stored it
+            self.queue.put(self.name, event_date, self.user)
+            return
+        stored = increment_habit(db, self.name, event_date, self.user)
+        if self.habit_store is not None:
+            self.habit_store.checked_off([(self.name, event_date)], self.user, stored)
+
+    def add_events(self, db, event_dates, chunk_size: int = 10000):
+        result = increment_habits_bulk(db, ((self.name, event_date) for event_date in event_dates), chunk_size,
+                                       self.user)
+        if self.habit_store is not None:
+            # bulk imports change the data version once per chunk, the store reads the habits again
+            self.habit_store.reload()
+        return result
 
     def delete_habit(self, db):
-        delete_habit(db, self.name)
+        deleted = delete_habit(db, self.name, self.user)
+        if self.habit_store is not None:
+            self.habit_store.deleted(self.name, self.user, deleted)
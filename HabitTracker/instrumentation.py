@@ -0,0 +1,236 @@
+"""
+Instrumentation of the hot paths of habit_db and analyse_habits.
+
+Functions decorated with instrument and blocks wrapped in measure record their number of calls, their wall time and
+the SQL statements executed and rows fetched while they run. Statements and rows are counted on the connections
+opened with habit_db after instrumentation was enabled. While instrumentation is disabled (the default) a decorated
+function only costs one additional check per call.
+
+Profiling is switched on with the environment variable HABIT_PROFILE or the --profile and --profile-file options of
+main.py:
+
+    HABIT_PROFILE=1 python main.py streak             # prints a summary to stderr when the process exits
+    HABIT_PROFILE=streak.pstats python main.py streak  # also writes a cProfile file, see pstats
+
+Hooks receive every measurement, e.g. to forward the metrics to a collector:
+
+    add_hook(lambda name, seconds, statements, rows: collector.timing(name, seconds))
+"""
+import atexit
+import functools
+import os
+import sys
+import threading
+import time
+
+# file extensions that make start_profiling write a cProfile file
+PSTATS_EXTENSIONS = ('.pstats', '.prof')
+
+_enabled = False
+_stats = dict()
+_hooks = []
+_lock = threading.Lock()
+_local = threading.local()
+# state of start_profiling, the summary is registered once per process
+_profiler = None
+_pstats_file = None
+_report_registered = False
+
+
+class FunctionStats:
+    """
+    measurements of one instrumented function or block, wall time and counts include nested calls
+    """
+    __slots__ = ('name', 'calls', 'seconds', 'statements', 'rows')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.statements = 0
+        self.rows = 0
+
+    def __repr__(self):
+        return (f"FunctionStats(name={self.name!r}, calls={self.calls}, seconds={self.seconds:.6f}, "
+                f"statements={self.statements}, rows={self.rows})")
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def enable():
+    """
+    starts recording, connections that are opened from now on count their statements and rows
+    """
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def reset():
+    """
+    drops all measurements
+    """
+    with _lock:
+        _stats.clear()
+
+
+def add_hook(hook):
+    """
+    registers a function that is called after every measurement with the arguments name, seconds, statements and rows
+
+    :param hook: function
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def _active():
+    active = getattr(_local, 'active', None)
+    if active is None:
+        active = _local.active = []
+    return active
+
+
+class measure:
+    """
+    context manager that records a block like a call of an instrumented function, it does nothing while
+    instrumentation is disabled
+
+    with measure('analyse_habits.numpy'):
+        ...
+    """
+    __slots__ = ('name', '_start', '_counts')
+
+    def __init__(self, name: str):
+        self.name = name
+        self._counts = None
+
+    def __enter__(self):
+        if _enabled:
+            # statements and rows are counted into every block that is active, see _count
+            self._counts = [0, 0]
+            _active().append(self._counts)
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._counts is None:
+            return
+        seconds = time.perf_counter() - self._start
+        _active().pop()
+        statements, rows = self._counts
+        self._counts = None
+        with _lock:
+            stats = _stats.get(self.name)
+            if stats is None:
+                stats = _stats[self.name] = FunctionStats(self.name)
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.statements += statements
+            stats.rows += rows
+        for hook in _hooks:
+            hook(self.name, seconds, statements, rows)
+
+
+def instrument(function):
+    """
+    decorator that records the calls of a function, see measure
+    """
+    name = f'{function.__module__}.{function.__qualname__}'
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return function(*args, **kwargs)
+        with measure(name):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def _count(index: int):
+    for counts in getattr(_local, 'active', ()):
+        counts[index] += 1
+
+
+def _count_statement(statement):
+    _count(0)
+
+
+def _count_row(cursor, row):
+    _count(1)
+    return row
+
+
+def watch(db):
+    """
+    counts the statements and fetched rows of a connection while instrumentation is enabled, habit_db calls this for
+    every connection it opens
+
+    :param db: database connection
+    :return: the connection
+    """
+    if _enabled:
+        db.set_trace_callback(_count_statement)
+        db.row_factory = _count_row
+    return db
+
+
+def report():
+    """
+    :return: list with the FunctionStats of all measured functions, the slowest first
+    """
+    with _lock:
+        return sorted(_stats.values(), key=lambda stats: stats.seconds, reverse=True)
+
+
+def format_report() -> str:
+    """
+    :return: the measurements as text table
+    """
+    lines = [f"{'function':55} {'calls':>7} {'total ms':>10} {'mean ms':>9} {'statements':>10} {'rows':>9}"]
+    for stats in report():
+        lines.append(f"{stats.name:55} {stats.calls:7} {stats.seconds * 1000:10.2f} "
+                     f"{stats.seconds * 1000 / stats.calls:9.3f} {stats.statements:10} {stats.rows:9}")
+    return '\n'.join(lines)
+
+
+def start_profiling(pstats_file: str = None):
+    """
+    enables instrumentation and prints the summary to stderr when the process exits. Calling it again, e.g. when
+    HABIT_PROFILE is set and --profile is given, does not print the summary twice.
+
+    :param pstats_file: if provided, cProfile also runs and writes its statistics to this file, unless cProfile was
+    already started for another file
+    """
+    global _profiler, _pstats_file, _report_registered
+    enable()
+    with _lock:
+        if pstats_file and _profiler is None:
+            import cProfile
+            _profiler, _pstats_file = cProfile.Profile(), pstats_file
+            _profiler.enable()
+        if not _report_registered:
+            _report_registered = True
+            atexit.register(_write_report)
+
+
+def _write_report():
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_pstats_file)
+    print(format_report(), file=sys.stderr)
+
+
+# HABIT_PROFILE=1 prints the summary, a file name ending with .pstats or .prof also writes a cProfile file
+_profile = os.environ.get('HABIT_PROFILE', '0')
+if _profile not in ('', '0'):
+    start_profiling(_profile if _profile.endswith(PSTATS_EXTENSIONS) else None)
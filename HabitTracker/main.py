@@ -1,277 +1,193 @@
-import PyInquirer as pyi
-from analyse_habits import return_habit_names, return_number_of_habit_streaks, return_number_of_habit_resets
-from habit_tracker import HabitTracker
-from habit_db import get_db
-from prompt_toolkit.validation import Validator, ValidationError
+"""
+HabitTracker app. Without a command the interactive menu is started, with a command it runs non-interactively and
+prints the result as JSON, for example
+
+    python main.py add "Do Yoga" --periodicity 7
+    python main.py add "Read" --periodicity 3/7
+    python main.py checkoff "Do Yoga" 2022-06-01 2022-06-08
+    printf 'Do Yoga,2022-06-15\nStudy\n' | python main.py checkoff -
+    python main.py resets --days 30
+    python main.py --as-of 2022-06-24 resets Study
+    python main.py at-risk
+    python main.py --profile-file streak.pstats streak
+
+The interactive menu (menu.py) and PyInquirer are only imported when the menu is started.
+"""
+import argparse
+import csv
 import datetime as dt
+import json
+import sys
+from contextlib import nullcontext
 
+import commands
+import instrumentation
+from clock import fixed_clock, today
+from habit_db import DEFAULT_USER, get_db
+from habit_io import FILE_FORMATS
+from periods import normalise_periodicity
 
-class DateValidator(Validator):
-    """
-    checks whether an entered date is a valid date, if not throws an exception and tells the user to enter a valid date
-    """
-    def validate(self, document):
-        try:
-            dt.datetime.strptime(str(document.text), '%Y-%m-%d')
-        except ValueError:
-            raise ValidationError(
-                message='Please enter a valid date',
-                cursor_position=len(document.text))  # Move cursor to end
 
-
-def user_options():
+def _read_check_offs(lines, default_date: str):
     """
-    Asks the user what they want to do
-    :return: user answer
+    reads check-offs from lines in the form 'habit name[,YYYY-MM-DD]', lines without a date are checked off on
+    default_date, empty lines are skipped
     """
-    user_prompt = {
-        'type': 'list',
-        'name': 'input',
-        'message': 'What do you want to do?',
-        'choices': [
-            'Add a new habit',
-            'Check off a habit',
-            'Delete a habit',
-            'Analyse my habits',
-            'Exit'
-        ]
-    }
-    answers = pyi.prompt(user_prompt)
-    return answers['input']
+    for row in csv.reader(lines):
+        if row and row[0].strip():
+            yield row[0].strip(), row[1].strip() if len(row) > 1 and row[1].strip() else default_date
 
 
-def list_of_habits(answers=None):
+def check_off_events(arguments, stdin=None):
     """
-    returns a list of habits that already exist in the database and adds the options  'exit', if answers is set to True,
-     the option 'For all habits' will be added
+    turns the arguments of the checkoff command into (habit name, date) pairs
 
-    :return: list of options
+    :param arguments: argparse namespace of the checkoff command
+    :param stdin: file that is read if the habit name is '-', if not provided sys.stdin is used
+    :return: iterable with (habit name, date) pairs
     """
-    habit_names = return_habit_names(db)
-    habit_names.append('Exit')
-    if answers:
-        habit_names.insert(0, 'For all habits')
-    return habit_names
+    default_date = today().isoformat()
+    if arguments.name == '-':
+        return _read_check_offs(stdin or sys.stdin, default_date)
+    return [(arguments.name, date) for date in arguments.dates or [default_date]]
 
 
-def new_habit_input():
+def _periodicity(value: str):
     """
-    Asks the user to enter a new habit name and then in what periodicity they want to check it off, every day, or once a
-    week
-
-    :return: user answer
+    argparse type of the periodicity options, see periods.normalise_periodicity
     """
-    user_prompt = [
-        {
-            'type': 'input',
-            'name': 'new_habit_name',
-            'message': 'What\'s the name of your new habit?',
-        },
-        {
-            'type': 'list',
-            'name': 'new_habit_periodicity',
-            'message': 'How often would you like to perform this habit?',
-            'choices': ['Every day', 'Once a week']
+    try:
+        return normalise_periodicity(value)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error)) from None
 
-        }
-    ]
-    answers = pyi.prompt(user_prompt)
-    return answers
 
-
-def check_off_habit_input():
+def _date(value: str):
     """
-    Presents the user with their list of habits and asks them which of those they want to check-off, they can then
-    decide whether they want to check it off late (i.e. for a previous date). If yes, they need to enter this date.
-
-    :return: user answer
+    argparse type of dates in the form YYYY-MM-DD
     """
-    user_prompt = [
-        {
-            'type': 'list',
-            'name': 'input',
-            'message': 'Which habit would you like to check off?',
-            'choices': list_of_habits(),
-        },
-        {
-            'type': 'confirm',
-            'message': 'Do you want to check-off this habit late?',
-            'name': 'confirmation',
-            'default': False,
-            'when': lambda answers: answers['input'] != 'Exit',
-        },
-        {
-            'type': 'input',
-            'name': 'check_off_date',
-            'message': 'When did you complete this habit? (Please enter a date in the form YYYY-MM-DD)',
-            'when': lambda answers: answers['input'] != 'Exit' and answers['confirmation'],
-            'validate': DateValidator
-        }
-    ]
-    answers = pyi.prompt(user_prompt)
-    if answers['input'] == 'Exit':
-        main()
-    else:
-        return answers
+    try:
+        return dt.date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid date {value!r}, use the form YYYY-MM-DD') from None
 
 
-def delete_habit_input():
+def parse_arguments(argv=None):
     """
-    Presents the user with their list of habits and lets them chose which one of those they want to delete. Then the
-    user as to confirm that they really want to delete that habit.
+    reads the command line, without a command the interactive menu is started
 
-    :return: user answer
+    :param argv: command line arguments, if not provided sys.argv is used
+    :return: argparse namespace
     """
-    user_prompt = [
-        {
-            'type': 'list',
-            'name': 'input',
-            'message': 'Which habit would you like to delete?',
-            'choices': list_of_habits(),
-        },
-        {
-            'type': 'confirm',
-            'message': 'Are you sure you want to delete this habit?',
-            'name': 'confirmation',
-            'default': False,
-            'when': lambda answers: answers['input'] != 'Exit',
-        }
+    formats = sorted(set(FILE_FORMATS.values()))
+    parser = argparse.ArgumentParser(description='HabitTracker App, without a command the interactive menu is started')
+    parser.add_argument('--db', default='main.db', help='database file')
+    parser.add_argument('--user', default=DEFAULT_USER, help='user the habits belong to')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the calls, time and SQL statements of the database and analysis functions to '
+                             'stderr at exit')
+    parser.add_argument('--profile-file', metavar='FILE', help='like --profile and write a cProfile file, see pstats')
+    parser.add_argument('--as-of', metavar='YYYY-MM-DD', type=_date,
+                        help='run as if today was this date: analyses end on it and check-offs without a date are '
+                             'stored for it')
+    subcommands = parser.add_subparsers(dest='command')
 
-    ]
-    answers = pyi.prompt(user_prompt)
-    if answers['input'] == 'Exit':
-        main()
-    else:
-        return answers
+    add_parser = subcommands.add_parser('add', help='define a new habit')
+    add_parser.add_argument('name', help='habit name')
+    add_parser.add_argument('--periodicity', type=_periodicity, default=1,
+                            help="days per period (1 = daily, 7 = weekly), 'week' for calendar weeks, 'month' for "
+                                 "calendar months or 'times/days' for a quota, e.g. 3/7 = 3 times in 7 days")
 
+    check_off_parser = subcommands.add_parser('checkoff', help='check off a habit')
+    check_off_parser.add_argument('name', help="habit name, '-' reads lines 'habit name[,YYYY-MM-DD]' from stdin")
+    check_off_parser.add_argument('dates', nargs='*', help="dates in the form YYYY-MM-DD, default: today")
 
-def analyse_habit_input():
-    """
-    asks the user what the want to analyse about their habits
-
-    :return: user input
-    """
-    user_prompt = {
-        'type': 'list',
-        'name': 'input',
-        'message': 'What do you want to know?',
-        'choices': [
-            'What’s my longest habit streak?',
-            'What\'s the list of my current daily habits?',
-            'What\'s the list of my current weekly habits?',
-            'With which habit did I struggle most with last month?',
-            'Exit'
-        ]
-    }
-    answers = pyi.prompt(user_prompt)
-    return answers['input']
+    delete_parser = subcommands.add_parser('delete', help='delete a habit and its check-offs')
+    delete_parser.add_argument('name', help='habit name')
 
+    for command, help_text in (('streak', 'longest streak'), ('resets', 'number of missed periods')):
+        analyse_parser = subcommands.add_parser(command, help=f'{help_text} of a habit or of all habits')
+        analyse_parser.add_argument('name', nargs='?', help='habit name, default: all habits')
+        analyse_parser.add_argument('--days', type=int, help='only analyse the last days days')
+        analyse_parser.add_argument('--periodicity', type=_periodicity,
+                                    help='only analyse habits with this periodicity')
 
-def choice_habit_to_analyse():
-    """
-    presents a list of habits that can be analysed
+    at_risk_parser = subcommands.add_parser('at-risk', help='habits whose streak breaks if they are not checked off '
+                                                            'in the current period')
+    at_risk_parser.add_argument('--periodicity', type=_periodicity,
+                                help='only list habits with this periodicity')
 
-    :return: user input
-    """
-    user_prompt = {
-        'type': 'list',
-        'name': 'input',
-        'message': 'For which habit would you like to know?',
-        'choices': list_of_habits(True)
-    }
-    answers = pyi.prompt(user_prompt)
-    return answers['input']
+    list_parser = subcommands.add_parser('list', help='list the habits')
+    list_parser.add_argument('--periodicity', type=_periodicity,
+                             help='only list habits with this periodicity')
 
+    export_parser = subcommands.add_parser('export', help='write the history of all habits to a file')
+    export_parser.add_argument('file', help=f'file to write, the extension selects the format: {FILE_FORMATS}')
+    export_parser.add_argument('--format', choices=formats, help='format of the file, overrides the extension')
+    export_parser.add_argument('--all-users', action='store_true', help='export the habits of all users')
 
-def ask_to_continue():
-    """
-    Asks the user whether they want to do perform any other action or not.
-    :return: user input
-    """
-    user_prompt = {
-        'type': 'confirm',
-        'message': 'Do you want to perform any other action?',
-        'name': 'confirmation',
-        'default': True,
-    }
-    answers = pyi.prompt(user_prompt)
-    if answers['confirmation']:
-        main()
-    else:
-        print('Alright! See you next time.')
+    import_parser = subcommands.add_parser('import', help='read habits and check-offs from an exported file')
+    import_parser.add_argument('file', help='file to read, the extension selects the format')
+    import_parser.add_argument('--format', choices=formats, help='format of the file, overrides the extension')
+    return parser.parse_args(argv)
 
 
-def main():
-    user_input = user_options()
-    if user_input == 'Add a new habit':
-        data = new_habit_input()
-        name = data['new_habit_name']
-        periodicity = 0
-        if data['new_habit_periodicity'] == 'Every day':
-            periodicity = 1
-        elif data['new_habit_periodicity'] == 'Once a week':
-            periodicity = 7
-        tracker = HabitTracker(name, periodicity)
-        tracker.store(db)
-        ask_to_continue()
-    elif user_input == 'Check off a habit':
-        data = check_off_habit_input()
-        try:
-            name = data['input']
-        except TypeError:
-            pass
-        else:
-            if data['confirmation']:
-                check_off_date = data['check_off_date']
-            else:
-                check_off_date = dt.date.today().strftime("%Y-%m-%d")
-            tracker = HabitTracker(name)
-            tracker.add_event(db, check_off_date)
-            ask_to_continue()
-    elif user_input == 'Delete a habit':
-        answer = delete_habit_input()
-        if answer['input'] == 'Exit':
-            main()
-        else:
-            habit_to_be_deleted = answer['input']
-            if answer['confirmation']:
-                tracker = HabitTracker(habit_to_be_deleted)
-                tracker.delete_habit(db)
-                print(f'The habit: "{habit_to_be_deleted}" has been deleted successfully ')
-                ask_to_continue()
-            elif not answer['confirmation']:
-                print(f'Ok,"{habit_to_be_deleted}" will not be deleted, you will be redirected to the main menu')
-                main()
-    elif user_input == 'Analyse my habits':
-        analyse = analyse_habit_input()
-        if analyse == 'What’s my longest habit streak?':
-            choice = choice_habit_to_analyse()
-            if choice == 'For all habits':
-                data = return_number_of_habit_streaks(db)
-                names = list(data[0])
-                print(f"The longest habit streak for your habit(s) '{' and '.join([str(x) for x in [*names]])}' "
-                      f"was: ", data[1])
+def run_command(db, arguments):
+    """
+    executes a command of the command line interface
 
-            elif choice == 'Exit':
-                main()
-            else:
-                number = return_number_of_habit_streaks(db, choice)
-                print(f'The longest habit streak for your habit "{choice}" was: ', number[1])
-        if analyse == 'What\'s the list of my current daily habits?':
-            print('Your current daily habits are:', *return_habit_names(db, 1), sep="\n")
-        if analyse == 'What\'s the list of my current weekly habits?':
-            print('Your current weekly habits are:', *return_habit_names(db, 7), sep="\n")
-        if analyse == 'With which habit did I struggle most with last month?':
-            data = return_number_of_habit_resets(db, time_interval=30)
-            names = list(data[0])
-            print(f"During the last month you struggled most with your habit(s) "
-                  f"'{' and '.join([str(x) for x in [*names]])}', you missed it {data[1]} times")
-        ask_to_continue()
-    else:
-        print('Goodbye! See you next time')
+    :param db: database where the data is stored
+    :param arguments: argparse namespace, see parse_arguments
+    :return: result of the command, see commands
+    """
+    user = arguments.user
+    if arguments.command == 'add':
+        return commands.add(db, arguments.name, arguments.periodicity, user)
+    if arguments.command == 'checkoff':
+        return commands.check_off(db, check_off_events(arguments), user)
+    if arguments.command == 'delete':
+        return commands.delete(db, arguments.name, user)
+    if arguments.command == 'streak':
+        return commands.streak(db, arguments.name, arguments.days, arguments.periodicity, user)
+    if arguments.command == 'resets':
+        return commands.resets(db, arguments.name, arguments.days, arguments.periodicity, user)
+    if arguments.command == 'at-risk':
+        return commands.at_risk(db, arguments.periodicity, user)
+    if arguments.command == 'list':
+        return commands.habit_list(db, arguments.periodicity, user)
+    if arguments.command == 'export':
+        return commands.export(db, arguments.file, arguments.format, None if arguments.all_users else user)
+    return commands.import_history(db, arguments.file, arguments.format)
+
+
+def main(argv=None):
+    """
+    runs a command or the interactive menu
+
+    :param argv: command line arguments, if not provided sys.argv is used
+    :return: exit code
+    """
+    arguments = parse_arguments(argv)
+    if arguments.profile or arguments.profile_file:
+        instrumentation.start_profiling(arguments.profile_file)
+    db = get_db(arguments.db)
+    try:
+        with fixed_clock(arguments.as_of) if arguments.as_of else nullcontext():
+            if arguments.command is None:
+                import menu
+                print("Welcome to your HabitTracker App!")
+                menu.run(db, arguments.user)
+                return 0
+            try:
+                result = run_command(db, arguments)
+            except commands.CommandError as error:
+                print(json.dumps({'error': str(error)}))
+                return 1
+            print(json.dumps(result))
+            return 0
+    finally:
+        db.close()
 
 
 if __name__ == '__main__':
-    db = get_db()
-    print("Welcome to your HabitTracker App!")
-    main()
+    sys.exit(main())
@@ -0,0 +1,299 @@
+"""
+Interactive menu of the HabitTracker app, started by main.py when no command is given. The menu runs in a loop until
+the user exits and executes the same commands as the command line interface.
+"""
+import PyInquirer as pyi
+from prompt_toolkit.validation import Validator, ValidationError
+import datetime as dt
+
+import commands
+from clock import today
+from analyse_habits import return_habit_names
+from habit_db import DEFAULT_USER
+from habit_store import HabitStore
+from periods import MONTH, WEEK
+
+# periodicities that can be chosen for a new habit, see periods
+PERIODICITY_CHOICES = {
+    'Every day': 1,
+    'Once a week': 7,
+    'Once a calendar week (Monday to Sunday)': WEEK,
+    'Once a calendar month': MONTH,
+    'Three times a week': '3/7',
+}
+
+
+class DateValidator(Validator):
+    """
+    checks whether an entered date is a valid date, if not throws an exception and tells the user to enter a valid date
+    """
+    def validate(self, document):
+        try:
+            dt.datetime.strptime(str(document.text), '%Y-%m-%d')
+        except ValueError:
+            raise ValidationError(
+                message='Please enter a valid date',
+                cursor_position=len(document.text))  # Move cursor to end
+
+
+def user_options():
+    """
+    Asks the user what they want to do
+    :return: user answer
+    """
+    user_prompt = {
+        'type': 'list',
+        'name': 'input',
+        'message': 'What do you want to do?',
+        'choices': [
+            'Add a new habit',
+            'Check off a habit',
+            'Delete a habit',
+            'Analyse my habits',
+            'Exit'
+        ]
+    }
+    answers = pyi.prompt(user_prompt)
+    return answers['input']
+
+
+def list_of_habits(db, answers=None, user: str = DEFAULT_USER, store=None):
+    """
+    returns a list of habits that already exist in the database and adds the options  'exit', if answers is set to True,
+     the option 'For all habits' will be added. If a HabitStore is given, the habits are read from it.
+
+    :return: list of options
+    """
+    habit_names = store.names() if store is not None else return_habit_names(db, user=user)
+    habit_names.append('Exit')
+    if answers:
+        habit_names.insert(0, 'For all habits')
+    return habit_names
+
+
+def new_habit_input():
+    """
+    Asks the user to enter a new habit name and then in what periodicity they want to check it off, every day, or once a
+    week
+
+    :return: user answer
+    """
+    user_prompt = [
+        {
+            'type': 'input',
+            'name': 'new_habit_name',
+            'message': 'What\'s the name of your new habit?',
+        },
+        {
+            'type': 'list',
+            'name': 'new_habit_periodicity',
+            'message': 'How often would you like to perform this habit?',
+            'choices': list(PERIODICITY_CHOICES)
+
+        }
+    ]
+    answers = pyi.prompt(user_prompt)
+    return answers
+
+
+def check_off_habit_input(db, user: str = DEFAULT_USER, store=None):
+    """
+    Presents the user with their list of habits and asks them which of those they want to check-off, they can then
+    decide whether they want to check it off late (i.e. for a previous date). If yes, they need to enter this date.
+
+    :return: user answer, None if the user chose 'Exit'
+    """
+    user_prompt = [
+        {
+            'type': 'list',
+            'name': 'input',
+            'message': 'Which habit would you like to check off?',
+            'choices': list_of_habits(db, user=user, store=store),
+        },
+        {
+            'type': 'confirm',
+            'message': 'Do you want to check-off this habit late?',
+            'name': 'confirmation',
+            'default': False,
+            'when': lambda answers: answers['input'] != 'Exit',
+        },
+        {
+            'type': 'input',
+            'name': 'check_off_date',
+            'message': 'When did you complete this habit? (Please enter a date in the form YYYY-MM-DD)',
+            'when': lambda answers: answers['input'] != 'Exit' and answers['confirmation'],
+            'validate': DateValidator
+        }
+    ]
+    answers = pyi.prompt(user_prompt)
+    if answers['input'] == 'Exit':
+        return None
+    return answers
+
+
+def delete_habit_input(db, user: str = DEFAULT_USER, store=None):
+    """
+    Presents the user with their list of habits and lets them chose which one of those they want to delete. Then the
+    user as to confirm that they really want to delete that habit.
+
+    :return: user answer
+    """
+    user_prompt = [
+        {
+            'type': 'list',
+            'name': 'input',
+            'message': 'Which habit would you like to delete?',
+            'choices': list_of_habits(db, user=user, store=store),
+        },
+        {
+            'type': 'confirm',
+            'message': 'Are you sure you want to delete this habit?',
+            'name': 'confirmation',
+            'default': False,
+            'when': lambda answers: answers['input'] != 'Exit',
+        }
+
+    ]
+    answers = pyi.prompt(user_prompt)
+    return answers
+
+
+def analyse_habit_input():
+    """
+    asks the user what the want to analyse about their habits
+
+    :return: user input
+    """
+    user_prompt = {
+        'type': 'list',
+        'name': 'input',
+        'message': 'What do you want to know?',
+        'choices': [
+            'What’s my longest habit streak?',
+            'What\'s the list of my current daily habits?',
+            'What\'s the list of my current weekly habits?',
+            'With which habit did I struggle most with last month?',
+            'Exit'
+        ]
+    }
+    answers = pyi.prompt(user_prompt)
+    return answers['input']
+
+
+def choice_habit_to_analyse(db, user: str = DEFAULT_USER, store=None):
+    """
+    presents a list of habits that can be analysed
+
+    :return: user input
+    """
+    user_prompt = {
+        'type': 'list',
+        'name': 'input',
+        'message': 'For which habit would you like to know?',
+        'choices': list_of_habits(db, True, user, store)
+    }
+    answers = pyi.prompt(user_prompt)
+    return answers['input']
+
+
+def ask_to_continue():
+    """
+    Asks the user whether they want to do perform any other action or not.
+    :return: True if the user wants to continue
+    """
+    user_prompt = {
+        'type': 'confirm',
+        'message': 'Do you want to perform any other action?',
+        'name': 'confirmation',
+        'default': True,
+    }
+    answers = pyi.prompt(user_prompt)
+    if not answers['confirmation']:
+        print('Alright! See you next time.')
+    return answers['confirmation']
+
+
+def run_action(db, user_input: str, user: str = DEFAULT_USER, store=None):
+    """
+    executes the action the user chose in the main menu
+
+    :param db: database where the data is stored
+    :param user_input: answer of user_options
+    :param user: user the habits belong to
+    :param store: habit_store.HabitStore of the user, the lists of habits are read from it
+    :return: True if the user should be asked whether they want to continue, False to show the main menu again
+    """
+    if user_input == 'Add a new habit':
+        data = new_habit_input()
+        commands.add(db, data['new_habit_name'], PERIODICITY_CHOICES[data['new_habit_periodicity']], user, store)
+        return True
+    if user_input == 'Check off a habit':
+        data = check_off_habit_input(db, user, store)
+        if data is None:
+            return False
+        if data['confirmation']:
+            check_off_date = data['check_off_date']
+        else:
+            check_off_date = today().strftime("%Y-%m-%d")
+        commands.check_off(db, [(data['input'], check_off_date)], user, store)
+        return True
+    if user_input == 'Delete a habit':
+        answer = delete_habit_input(db, user, store)
+        if answer['input'] == 'Exit':
+            return False
+        habit_to_be_deleted = answer['input']
+        if not answer['confirmation']:
+            print(f'Ok,"{habit_to_be_deleted}" will not be deleted, you will be redirected to the main menu')
+            return False
+        commands.delete(db, habit_to_be_deleted, user, store)
+        print(f'The habit: "{habit_to_be_deleted}" has been deleted successfully ')
+        return True
+
+    analyse = analyse_habit_input()
+    if analyse == 'What’s my longest habit streak?':
+        choice = choice_habit_to_analyse(db, user, store)
+        if choice == 'Exit':
+            return False
+        if choice == 'For all habits':
+            data = commands.streak(db, user=user)
+            print(f"The longest habit streak for your habit(s) '{' and '.join(data['habits'])}' "
+                  f"was: ", data['longest_streak'])
+        else:
+            data = commands.streak(db, choice, user=user)
+            print(f'The longest habit streak for your habit "{choice}" was: ', data['longest_streak'])
+    if analyse == 'What\'s the list of my current daily habits?':
+        print('Your current daily habits are:', *commands.habit_list(db, None, user, store, length=1)['habits'],
+              sep="\n")
+    if analyse == 'What\'s the list of my current weekly habits?':
+        # habits with weekly periods: 7 days, calendar weeks and quotas like '3/7'
+        print('Your current weekly habits are:', *commands.habit_list(db, None, user, store, length=7)['habits'],
+              sep="\n")
+    if analyse == 'With which habit did I struggle most with last month?':
+        end_date = today()
+        data = commands.resets(db, user=user, start_date=end_date - dt.timedelta(days=30), end_date=end_date)
+        print(f"During the last month you struggled most with your habit(s) "
+              f"'{' and '.join(data['habits'])}', you missed it {data['resets']} times")
+    return True
+
+
+def run(db, user: str = DEFAULT_USER):
+    """
+    shows the main menu until the user exits, the habits are loaded once into a HabitStore
+
+    :param db: database where the data is stored
+    :param user: user the habits belong to
+    :return: None
+    """
+    store = HabitStore(db, user)
+    while True:
+        user_input = user_options()
+        if user_input == 'Exit':
+            print('Goodbye! See you next time')
+            return
+        try:
+            ask = run_action(db, user_input, user, store)
+        except commands.CommandError as error:
+            print(f'Sorry, {error}')
+            ask = True
+        if ask and not ask_to_continue():
+            return
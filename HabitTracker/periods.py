@@ -0,0 +1,330 @@
+"""
+Period engine: the rules that split the calendar into the periods in which a habit has to be completed.
+
+The periodicity of a habit is stored in the periodicity column of the habits table, either as number of days or as
+text for the other rules:
+
+    7        periods of 7 days, the first one starts with the first check-off of the habit
+    'week'   ISO calendar weeks, Monday to Sunday
+    'month'  calendar months
+    '3/7'    3 of 7 days: periods of 7 days like 7, a period is completed once the habit was checked off on 3 days
+
+Every rule maps a day ordinal to the index of its period and a period index to its first day in O(1), so the check-offs
+of a habit are bucketed into periods with one merge pass over the sorted check-offs and the period boundaries,
+whatever the rule is.
+"""
+from __future__ import annotations
+
+import datetime as dt
+
+from streaks import EPOCH_ORDINAL, PeriodGrid, StreakSummary, np, summarise
+
+WEEK = 'week'
+MONTH = 'month'
+
+
+class PeriodRule:
+    """
+    base class of the period rules. Periods are numbered with absolute indices, index(start(i)) == i
+
+    spec: the periodicity as it is stored in the database
+    required: number of days with a check-off that complete a period
+    anchored: True if the periods start with the first check-off of a habit, False if they are aligned to the calendar
+    """
+    spec = None
+    required = 1
+    anchored = False
+
+    def index(self, day: int) -> int:
+        """
+        :param day: day ordinal
+        :return: index of the period that contains the day
+        """
+        raise NotImplementedError
+
+    def start(self, index: int) -> int:
+        """
+        :param index: period index
+        :return: day ordinal of the first day of the period
+        """
+        raise NotImplementedError
+
+    def indices(self, days: np.ndarray) -> np.ndarray:
+        """
+        :param days: array with day ordinals
+        :return: array with the indices of the periods that contain the days
+        """
+        return np.fromiter((self.index(int(day)) for day in days), dtype=np.int64, count=len(days))
+
+    def starts(self, first: int, count: int) -> np.ndarray:
+        """
+        :param first: index of the first period
+        :param count: number of periods
+        :return: array with the first days of count consecutive periods
+        """
+        return np.fromiter((self.start(index) for index in range(first, first + count)), dtype=np.int64, count=count)
+
+    def expected(self, first: int, last: int) -> float:
+        """
+        returns the number of check-offs that complete all periods on the days from first to last, a period that
+        only partly lies within these days counts with the part of its days, used for completion rates
+
+        :param first: day ordinal of the first day
+        :param last: day ordinal of the last day
+        :return: number of check-offs
+        """
+        expected = 0.0
+        for index in range(self.index(first), self.index(last) + 1):
+            start, end = self.start(index), self.start(index + 1)
+            expected += self.required * (min(last + 1, end) - max(first, start)) / (end - start)
+        return expected
+
+    def at(self, day: int):
+        """
+        returns the rule whose first period starts on day, rules that are aligned to the calendar are returned as they
+        are
+
+        :param day: day ordinal, normally the first check-off or the start of the analysed window
+        :return: PeriodRule
+        """
+        return self
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__dict__ == other.__dict__
+
+    def __hash__(self):
+        return hash((type(self), tuple(self.__dict__.items())))
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.spec!r})"
+
+
+class EveryNDays(PeriodRule):
+    """
+    periods of days days, period 0 starts on the day ordinal origin
+    """
+    anchored = True
+
+    def __init__(self, days: int, origin: int = 0):
+        if days < 1:
+            raise ValueError(f'a period has at least one day, not {days}')
+        self.days = days
+        self.origin = origin
+
+    @property
+    def spec(self):
+        return self.days
+
+    def expected(self, first: int, last: int) -> float:
+        return self.required * (last - first + 1) / self.days
+
+    def index(self, day: int) -> int:
+        return (day - self.origin) // self.days
+
+    def start(self, index: int) -> int:
+        return self.origin + index * self.days
+
+    def indices(self, days: np.ndarray) -> np.ndarray:
+        return (days - self.origin) // self.days
+
+    def starts(self, first: int, count: int) -> np.ndarray:
+        return self.origin + np.arange(first, first + count, dtype=np.int64) * self.days
+
+    def at(self, day: int):
+        return type(self)(self.days, day)
+
+
+class Quota(EveryNDays):
+    """
+    times of days days: periods of days days, a period is completed by check-offs on times different days
+    """
+
+    def __init__(self, times: int, days: int, origin: int = 0):
+        super().__init__(days, origin)
+        if not 1 <= times <= days:
+            raise ValueError(f'a quota of {times} of {days} days can not be met')
+        self.times = times
+
+    @property
+    def spec(self):
+        return f'{self.times}/{self.days}'
+
+    @property
+    def required(self):
+        return self.times
+
+    def at(self, day: int):
+        return type(self)(self.times, self.days, day)
+
+
+class IsoWeek(PeriodRule):
+    """
+    ISO calendar weeks, the day ordinal 1 (0001-01-01) is a Monday
+    """
+    spec = WEEK
+
+    def index(self, day: int) -> int:
+        return (day - 1) // 7
+
+    def start(self, index: int) -> int:
+        return index * 7 + 1
+
+    def indices(self, days: np.ndarray) -> np.ndarray:
+        return (days - 1) // 7
+
+    def starts(self, first: int, count: int) -> np.ndarray:
+        return np.arange(first, first + count, dtype=np.int64) * 7 + 1
+
+
+class CalendarMonth(PeriodRule):
+    """
+    calendar months, the index counts the months since year 0
+    """
+    spec = MONTH
+
+    def index(self, day: int) -> int:
+        date = dt.date.fromordinal(day)
+        return date.year * 12 + date.month - 1
+
+    def start(self, index: int) -> int:
+        year, month = divmod(index, 12)
+        return dt.date(year, month + 1, 1).toordinal()
+
+    def indices(self, days: np.ndarray) -> np.ndarray:
+        months = (np.asarray(days, dtype=np.int64) - EPOCH_ORDINAL).astype('datetime64[D]').astype('datetime64[M]')
+        return months.astype(np.int64) + 1970 * 12
+
+    def starts(self, first: int, count: int) -> np.ndarray:
+        months = np.arange(first - 1970 * 12, first - 1970 * 12 + count, dtype=np.int64).astype('datetime64[M]')
+        return months.astype('datetime64[D]').astype(np.int64) + EPOCH_ORDINAL
+
+
+def normalise_periodicity(value):
+    """
+    checks a periodicity and converts it into the form that is stored in the database
+
+    :param value: number of days as int or string, 'week', 'month' or a quota in the form 'times/days'
+    :return: int for periods of a number of days, otherwise the rule as string
+    """
+    return parse_periodicity(value).spec
+
+
+def period_length(value):
+    """
+    :param value: periodicity as stored in the database or as entered by the user
+    :return: number of days of every period, e.g. 7 for 7, 'week' and '3/7', None for calendar months
+    """
+    rule = parse_periodicity(value)
+    if isinstance(rule, EveryNDays):
+        return rule.days
+    if isinstance(rule, IsoWeek):
+        return 7
+    return None
+
+
+def parse_periodicity(value) -> PeriodRule:
+    """
+    returns the rule of a periodicity, see the module documentation
+
+    :param value: periodicity as stored in the database or as entered by the user
+    :return: PeriodRule, periods of days days start on the day ordinal 0 until they are moved with PeriodRule.at
+    """
+    if isinstance(value, PeriodRule):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, int):
+        return EveryNDays(value)
+    text = str(value).strip().lower()
+    if text == WEEK:
+        return IsoWeek()
+    if text == MONTH:
+        return CalendarMonth()
+    error = f"invalid periodicity {value!r}, use a number of days, '{WEEK}', '{MONTH}' or 'times/days'"
+    try:
+        numbers = [int(number) for number in text.split('/')]
+    except ValueError:
+        raise ValueError(error) from None
+    if len(numbers) == 1:
+        return EveryNDays(numbers[0])
+    if len(numbers) == 2:
+        return Quota(*numbers)
+    raise ValueError(error)
+
+
+def period_counts(check_offs: np.ndarray, rule: PeriodRule, first: int, periods: int) -> np.ndarray:
+    """
+    counts the check-offs in every period with one merge pass over the sorted check-offs and the sorted period
+    boundaries
+
+    :param check_offs: sorted array with unique check-off day ordinals
+    :param rule: PeriodRule
+    :param first: index of the first period
+    :param periods: number of periods
+    :return: array with the number of check-offs per period
+    """
+    boundaries = rule.starts(first, periods + 1)
+    return np.diff(np.searchsorted(check_offs, boundaries))
+
+
+def completed_periods(check_offs: np.ndarray, rule: PeriodRule, first: int, periods: int) -> np.ndarray:
+    """
+    :param check_offs: sorted array with unique check-off day ordinals
+    :param rule: PeriodRule
+    :param first: index of the first period
+    :param periods: number of periods
+    :return: Boolean array with one entry per period, True if the period was completed
+    """
+    return period_counts(check_offs, rule, first, periods) >= rule.required
+
+
+def completed_indices(days, rule: PeriodRule):
+    """
+    walks once through sorted check-offs and yields the index of every period as soon as it is completed, used where
+    the check-offs are read from the database one by one
+
+    :param days: iterable with sorted unique check-off day ordinals
+    :param rule: PeriodRule
+    :return: generator of period indices in ascending order
+    """
+    period, count = None, 0
+    for day in days:
+        index = rule.index(day)
+        if index != period:
+            period, count = index, 0
+        count += 1
+        if count == rule.required:
+            yield index
+
+
+def rule_grid(first_check_off: int, start: int, end: int, rule: PeriodRule) -> PeriodGrid:
+    """
+    computes the periods of a habit within a window like streaks.period_grid: periods begin with the period that
+    contains the later of the window start and the first check-off, anchored rules start their first period on that
+    day
+
+    :param first_check_off: day ordinal of the first check-off, None if the habit has never been checked off
+    :param start: day ordinal of the first day of the window
+    :param end: day ordinal of the last day of the window
+    :param rule: PeriodRule of the habit
+    :return: PeriodGrid with the rule as periodicity, without periods if the habit was first checked off after the
+    window
+    """
+    if first_check_off is None or first_check_off > end:
+        return PeriodGrid(start, rule.at(start), 0)
+    grid_start = max(start, first_check_off)
+    rule = rule.at(grid_start)
+    first = rule.index(grid_start)
+    return PeriodGrid(rule.start(first), rule, rule.index(end) - first + 1)
+
+
+def analyse_rule(check_offs: np.ndarray, grid: PeriodGrid) -> StreakSummary:
+    """
+    computes completion vector, longest streak, current streak and reset count of a habit with a PeriodRule
+
+    :param check_offs: sorted array with unique check-off day ordinals
+    :param grid: PeriodGrid returned by rule_grid
+    :return: StreakSummary
+    """
+    rule = grid.periodicity
+    return summarise(completed_periods(check_offs, rule, rule.index(grid.start), grid.periods))
@@ -0,0 +1,363 @@
+from __future__ import annotations
+
+import datetime as dt
+import importlib.util
+import sys
+from collections.abc import Mapping
+from typing import NamedTuple
+
+
+def lazy_import(name: str):
+    """
+    returns a module that is only executed when one of its attributes is accessed for the first time, so importing
+    this module does not slow down the start of the app
+
+    :param name: name of the module
+    :return: module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+np = lazy_import('numpy')
+
+# numpy counts datetime64[D] values from 1970-01-01, python's date ordinals from 0001-01-01
+EPOCH_ORDINAL = dt.date(1970, 1, 1).toordinal()
+
+
+class StreakSummary(NamedTuple):
+    """
+    result of the streak engine for one habit
+
+    completed: Boolean array with one entry per period, True if the habit was checked off in that period, None if the
+    summary was computed without it
+    longest_streak: longest run of consecutive completed periods
+    current_streak: run of completed periods that is still going on, the ongoing (last) period may still be open
+    resets: number of periods in which the habit was not completed
+    """
+    completed: np.ndarray
+    longest_streak: int
+    current_streak: int
+    resets: int
+
+
+def _period_start(start: int, periodicity, index: int) -> int:
+    """
+    first day of the period index, counted from the period that starts on the day ordinal start
+
+    :param periodicity: length of a period in days or a rule of the period engine, see periods.PeriodRule
+    """
+    if isinstance(periodicity, int):
+        return start + index * periodicity
+    return periodicity.start(periodicity.index(start) + index)
+
+
+def _period_offset(start: int, periodicity, day: int):
+    """
+    :return: tuple with the index of the period that contains day, counted from the period that starts on the day
+    ordinal start, and the number of days between the first day of that period and day
+    """
+    if isinstance(periodicity, int):
+        return divmod(day - start, periodicity)
+    index = periodicity.index(day)
+    return index - periodicity.index(start), day - periodicity.start(index)
+
+
+class PeriodGrid(NamedTuple):
+    """
+    the periods that are analysed for a habit: periods consecutive periods, the first one starts on the day ordinal
+    start. periodicity is the length of a period in days or, for calendar and quota periods, a periods.PeriodRule
+    """
+    start: int
+    periodicity: int
+    periods: int
+
+    def period_start(self, index: int) -> int:
+        return _period_start(self.start, self.periodicity, index)
+
+
+def period_grid(first_check_off: int, start: int, end: int, periodicity: int) -> PeriodGrid:
+    """
+    computes the periods of a habit within a window in O(1): periods begin at the later of the window start and the
+    first check-off of the habit and run until the period that contains the end of the window
+
+    :param first_check_off: day ordinal of the first check-off, None if the habit has never been checked off
+    :param start: day ordinal of the first day of the window
+    :param end: day ordinal of the last day of the window
+    :param periodicity: length of a period in days
+    :return: PeriodGrid, without periods if the habit was first checked off after the window
+    """
+    if first_check_off is None or first_check_off > end:
+        return PeriodGrid(start, periodicity, 0)
+    grid_start = max(start, first_check_off)
+    return PeriodGrid(grid_start, periodicity, (end - grid_start) // periodicity + 1)
+
+
+def missed_summary(periods: int) -> StreakSummary:
+    """
+    StreakSummary of periods periods in which the habit was never checked off, computed without a completion vector
+
+    :param periods: number of periods
+    :return: StreakSummary, completed is None
+    """
+    return StreakSummary(None, 0, 0, periods)
+
+
+def to_ordinals(dates) -> np.ndarray:
+    """
+    converts check-off dates into a sorted array of day ordinals (see dt.date.toordinal)
+
+    :param dates: iterable with check-off dates, either day ordinals, dt.date objects or strings in the form YYYY-MM-DD
+    :return: sorted numpy array with unique day ordinals
+    """
+    dates = list(dates)
+    if dates and isinstance(dates[0], int):
+        return np.unique(np.asarray(dates, dtype=np.int64))
+    days = np.asarray(dates, dtype='datetime64[D]')
+    return np.unique(days.astype(np.int64) + EPOCH_ORDINAL)
+
+
+def completion_vector(check_offs: np.ndarray, start: int, end: int, periodicity: int) -> np.ndarray:
+    """
+    computes for every period between start and end whether the habit was checked off in that period
+
+    :param check_offs: array with check-off day ordinals
+    :param start: day ordinal of the first day of the first period
+    :param end: day ordinal of the last day that is analysed (normally today), the last period is the one containing it
+    :param periodicity: length of a period in days
+    :return: Boolean array with one entry per period
+    """
+    if end < start:
+        return np.zeros(0, dtype=bool)
+    completed = np.zeros((end - start) // periodicity + 1, dtype=bool)
+    check_offs = check_offs[(check_offs >= start) & (check_offs <= end)]
+    completed[(check_offs - start) // periodicity] = True
+    return completed
+
+
+def summarise(completed: np.ndarray) -> StreakSummary:
+    """
+    derives the longest streak, the current streak and the reset count from a completion vector
+
+    :param completed: Boolean array with one entry per period
+    :return: StreakSummary
+    """
+    completed = np.asarray(completed, dtype=bool)
+    periods = completed.size
+    # the edges of the padded vector mark where runs of completed periods start and end
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], completed.view(np.int8), [0]))))
+    run_starts, run_ends = edges[::2], edges[1::2]
+    run_lengths = run_ends - run_starts
+
+    longest_streak = int(run_lengths.max()) if run_lengths.size else 0
+    current_streak = 0
+    # a streak is still alive while the ongoing period has not been checked off yet
+    if run_lengths.size and run_ends[-1] >= periods - 1:
+        current_streak = int(run_lengths[-1])
+    resets = periods - int(np.count_nonzero(completed))
+    return StreakSummary(completed, longest_streak, current_streak, resets)
+
+
+def analyse_check_offs(check_offs: np.ndarray, start: int, end: int, periodicity: int) -> StreakSummary:
+    """
+    computes completion vector, longest streak, current streak and reset count for a habit in one go
+
+    :param check_offs: array with check-off day ordinals
+    :param start: day ordinal of the first day of the first period
+    :param end: day ordinal of the last day that is analysed
+    :param periodicity: length of a period in days
+    :return: StreakSummary
+    """
+    return summarise(completion_vector(check_offs, start, end, periodicity))
+
+
+class StreakAccumulator:
+    """
+    online streak engine: check-offs are added one by one in ascending order and only the state of the current period
+    and of the current run is kept, so the memory does not depend on the number of check-offs. The result is the same
+    as the one of analyse_check_offs for the same periods, without the completion vector.
+    """
+    __slots__ = ('grid', '_required', '_period', '_count', '_last_completed', '_run', '_longest', '_completed')
+
+    def __init__(self, grid: PeriodGrid):
+        """
+        :param grid: periods that are analysed, its periodicity is a number of days or a periods.PeriodRule
+        """
+        self.grid = grid
+        self._required = getattr(grid.periodicity, 'required', 1)
+        self._period = self._last_completed = -1
+        self._count = self._run = self._longest = self._completed = 0
+
+    def update(self, days):
+        """
+        adds check-offs, every day must be later than the days that were added before and lie within the grid
+
+        :param days: iterable with ascending unique day ordinals
+        """
+        start, periodicity, required = self.grid.start, self.grid.periodicity, self._required
+        period, count, last_completed, run = self._period, self._count, self._last_completed, self._run
+        if isinstance(periodicity, int):
+            indices = ((day - start) // periodicity for day in days)
+        else:
+            first = periodicity.index(start)
+            indices = (periodicity.index(day) - first for day in days)
+        for index in indices:
+            if index != period:
+                period, count = index, 0
+            count += 1
+            if count == required:
+                run = run + 1 if index == last_completed + 1 else 1
+                last_completed = index
+                self._completed += 1
+                if run > self._longest:
+                    self._longest = run
+        self._period, self._count, self._last_completed, self._run = period, count, last_completed, run
+
+    def summary(self) -> StreakSummary:
+        """
+        :return: StreakSummary of the check-offs added so far, completed is None
+        """
+        periods = self.grid.periods
+        # the streak is still alive while the ongoing period has not been completed yet
+        current_streak = self._run if self._last_completed >= periods - 2 else 0
+        return StreakSummary(None, self._longest, current_streak, periods - self._completed)
+
+
+class CompletionHistory(Mapping):
+    """
+    compact completion history of a habit: one bit per period, the periods start on the day ordinal start and are
+    periodicity days long, or follow a periods.PeriodRule. It can be used like the dictionaries returned by
+    get_habit_streak, key = date of the first day of the period in the form YYYY-MM-DD, value = True if the habit was
+    completed in that period, the items are created lazily when they are accessed.
+    """
+    __slots__ = ('start', 'periodicity', 'periods', '_bits')
+
+    def __init__(self, start: int, periodicity: int, periods: int, bits: bytes = None):
+        """
+        :param start: day ordinal of the first day of the first period
+        :param periodicity: length of a period in days or periods.PeriodRule
+        :param periods: number of periods
+        :param bits: completed periods packed with numpy.packbits, None if no period was completed
+        """
+        self.start = start
+        self.periodicity = periodicity
+        self.periods = periods
+        self._bits = bits
+
+    @classmethod
+    def from_completed(cls, start: int, periodicity: int, completed):
+        """
+        creates the history from a completion vector
+
+        :param start: day ordinal of the first day of the first period
+        :param periodicity: length of a period in days
+        :param completed: Boolean array with one entry per period
+        :return: CompletionHistory
+        """
+        completed = np.asarray(completed, dtype=bool)
+        bits = np.packbits(completed).tobytes() if completed.any() else None
+        return cls(start, periodicity, completed.size, bits)
+
+    def completed(self) -> np.ndarray:
+        """
+        :return: Boolean array with one entry per period
+        """
+        if self._bits is None:
+            return np.zeros(self.periods, dtype=bool)
+        return np.unpackbits(np.frombuffer(self._bits, dtype=np.uint8), count=self.periods).astype(bool)
+
+    def completed_periods(self) -> int:
+        """
+        :return: number of completed periods, counted directly on the packed bits
+        """
+        if self._bits is None:
+            return 0
+        return int(np.unpackbits(np.frombuffer(self._bits, dtype=np.uint8)).sum())
+
+    def missed_periods(self) -> int:
+        """
+        :return: number of periods in which the habit was not completed
+        """
+        return self.periods - self.completed_periods()
+
+    def runs(self):
+        """
+        run-length encoding of the completed periods
+
+        :return: tuple with an array of the indices where runs of completed periods start and an array of their lengths
+        """
+        completed = self.completed()
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], completed.view(np.int8), [0]))))
+        return edges[::2], edges[1::2] - edges[::2]
+
+    def summary(self) -> StreakSummary:
+        """
+        :return: StreakSummary of the history
+        """
+        if self._bits is None:
+            return missed_summary(self.periods)
+        return summarise(self.completed())
+
+    def window(self, start_date: dt.date, end_date: dt.date):
+        """
+        returns the part of the history with the periods that start between start_date and end_date, both included
+
+        :param start_date: first day of the window
+        :param end_date: last day of the window
+        :return: CompletionHistory
+        """
+        first, offset = _period_offset(self.start, self.periodicity, start_date.toordinal())
+        first = max(0, first + (offset > 0))
+        last = min(self.periods, _period_offset(self.start, self.periodicity, end_date.toordinal())[0] + 1)
+        first_start = _period_start(self.start, self.periodicity, first)
+        if last <= first:
+            return CompletionHistory(first_start, self.periodicity, 0)
+        if self._bits is None:
+            return CompletionHistory(first_start, self.periodicity, last - first)
+        return CompletionHistory.from_completed(first_start, self.periodicity, self.completed()[first:last])
+
+    def nbytes(self) -> int:
+        """
+        :return: size of the packed bits in bytes
+        """
+        return len(self._bits) if self._bits is not None else 0
+
+    def to_dict(self) -> dict:
+        """
+        :return: the history as dictionary like returned by get_habit_streak
+        """
+        return dict(self.items())
+
+    def _index(self, key) -> int:
+        if isinstance(key, str):
+            key = dt.date.fromisoformat(key)
+        if not isinstance(key, dt.date):
+            raise KeyError(key)
+        index, offset = _period_offset(self.start, self.periodicity, key.toordinal())
+        if offset or not 0 <= index < self.periods:
+            raise KeyError(key)
+        return index
+
+    def __getitem__(self, key) -> bool:
+        index = self._index(key)
+        if self._bits is None:
+            return False
+        return bool(self._bits[index >> 3] & (0x80 >> (index & 7)))
+
+    def __iter__(self):
+        for index in range(self.periods):
+            yield dt.date.fromordinal(_period_start(self.start, self.periodicity, index)).strftime('%Y-%m-%d')
+
+    def __len__(self) -> int:
+        return self.periods
+
+    def __repr__(self):
+        return (f"CompletionHistory(start={dt.date.fromordinal(self.start)}, periodicity={self.periodicity}, "
+                f"periods={self.periods}, completed={self.completed_periods()})")
@@ -1,8 +1,32 @@
+import asyncio
 import datetime as dt
+import io
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import tracemalloc
+
+import pytest
 
 import analyse_habits
+import analysis_cache
+import benchmark
+import check_off_queue
+import clock
+import commands
+import habit_db
+import habit_db_aio
+import habit_io
+import habit_store
 import habit_tracker
-from habit_db import get_db, add_habit, increment_habit, get_habit_tracker
+import instrumentation
+import main
+import periods
+import streaks
+from habit_db import get_db, add_habit, increment_habit, increment_habits_bulk, get_habit_tracker, get_habits_snapshot
 
 
 class TestHabitTracker:
@@ -93,15 +117,1149 @@ class TestHabitTracker:
         data6 = analyse_habits.return_number_of_habit_streaks(self.db, periodicity=7)
         assert data6 == (['test_habit_weekly', 'test_habit_weekly_1'], 5)
 
+    def test_db_habits_snapshot(self):
+        snapshot = get_habits_snapshot(self.db, dt.date(2022, 3, 21), periodicity=1)
+        assert list(snapshot) == ['test_habit', 'test_habit_1', 'test_habit_2']
+        assert snapshot['test_habit_1'].first_check_off_date == dt.date(2022, 3, 20).toordinal()
+        assert snapshot['test_habit_1'].check_off_dates == [dt.date(2022, 3, day).toordinal() for day in (21, 22, 23, 25)]
+
+    def test_db_all_habits_query_count(self):
+        statements = []
+        self.db.set_trace_callback(statements.append)
+        analyse_habits.return_number_of_habit_streaks(self.db, time_interval=30)
+        self.db.set_trace_callback(None)
+        assert len(statements) == 2
+
+    def test_db_streak_summary_table(self):
+        analyse_habits.return_number_of_habit_streaks(self.db)
+        statements = []
+        self.db.set_trace_callback(statements.append)
+        data = analyse_habits.return_number_of_habit_streaks(self.db)
+        self.db.set_trace_callback(None)
+        assert data == (['test_habit', 'test_habit_2'], 10)
+        assert len(statements) == 1
+
+    def test_db_streak_summary_late_check_offs(self):
+        habit_db.get_streak_summaries(self.db)
+        for day in (26, 25, 22, 19, 17, 12, 10):
+            increment_habit(self.db, "test_habit", dt.date(2022, 3, day))
+        for day in (2, 20, 27, 13, 6, 3):
+            increment_habit(self.db, "test_habit_weekly", dt.date(2022, 1, day))
+        incremental = habit_db.get_streak_summaries(self.db)
+        self.db.execute("UPDATE habit_streaks SET stale = 1")
+        assert habit_db.get_streak_summaries(self.db) == incremental
+        assert incremental["test_habit"].longest_streak == 25
+
+    def test_db_bulk_check_offs(self):
+        events = (("test_habit_1", dt.date(2022, 4, 1) + dt.timedelta(days=i)) for i in range(100))
+        assert increment_habits_bulk(self.db, events, chunk_size=7) == (100, 0)
+        tracker = habit_tracker.HabitTracker("test_habit_1")
+        assert tracker.add_events(self.db, ["2022-03-25", "2022-03-26", "2022-04-01"]) == (1, 2)
+        assert len(get_habit_tracker(self.db, dt.date(2022, 3, 1), "test_habit_1")) == 106
+
+    def test_db_bulk_check_offs_unknown_habit(self):
+        events = [("test_habit_1", dt.date(2022, 4, 1)), ("unknown_habit", dt.date(2022, 4, 1))]
+        with pytest.raises(sqlite3.IntegrityError):
+            increment_habits_bulk(self.db, events)
+        assert len(get_habit_tracker(self.db, dt.date(2022, 3, 1), "test_habit_1")) == 5
+
+    def test_db_window_in_the_past(self):
+        data = analyse_habits.return_number_of_habit_resets(self.db, start_date=dt.date(2022, 3, 1),
+                                                            end_date=dt.date(2022, 3, 31))
+        assert data == (['test_habit_1'], 7)
+        assert commands.resets(self.db, start_date=dt.date(2022, 3, 1), end_date=dt.date(2022, 3, 31)) == \
+            {'habits': ['test_habit_1'], 'resets': 7}
+        data = analyse_habits.return_number_of_habit_streaks(self.db, 'test_habit_weekly_1',
+                                                             start_date=dt.date(2022, 3, 1),
+                                                             end_date=dt.date(2022, 3, 31))
+        assert data == ('test_habit_weekly_1', 4)
+
+    def test_db_window_without_check_offs(self):
+        window = analyse_habits.analyse_window(self.db, dt.date(2022, 6, 1), dt.date(2022, 6, 30), periodicity=7)
+        grid, summary = window['test_habit_weekly']
+        assert grid.periods == 5
+        assert summary.completed is None
+        assert summary.resets == 5
+        data = analyse_habits.return_number_of_habit_resets(self.db, 'test_habit_weekly', time_interval=30.5)
+        assert data == ('test_habit_weekly', 5)
+
+    def test_db_streak_for_all_habits(self):
+        data = analyse_habits.get_habit_streak_for_all_habits(self.db, periodicity=7)
+        assert isinstance(data['test_habit_weekly_1'], streaks.CompletionHistory)
+        assert data['test_habit_weekly_1'] == analyse_habits.get_habit_streak(self.db, 'test_habit_weekly_1')
+
+    def test_db_parallel_analysis(self):
+        for time_interval in (None, 30, 10000):
+            serial = analyse_habits.get_habit_streak_for_all_habits(self.db, time_interval)
+            parallel = analyse_habits.get_habit_streak_for_all_habits(self.db, time_interval, workers=2)
+            assert list(parallel) == list(serial)
+            assert all(parallel[habit_name] == serial[habit_name] for habit_name in serial)
+        assert analyse_habits.return_number_of_habit_resets(self.db, time_interval=10000, workers=2) == \
+            analyse_habits.return_number_of_habit_resets(self.db, time_interval=10000)
+
     def test_db_habit_tracker_8(self):
         """
-        This is difficult to test, as all resets will be counted and it will check until today's date. On 2022-06-24 it
-        was 32 resets, but of course if you test this later, this number has to be incremented
+        all resets until today's date are counted, so the test analyses the data as of 2022-06-24, when it was 32
+        resets
         """
-
-    # data7 = analyse_habits.return_number_of_habit_resets(self.db, name='test_habit_2')
-    # assert data7 == ('test_habit_2', 32)
+        data7 = analyse_habits.return_number_of_habit_resets(self.db, name='test_habit_2', as_of=dt.date(2022, 6, 24))
+        assert data7 == ('test_habit_2', 32)
+        with clock.fixed_clock('2022-06-24'):
+            assert analyse_habits.return_number_of_habit_resets(self.db, name='test_habit_2') == data7
+        assert analyse_habits.return_number_of_habit_resets(self.db, name='test_habit_2', as_of=dt.date(2022, 6, 24),
+                                                            backend='sql') == data7
 
     def teardown_method(self):
         import os
         os.remove("test1.db")
+
+
+class TestCurrentStreaks:
+
+    def setup_method(self):
+        self.db = get_db("test_current.db")
+        today = dt.date.today()
+        habits = {"Study": (1, [0, 1, 2, 4]), "Read": (1, [1, 2, 3]), "Run": (1, [2, 3]), "Gym": (7, [7, 14, 28]),
+                  "Never": (7, [])}
+        for name, (periodicity, days_ago) in habits.items():
+            add_habit(self.db, name, periodicity, today)
+            increment_habits_bulk(self.db, [(name, today - dt.timedelta(days=days)) for days in days_ago])
+
+    def test_current_streaks_match_full_analysis(self):
+        streaks = analyse_habits.current_streaks(self.db)
+        summaries = analyse_habits.get_habit_summary_for_all_habits(self.db)
+        assert {name: streak.current_streak for name, streak in streaks.items()} == \
+            {name: summary.current_streak for name, summary in summaries.items() if summary.current_streak}
+        assert streaks["Study"].current_streak == 3 and not streaks["Study"].at_risk
+        assert streaks["Read"].due_date == dt.date.today().isoformat()
+
+    def test_as_of(self):
+        as_of = dt.date.today() - dt.timedelta(days=3)
+        streaks = analyse_habits.current_streaks(self.db, as_of=as_of)
+        summaries = analyse_habits.get_habit_summary_for_all_habits(self.db, as_of=as_of)
+        assert {name: streak.current_streak for name, streak in streaks.items()} == \
+            {name: summary.current_streak for name, summary in summaries.items() if summary.current_streak} == \
+            {"Study": 1, "Read": 1, "Run": 1, "Gym": 2}
+        assert streaks["Study"].at_risk and streaks["Study"].due_date == as_of.isoformat()
+        with clock.fixed_clock(as_of):
+            assert analyse_habits.current_streaks(self.db) == streaks
+            assert [streak.name for streak in analyse_habits.habits_at_risk(self.db)] == ["Study"]
+
+    def test_habits_at_risk(self):
+        assert [streak.name for streak in analyse_habits.habits_at_risk(self.db)] == ["Read", "Gym"]
+        gym, = analyse_habits.habits_at_risk(self.db, periodicity=7)
+        assert gym.current_streak == 2 and gym.due_date == (dt.date.today() + dt.timedelta(days=6)).isoformat()
+
+    def teardown_method(self):
+        self.db.close()
+        os.remove("test_current.db")
+
+
+class TestStreakEngine:
+
+    def test_streak_engine_daily(self):
+        start = dt.date(2022, 3, 1).toordinal()
+        check_offs = streaks.to_ordinals(['2022-03-01', '2022-03-02', '2022-03-04', '2022-03-05', '2022-03-06'])
+        summary = streaks.analyse_check_offs(check_offs, start, start + 6, 1)
+        assert summary.completed.tolist() == [True, True, False, True, True, True, False]
+        assert (summary.longest_streak, summary.current_streak, summary.resets) == (3, 3, 2)
+
+    def test_streak_engine_weekly(self):
+        start = dt.date(2022, 3, 1).toordinal()
+        check_offs = streaks.to_ordinals([dt.date(2022, 3, 1), dt.date(2022, 3, 7), dt.date(2022, 3, 8),
+                                          dt.date(2022, 3, 29)])
+        summary = streaks.analyse_check_offs(check_offs, start, start + 30, 7)
+        assert summary.completed.tolist() == [True, True, False, False, True]
+        assert (summary.longest_streak, summary.current_streak, summary.resets) == (2, 1, 2)
+
+    def test_completion_history(self):
+        completed = [True, True, False, True, True, True, False, True, True, False]
+        history = streaks.CompletionHistory.from_completed(dt.date(2022, 3, 1).toordinal(), 7, completed)
+        assert len(history) == 10
+        assert history.nbytes() == 2
+        assert history.completed_periods() == 7
+        assert history['2022-03-15'] is False and history[dt.date(2022, 3, 22)] is True
+        assert '2022-03-16' not in history
+        run_starts, run_lengths = history.runs()
+        assert run_starts.tolist() == [0, 3, 7] and run_lengths.tolist() == [2, 3, 2]
+        assert history.summary().longest_streak == 3
+        window = history.window(dt.date(2022, 3, 10), dt.date(2022, 4, 12))
+        assert list(window.items()) == [('2022-03-15', False), ('2022-03-22', True), ('2022-03-29', True),
+                                        ('2022-04-05', True), ('2022-04-12', False)]
+
+    def test_completion_history_all_missed(self):
+        history = streaks.CompletionHistory(dt.date(2022, 3, 1).toordinal(), 1, 5)
+        assert history.nbytes() == 0
+        assert history.missed_periods() == 5
+        assert history.to_dict() == {'2022-03-01': False, '2022-03-02': False, '2022-03-03': False,
+                                     '2022-03-04': False, '2022-03-05': False}
+
+    def test_streak_engine_broken_streak(self):
+        summary = streaks.summarise([True, True, False, False])
+        assert (summary.longest_streak, summary.current_streak, summary.resets) == (2, 0, 2)
+
+
+class TestPeriodEngine:
+
+    def setup_method(self):
+        self.db = get_db("test_periods.db")
+        check_offs = {"Budget": ("month", ['2022-01-15', '2022-02-03', '2022-04-10']),
+                      "Call home": ("week", ['2022-06-05', '2022-06-06']),
+                      "Swim": ("2/7", ['2022-06-01', '2022-06-03', '2022-06-09', '2022-06-15', '2022-06-16'])}
+        for name, (periodicity, dates) in check_offs.items():
+            add_habit(self.db, name, periodicity, dt.date(2022, 1, 1))
+            increment_habits_bulk(self.db, [(name, date) for date in dates])
+
+    @pytest.mark.parametrize("spec", [1, 3, 7, "week", "month", "2/7"])
+    def test_rules_map_days_to_periods(self, spec):
+        rule = periods.parse_periodicity(spec).at(dt.date(2023, 12, 3).toordinal())
+        days = list(range(dt.date(2023, 11, 1).toordinal(), dt.date(2024, 4, 1).toordinal()))
+        indices = [rule.index(day) for day in days]
+        assert rule.indices(streaks.np.array(days)).tolist() == indices
+        assert all(rule.start(index) <= day < rule.start(index + 1) for day, index in zip(days, indices))
+        assert rule.starts(indices[0], 3).tolist() == [rule.start(indices[0] + i) for i in range(3)]
+        check_offs = streaks.np.array(days[::5])
+        counts = periods.period_counts(check_offs, rule, indices[0], indices[-1] - indices[0] + 1)
+        assert counts.tolist() == [sum(rule.index(day) == index for day in check_offs)
+                                   for index in range(indices[0], indices[-1] + 1)]
+
+    def test_invalid_periodicity(self):
+        assert periods.normalise_periodicity("7") == 7 and periods.normalise_periodicity(" Week ") == "week"
+        for spec in ("fortnight", "0", "8/7"):
+            with pytest.raises(ValueError):
+                periods.parse_periodicity(spec)
+        with pytest.raises(commands.CommandError):
+            commands.add(self.db, "Yoga", "fortnight")
+
+    def test_habits_are_listed_by_period_length(self):
+        add_habit(self.db, "Gym", 7, dt.date(2022, 1, 1))
+        assert [periods.period_length(spec) for spec in (1, 7, "week", "3/7", "month")] == [1, 7, 7, 7, None]
+        weekly = ["Call home", "Gym", "Swim"]
+        statements = []
+        self.db.set_trace_callback(statements.append)
+        assert commands.habit_list(self.db, length=7) == {'habits': weekly}
+        self.db.set_trace_callback(None)
+        assert len(statements) == 1
+        store = habit_store.HabitStore(self.db)
+        assert commands.habit_list(self.db, store=store, length=7) == {'habits': weekly}
+        assert commands.habit_list(self.db, "week", store=store, length=7) == {'habits': ["Call home"]}
+
+    def test_calendar_and_quota_periods(self):
+        window = analyse_habits.analyse_window(self.db, dt.date(2022, 1, 1), dt.date(2022, 6, 21))
+        history = analyse_habits.completion_history(*window["Budget"])
+        assert list(history.window(dt.date(2022, 1, 1), dt.date(2022, 4, 30)).items()) == \
+            [('2022-01-01', True), ('2022-02-01', True), ('2022-03-01', False), ('2022-04-01', True)]
+        calendar_weeks = analyse_habits.completion_history(*window["Call home"])
+        assert list(calendar_weeks.items())[:2] == [('2022-05-30', True), ('2022-06-06', True)]
+        assert window["Call home"][1].longest_streak == 2
+        swim = window["Swim"][1]
+        assert swim.completed.tolist() == [True, False, True]
+        assert (swim.longest_streak, swim.current_streak, swim.resets) == (1, 1, 1)
+
+    def test_streak_summary_table_matches_analysis(self):
+        # a late check-off marks the summary as stale, it is rebuilt with the period engine
+        increment_habit(self.db, "Swim", dt.date(2022, 6, 13))
+        increment_habit(self.db, "Budget", dt.date(2022, 3, 31))
+        from_table = analyse_habits.get_habit_summary_for_all_habits(self.db)
+        analysed = analyse_habits.get_habit_summary_for_all_habits(self.db, start_date=dt.date(2000, 1, 1))
+        assert {name: summary[1:] for name, summary in from_table.items()} == \
+            {name: summary[1:] for name, summary in analysed.items()}
+        assert from_table["Budget"].longest_streak == 4 and from_table["Swim"].longest_streak == 3
+        assert habit_db.get_streak_leaderboard(self.db, limit=1) == [('default', 'Budget', 'month', 4)]
+
+    @pytest.mark.parametrize("spec, late", [("week", 60), ("month", -10), ("2/7", 60), ("3/5", 60)])
+    def test_streak_summary_is_updated_step_by_step(self, spec, late):
+        add_habit(self.db, "Run", spec, dt.date(2022, 1, 1))
+        habit_db.get_streak_summaries(self.db)
+        first = dt.date(2022, 1, 3)
+        for offset in (0, 2, 3, 5, 9, 10, 16, 17, 30, 31, 33, 34, 36, 80, 81, 82, 85, 86):
+            increment_habit(self.db, "Run", first + dt.timedelta(days=offset))
+            assert not self.db.execute("SELECT stale FROM habit_streaks WHERE habitsName = 'Run'").fetchone()[0]
+        incremental = habit_db.get_streak_summaries(self.db, name="Run")
+        self.db.execute("UPDATE habit_streaks SET stale = 1")
+        assert habit_db.get_streak_summaries(self.db, name="Run") == incremental
+        self.db.execute("UPDATE habit_streaks SET stale = 0")
+        # a check-off before the last completed period can close a gap, the summary is rebuilt with it
+        increment_habit(self.db, "Run", first + dt.timedelta(days=late))
+        assert not self.db.execute("SELECT stale FROM habit_streaks WHERE habitsName = 'Run'").fetchone()[0]
+        rebuilt = habit_db.get_streak_summaries(self.db, name="Run")
+        self.db.execute("UPDATE habit_streaks SET stale = 1")
+        assert habit_db.get_streak_summaries(self.db, name="Run") == rebuilt
+
+    @pytest.mark.parametrize("spec", ["week", "month", "2/7", "3/5"])
+    def test_current_streak_of_rule_periods_matches_full_analysis(self, spec):
+        add_habit(self.db, "Run", spec, dt.date(2022, 1, 1))
+        first = dt.date(2022, 1, 3)
+        increment_habits_bulk(self.db, [("Run", first + dt.timedelta(days=offset))
+                                        for offset in (0, 2, 3, 5, 9, 10, 16, 17, 30, 31, 33, 34, 36, 80, 81, 82, 85)])
+        for days in range(0, 130):
+            as_of = first + dt.timedelta(days=days)
+            streak = analyse_habits.current_streaks(self.db, name="Run", as_of=as_of).get("Run")
+            grid, summary = analyse_habits.analyse_window(self.db, dt.date(2000, 1, 1), as_of, name="Run")["Run"]
+            assert (streak.current_streak if streak else 0) == summary.current_streak
+            if streak:
+                assert streak.at_risk == (not summary.completed[-1])
+                assert streak.due_date == dt.date.fromordinal(grid.period_start(grid.periods) - 1).isoformat()
+        # a streak that ended before the previous period is skipped without reading the check-offs
+        statements = []
+        self.db.set_trace_callback(statements.append)
+        assert analyse_habits.current_streaks(self.db, name="Run", as_of=dt.date(2022, 12, 31)) == {}
+        self.db.set_trace_callback(None)
+        assert len(statements) == 1
+
+    def test_current_streak_of_calendar_periods(self):
+        increment_habit(self.db, "Call home", dt.date.today())
+        streak = analyse_habits.current_streaks(self.db)["Call home"]
+        assert (streak.periodicity, streak.current_streak, streak.at_risk) == ("week", 1, False)
+        monday = dt.date.today() - dt.timedelta(days=dt.date.today().weekday())
+        assert streak.due_date == (monday + dt.timedelta(days=6)).isoformat()
+
+    def teardown_method(self):
+        self.db.close()
+        os.remove("test_periods.db")
+
+
+class TestWindowAnalysis:
+
+    def setup_method(self):
+        self.db = get_db("test_streaming.db")
+        benchmark.populate_db(self.db, 20, 2, completion_rate=0.7, end_date=dt.date(2022, 6, 30))
+        add_habit(self.db, "Budget", "month", dt.date(2020, 1, 1))
+        add_habit(self.db, "Swim", "2/7", dt.date(2020, 1, 1))
+        add_habit(self.db, "Never", "week", dt.date(2020, 1, 1))
+        increment_habits_bulk(self.db, [("Budget", dt.date(2021, month, 3)) for month in (1, 2, 3, 5, 6)] +
+                              [("Swim", dt.date(2022, 6, day)) for day in (1, 3, 9, 15, 16)])
+
+    @pytest.mark.parametrize("start_date, end_date", [(dt.date(2000, 1, 1), dt.date(2022, 6, 30)),
+                                                      (dt.date(2021, 2, 10), dt.date(2022, 6, 10))])
+    def test_streaming_matches_analyse_window(self, start_date, end_date):
+        window = analyse_habits.analyse_window(self.db, start_date, end_date)
+        streamed = analyse_habits.analyse_window_streaming(self.db, start_date, end_date, batch_size=7)
+        assert list(streamed) == list(window)
+        for name, (grid, summary) in window.items():
+            assert streamed[name][0] == grid
+            assert streamed[name][1][1:] == summary[1:]
+
+    @pytest.mark.parametrize("start_date, end_date", [(dt.date(2000, 1, 1), dt.date(2022, 6, 30)),
+                                                      (dt.date(2021, 2, 10), dt.date(2022, 6, 10)),
+                                                      (dt.date(2022, 6, 2), dt.date(2022, 6, 16))])
+    def test_sql_streaks_match_analyse_window(self, start_date, end_date):
+        window = analyse_habits.analyse_window(self.db, start_date, end_date)
+        records = habit_db.get_window_streaks(self.db, start_date, end_date)
+        assert list(records) == list(window)
+        for name, (grid, summary) in window.items():
+            assert records[name] == (grid.periodicity if isinstance(grid.periodicity, int) else grid.periodicity.spec,
+                                     grid.periods, *summary[1:])
+
+    def test_sql_backend_is_one_query(self):
+        statements = []
+        self.db.set_trace_callback(statements.append)
+        result = analyse_habits.return_number_of_habit_streaks(self.db, backend="sql")
+        self.db.set_trace_callback(None)
+        assert len(statements) == 1
+        assert result == analyse_habits.return_number_of_habit_streaks(self.db)
+        for periodicity in (1, 7, "month", "2/7"):
+            assert analyse_habits.return_number_of_habit_resets(self.db, time_interval=400, periodicity=periodicity,
+                                                                backend="sql") == \
+                analyse_habits.return_number_of_habit_resets(self.db, time_interval=400, periodicity=periodicity)
+
+    def test_memory_does_not_depend_on_history_length(self):
+        peaks = []
+        for check_offs in (200, 20000):
+            habit_db.delete_habit(self.db, "Study")
+            add_habit(self.db, "Study", 1, dt.date(1900, 1, 1))
+            start = dt.date(1950, 1, 1).toordinal()
+            increment_habits_bulk(self.db, (("Study", start + 2 * i) for i in range(check_offs)))
+            tracemalloc.start()
+            analyse_habits.analyse_window_streaming(self.db, dt.date(1950, 1, 1), name="Study", batch_size=100)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        # the peak of a few 10 KB varies with allocations made on the first call, a history that was loaded as a
+        # whole would grow the peak about 100 times
+        assert peaks[1] < peaks[0] * 3 and max(peaks) < 100000
+
+    def teardown_method(self):
+        self.db.close()
+        os.remove("test_streaming.db")
+
+
+class TestRollups:
+
+    def setup_method(self):
+        self.db = get_db("test_rollups.db")
+        benchmark.populate_db(self.db, 5, 2, completion_rate=0.7, end_date=dt.date(2022, 6, 30))
+        add_habit(self.db, "Budget", "month", dt.date(2020, 1, 1))
+        add_habit(self.db, "Read", 1, dt.date(2022, 6, 1))
+        increment_habits_bulk(self.db, [("Budget", dt.date(2021, month, 3)) for month in (1, 2, 3, 5, 6)])
+        for day in range(1, 16):
+            increment_habit(self.db, "Read", dt.date(2022, 6, day))
+
+    def raw_rollups(self, grain):
+        rule = periods.parse_periodicity(grain)
+        rollups = dict()
+        for name, day in self.db.execute("SELECT habitsName, check_off_date FROM habits_tracker ORDER BY 1, 2"):
+            counts = rollups.setdefault(name, dict()).setdefault(rule.start(rule.index(day)), [0] * 8)
+            counts[0] += 1
+            counts[1 + (day - 1) % 7] += 1
+        return {name: [(start, counts[0], tuple(counts[1:])) for start, counts in buckets.items()]
+                for name, buckets in rollups.items()}
+
+    @pytest.mark.parametrize("grain", ["week", "month"])
+    def test_rollups_match_check_offs(self, grain):
+        assert habit_db.get_rollups(self.db, grain) == self.raw_rollups(grain)
+        increment_habit(self.db, "Budget", dt.date(2021, 4, 30))
+        increment_habit(self.db, "Budget", dt.date(2021, 4, 30))
+        habit_db.increment_habits(self.db, [("Read", dt.date(2022, 5, 31)), ("habit_00001", dt.date(1999, 12, 31))])
+        assert not self.db.execute("SELECT 1 FROM habits WHERE rollups_stale").fetchall()
+        assert habit_db.get_rollups(self.db, grain) == self.raw_rollups(grain)
+        increment_habits_bulk(self.db, [("Read", dt.date(2022, 7, 1) + dt.timedelta(days=day))
+                                        for day in range(0, 60, 3)])
+        assert not self.db.execute("SELECT 1 FROM habits WHERE rollups_stale").fetchall()
+        assert habit_db.get_rollups(self.db, grain) == self.raw_rollups(grain)
+        # rollups marked as stale by an older version of the app are aggregated without writing
+        window = habit_db.get_rollups(self.db, grain, dt.date(2021, 2, 10), dt.date(2022, 7, 20))
+        self.db.execute("UPDATE habits SET rollups_stale = 1 WHERE name IN ('Budget', 'Read')")
+        self.db.commit()
+        reader = habit_db.get_read_only_db("test_rollups.db")
+        assert habit_db.get_rollups(reader, grain, dt.date(2021, 2, 10), dt.date(2022, 7, 20)) == window
+        reader.close()
+        habit_db.delete_habit(self.db, "Read")
+        assert not self.db.execute("SELECT 1 FROM habit_rollups WHERE habitsName = 'Read'").fetchall()
+
+    def test_rollups_are_read_by_range(self):
+        habit_db.get_rollups(self.db, "month")
+        statements = []
+        self.db.set_trace_callback(statements.append)
+        rollups = habit_db.get_rollups(self.db, "month", dt.date(2021, 2, 10), dt.date(2021, 5, 3), name="Budget")
+        self.db.set_trace_callback(None)
+        assert len(statements) == 2
+        assert [habit_db.to_date_string(record.period_start) for record in rollups["Budget"]] == \
+            ["2021-02-01", "2021-03-01", "2021-05-01"]
+        with pytest.raises(ValueError):
+            habit_db.get_rollups(self.db, "day")
+
+    def test_completion_rates(self):
+        rates = analyse_habits.completion_rates(self.db, "month", end_date=dt.date(2022, 6, 30), name="Read")
+        assert rates == {"Read": [analyse_habits.CompletionRate("2022-06-01", 15, 30.0, 0.5)]}
+        rates = analyse_habits.completion_rates(self.db, "week", dt.date(2022, 6, 10), dt.date(2022, 6, 22),
+                                                name="Read")["Read"]
+        assert [(rate.period_start, rate.check_offs, rate.expected) for rate in rates] == \
+            [("2022-06-06", 7, 7.0), ("2022-06-13", 3, 7.0), ("2022-06-20", 0, 3.0)]
+        budget = analyse_habits.completion_rates(self.db, "month", end_date=dt.date(2021, 6, 30), name="Budget")
+        assert [rate.rate for rate in budget["Budget"]] == [1.0, 1.0, 1.0, 0.0, 1.0, 1.0]
+        weeks = analyse_habits.completion_rates(self.db, "week", end_date=dt.date(2021, 1, 31), name="Budget")
+        # the first check-off is on 2021-01-03
+        assert sum(rate.expected for rate in weeks["Budget"]) == pytest.approx(29 / 31)
+
+    def test_weekday_heatmap_and_trends(self):
+        heatmap = analyse_habits.weekday_heatmap(self.db)
+        for name, check_offs in self.raw_rollups("week").items():
+            assert list(heatmap[name].values()) == [sum(counts) for counts in zip(*(row[2] for row in check_offs))]
+        # 2022-06-06 is a Monday
+        assert analyse_habits.weekday_heatmap(self.db, dt.date(2022, 6, 6), name="Read")["Read"] == \
+            dict(monday=2, tuesday=2, wednesday=2, thursday=1, friday=1, saturday=1, sunday=1)
+        trends = analyse_habits.periodicity_trends(self.db, end_date=dt.date(2022, 6, 30))
+        assert trends["month"][:2] == [("2021-01-01", 1.0), ("2021-02-01", 1.0)]
+        rates = analyse_habits.completion_rates(self.db, "month", end_date=dt.date(2022, 6, 30), periodicity=7)
+        june = [habit_rates[-1].rate for habit_rates in rates.values()]
+        assert trends[7][-1] == ("2022-06-01", pytest.approx(sum(june) / len(june)))
+
+    def teardown_method(self):
+        self.db.close()
+        os.remove("test_rollups.db")
+
+
+class TestSchemaMigration:
+
+    def setup_method(self):
+        legacy_db = sqlite3.connect("test_legacy.db")
+        legacy_db.execute("CREATE TABLE habits (name TEXT PRIMARY KEY, periodicity INT, creation_date DATE)")
+        legacy_db.execute("""CREATE TABLE habits_tracker (habitsName TEXT, check_off_date DATE,
+            FOREIGN KEY (habitsName) REFERENCES habits(name))""")
+        legacy_db.execute("INSERT INTO habits VALUES ('Study', 1, '2022-05-15')")
+        legacy_db.executemany("INSERT INTO habits_tracker VALUES (?, ?)",
+                              [('Study', '2022-05-15'), ('Study', '2022-05-16'), ('Study', '2022-05-16'),
+                               ('study', '2022-05-17'), ('Deleted habit', '2022-05-16')])
+        legacy_db.commit()
+        legacy_db.close()
+        self.db = get_db("test_legacy.db")
+
+    def test_migration_upgrades_in_place(self):
+        assert self.db.execute("PRAGMA user_version").fetchone()[0] == habit_db.SCHEMA_VERSION
+        assert self.db.execute("SELECT * FROM habits_tracker").fetchall() == [
+            ('default', 'Study', dt.date(2022, 5, 15).toordinal()),
+            ('default', 'Study', dt.date(2022, 5, 16).toordinal()),
+            ('default', 'Study', dt.date(2022, 5, 17).toordinal())]
+        assert get_habit_tracker(self.db, dt.date(2022, 5, 1), 'Study') == [('Study', '2022-05-15'),
+                                                                           ('Study', '2022-05-16'),
+                                                                           ('Study', '2022-05-17')]
+
+    def test_unmatched_check_offs_are_kept(self):
+        assert self.db.execute("SELECT * FROM habits_tracker_orphans").fetchall() == [('Deleted habit', '2022-05-16')]
+
+    def test_duplicate_check_off_is_ignored(self):
+        increment_habit(self.db, 'Study', '2022-05-16')
+        assert habit_db.get_first_check_off_date(self.db, 'Study') == '2022-05-15'
+        assert len(get_habit_tracker(self.db, dt.date(2022, 5, 1), 'Study')) == 3
+
+    def test_delete_cascades_to_check_offs(self):
+        habit_db.delete_habit(self.db, 'Study')
+        assert self.db.execute("SELECT COUNT(*) FROM habits_tracker").fetchone()[0] == 0
+
+    def test_migrated_habits_get_a_streak_summary(self):
+        assert habit_db.get_users(self.db) == [habit_db.DEFAULT_USER]
+        # the summaries are rebuilt by the migration, reads do not write
+        assert self.db.execute("SELECT habitsName, stale FROM habit_streaks").fetchall() == [('Study', 0)]
+        assert habit_db.get_streak_leaderboard(self.db) == [(habit_db.DEFAULT_USER, 'Study', 1, 3)]
+
+    def teardown_method(self):
+        import os
+        self.db.close()
+        os.remove("test_legacy.db")
+
+
+class TestMultiTenant:
+
+    def setup_method(self):
+        self.db = get_db("test_tenants.db")
+        for user, days in (('alice', 3), ('bob', 5)):
+            add_habit(self.db, 'Study', 1, dt.date(2022, 5, 1), user=user)
+            for day in range(days):
+                increment_habit(self.db, 'Study', dt.date(2022, 5, 1) + dt.timedelta(days=day), user)
+        habit_tracker.HabitTracker('Gym', 7, user='alice').store(self.db)
+
+    def test_habits_are_stored_per_user(self):
+        assert habit_db.get_users(self.db) == ['alice', 'bob']
+        assert habit_db.get_habit_names(self.db, user='alice') == ['Gym', 'Study']
+        assert habit_db.get_habit_names(self.db, user='bob') == ['Study']
+        assert habit_db.get_habit_names(self.db) == []
+        assert len(get_habit_tracker(self.db, dt.date(2022, 5, 1), 'Study', user='bob')) == 5
+        assert analyse_habits.return_number_of_habit_streaks(self.db, 'Study', user='alice') == ('Study', 3)
+        assert analyse_habits.return_number_of_habit_streaks(self.db, 'Study', user='bob',
+                                                              end_date=dt.date(2022, 5, 31)) == ('Study', 5)
+
+    def test_delete_only_affects_one_user(self):
+        habit_tracker.HabitTracker('Study', user='alice').delete_habit(self.db)
+        assert habit_db.get_habit_names(self.db, user='alice') == ['Gym']
+        assert habit_db.get_first_check_off_date(self.db, 'Study', user='bob') == '2022-05-01'
+
+    def test_check_off_of_other_users_habit_fails(self):
+        with pytest.raises(sqlite3.IntegrityError):
+            increment_habit(self.db, 'Gym', dt.date(2022, 5, 1), 'bob')
+
+    def test_streak_leaderboard(self):
+        habit_tracker.HabitTracker('Study', user='bob').add_events(self.db, [dt.date(2022, 5, 6)])
+        assert habit_db.get_streak_leaderboard(self.db) == [('bob', 'Study', 1, 6), ('alice', 'Study', 1, 3),
+                                                            ('alice', 'Gym', 7, 0)]
+        assert habit_db.get_streak_leaderboard(self.db, limit=1, periodicity=7) == [('alice', 'Gym', 7, 0)]
+        # summaries marked as stale by an older version of the app are computed without writing
+        self.db.execute("UPDATE habit_streaks SET stale = 1 WHERE user = 'bob'")
+        self.db.commit()
+        reader = habit_db.get_read_only_db("test_tenants.db")
+        assert habit_db.get_streak_leaderboard(reader, limit=2) == [('bob', 'Study', 1, 6), ('alice', 'Study', 1, 3)]
+        assert habit_db.get_streak_leaderboard(reader, periodicity=7) == [('alice', 'Gym', 7, 0)]
+        reader.close()
+
+    def teardown_method(self):
+        self.db.close()
+        os.remove("test_tenants.db")
+
+
+class TestExportImport:
+
+    def setup_method(self):
+        self.db = get_db("test_export.db")
+        self.copy = get_db("test_import.db")
+        add_habit(self.db, "Study", 1, dt.date(2022, 5, 1))
+        add_habit(self.db, "Gym", 7, dt.date(2022, 5, 1), user="alice")
+        add_habit(self.db, "Read", 1, dt.date(2022, 5, 1))
+        increment_habits_bulk(self.db, (("Study", dt.date(2022, 5, 1) + dt.timedelta(days=day)) for day in range(100)))
+        increment_habit(self.db, "Gym", dt.date(2022, 5, 2), "alice")
+
+    @pytest.mark.parametrize('extension', ['.csv', '.jsonl', '.habits'])
+    def test_round_trip(self, extension):
+        path = "test_history" + extension
+        try:
+            assert habit_io.export_file(self.db, path) == 104
+            assert habit_io.import_file(self.copy, path) == (3, 101, 0)
+            assert habit_io.import_file(self.copy, path, chunk_size=7) == (0, 0, 101)
+        finally:
+            os.remove(path)
+        assert list(habit_db.export_history(self.copy)) == list(habit_db.export_history(self.db))
+        assert analyse_habits.return_number_of_habit_streaks(self.copy, "Study", end_date=dt.date(2022, 8, 8)) == \
+            ("Study", 100)
+
+    def test_columnar_file_is_read_with_mmap(self):
+        path = "test_history.habits"
+        try:
+            habit_io.export_file(self.db, path, user=habit_db.DEFAULT_USER)
+            with habit_io.ColumnarHistory(path) as history:
+                assert [habit.name for habit in history.habits] == ["Read", "Study"]
+                days = history.check_offs(habit_db.DEFAULT_USER, "Study")
+                assert len(days) == 100 and days[0] == dt.date(2022, 5, 1).toordinal()
+                assert list(streaks.to_ordinals(days.tolist())) == list(days)
+                assert len(history.check_offs(habit_db.DEFAULT_USER, "Read")) == 0
+                days.release()
+        finally:
+            os.remove(path)
+
+    def test_export_is_streamed(self):
+        records = habit_db.export_history(self.db)
+        assert next(records) == ("alice", "Gym", 7, "2022-05-01")
+        assert sum(isinstance(record, habit_db.ExportedCheckOff) for record in records) == 101
+
+    def test_import_of_unknown_habit_stores_nothing(self):
+        records = [habit_db.ExportedHabit("bob", "Run", 1, "2022-05-01"),
+                   habit_db.ExportedCheckOff("bob", "Run", dt.date(2022, 5, 1)),
+                   habit_db.ExportedCheckOff("bob", "Swim", dt.date(2022, 5, 1))]
+        with pytest.raises(sqlite3.IntegrityError):
+            habit_db.import_history(self.copy, records)
+        assert habit_db.get_users(self.copy) == []
+
+    def teardown_method(self):
+        self.db.close()
+        self.copy.close()
+        os.remove("test_export.db")
+        os.remove("test_import.db")
+
+
+class TestAnalysisCache:
+
+    def setup_method(self):
+        self.db = get_db("test_cache.db")
+        add_habit(self.db, "Study", 1, dt.date(2022, 5, 1))
+        add_habit(self.db, "Gym", 7, dt.date(2022, 5, 1))
+        increment_habit(self.db, "Study", dt.date(2022, 5, 1))
+        self.now = 0.0
+        self.cache = analysis_cache.AnalysisCache(maxsize=3, ttl=60, clock=lambda: self.now)
+        self.streaks = self.cache.wrap(analyse_habits.return_number_of_habit_streaks)
+
+    def test_results_are_reused(self):
+        assert self.streaks(self.db, "Study") == ("Study", 1)
+        assert self.streaks(self.db, name="Study") == ("Study", 1)
+        assert self.streaks(self.db, "Study", workers=2) == ("Study", 1)
+        assert self.cache.stats()[:4] == (2, 1, 0, 1)
+
+    def test_as_of_results_do_not_expire(self):
+        resets = self.cache.wrap(analyse_habits.return_number_of_habit_resets)
+        assert resets(self.db, "Study", as_of=dt.date(2022, 5, 10)) == ("Study", 9)
+        self.now += 3600
+        with clock.fixed_clock(dt.date(2030, 1, 1)):
+            assert resets(self.db, "Study", as_of=dt.date(2022, 5, 10)) == ("Study", 9)
+        assert self.cache.stats()[:2] == (1, 1)
+
+    def test_writes_only_invalidate_the_changed_habit(self):
+        self.streaks(self.db, "Study")
+        self.streaks(self.db, "Gym")
+        self.streaks(self.db)
+        other_process = get_db("test_cache.db")
+        increment_habit(other_process, "Study", dt.date(2022, 5, 2))
+        other_process.close()
+
+        assert self.streaks(self.db, "Gym") == ("Gym", 0)
+        assert self.streaks(self.db, "Study") == ("Study", 2)
+        assert self.streaks(self.db) == (["Study"], 2)
+        assert self.cache.stats().hits == 1
+
+    def test_deleted_habit_gets_a_new_version(self):
+        version = habit_db.get_data_version(self.db, "Gym")
+        habit_db.delete_habit(self.db, "Gym")
+        assert habit_db.get_data_version(self.db, "Gym") is None
+        add_habit(self.db, "Gym", 7, dt.date(2022, 5, 1))
+        assert habit_db.get_data_version(self.db, "Gym") > version
+
+    def test_lru_and_ttl(self):
+        for name in ("Study", "Gym", None):
+            self.streaks(self.db, name)
+        self.streaks(self.db, "Study")
+        self.streaks(self.db, "Study", time_interval=30)
+        assert self.cache.stats().evictions == 1
+        self.streaks(self.db, "Study")
+        self.now = 61
+        self.streaks(self.db, "Study")
+        assert self.cache.stats()[:4] == (2, 5, 1, 3)
+
+    def teardown_method(self):
+        self.db.close()
+        os.remove("test_cache.db")
+
+
+class TestHabitStore:
+
+    def setup_method(self):
+        self.db = get_db("test_store.db")
+        add_habit(self.db, "Study", 1, dt.date(2022, 5, 1), user="alice")
+        add_habit(self.db, "Budget", "month", dt.date(2022, 5, 1), user="alice")
+        add_habit(self.db, "Study", 7, dt.date(2022, 5, 1), user="bob")
+        increment_habits_bulk(self.db, [("Study", dt.date(2022, 5, day)) for day in (1, 2, 4, 8, 9)], user="alice")
+        self.store = habit_store.HabitStore(self.db, "alice")
+
+    def test_lookups(self):
+        assert self.store.names() == habit_db.get_habit_names(self.db, user="alice")
+        assert self.store.names("month") == ["Budget"]
+        assert self.store.periodicity("Study") == 1 and self.store.periodicity("Yoga") is None
+        assert list(self.store.check_offs("Study", dt.date(2022, 5, 2), "2022-05-08")) == \
+            [dt.date(2022, 5, day).toordinal() for day in (2, 4, 8)]
+        assert self.store.count("Study", end_date=dt.date(2022, 5, 3)) == 2
+        assert self.store.count("Budget") == 0
+
+    def test_writes_are_applied_as_deltas(self):
+        snapshot = self.store.snapshot()
+        tracker = habit_tracker.HabitTracker("Study", user="alice", habit_store=self.store)
+        tracker.add_event(self.db, dt.date(2022, 5, 3))
+        tracker.add_event(self.db, dt.date(2022, 5, 3))
+        commands.check_off(self.db, [("Budget", "2022-05-31"), ("Study", "2022-05-20")], "alice", self.store)
+        commands.add(self.db, "Yoga", "3/7", "alice", self.store)
+        commands.delete(self.db, "Budget", "alice", self.store)
+        habit_tracker.HabitTracker("Study", user="bob", habit_store=self.store).add_event(self.db, "2022-05-03")
+        assert self.store.reloads == 1
+        assert self.store.names() == ["Study", "Yoga"] and self.store.periodicity("Yoga") == "3/7"
+        assert self.store.count("Study") == 7
+        # a snapshot that was handed out before does not change
+        assert snapshot.names() == ["Budget", "Study"] and snapshot.count("Study") == 5
+        assert self.store.snapshot().version == habit_db.get_data_version(self.db, user="alice")
+
+    def test_reloads_only_after_changes_by_other_connections(self):
+        other = get_db("test_store.db")
+        increment_habit(other, "Study", dt.date(2022, 5, 3), "bob")
+        assert self.store.names() == ["Budget", "Study"]
+        assert self.store.reloads == 1
+        increment_habit(other, "Study", dt.date(2022, 5, 3), "alice")
+        # the write of the other connection comes before the delta of the own write, so the habits are reloaded
+        habit_tracker.HabitTracker("Budget", user="alice", habit_store=self.store).add_event(self.db, "2022-05-31")
+        assert self.store.reloads == 2
+        habit_db.delete_habit(other, "Budget", "alice")
+        other.close()
+        assert self.store.names() == ["Study"] and self.store.count("Study") == 6
+        assert self.store.reloads == 3
+
+    def test_reload_groups_and_sorts_the_check_offs(self):
+        events = [("Budget", dt.date(2022, 5, 31)), ("Study", dt.date(2022, 5, 3)), ("Budget", dt.date(2022, 6, 30)),
+                  ("Study", dt.date(2022, 4, 30))]
+        increment_habits_bulk(self.db, events, user="alice")
+        self.store.reload()
+        assert list(self.store.check_offs("Study")) == \
+            [dt.date(2022, month, day).toordinal() for month, day in ((4, 30), (5, 1), (5, 2), (5, 3), (5, 4),
+                                                                       (5, 8), (5, 9))]
+        assert list(self.store.check_offs("Budget")) == [dt.date(2022, 5, 31).toordinal(),
+                                                         dt.date(2022, 6, 30).toordinal()]
+        plan = self.db.execute("EXPLAIN QUERY PLAN SELECT habitsName, check_off_date FROM habits_tracker "
+                               "WHERE user = 'alice' ORDER BY habitsName, check_off_date").fetchall()
+        assert not any("TEMP B-TREE" in row[-1] for row in plan)
+
+    def test_write_that_stores_nothing_is_not_taken_for_a_change(self):
+        add_habit(self.db, "Yoga", 1, dt.date(2022, 5, 1), user="alice")
+        self.store.reload()
+        other = get_db("test_store.db")
+        increment_habit(other, "Yoga", dt.date(2022, 5, 3), "alice")
+        other.close()
+        # the duplicate check-off does not move the data version, the version of the other write must not be taken
+        habit_tracker.HabitTracker("Study", user="alice", habit_store=self.store).add_event(self.db, "2022-05-01")
+        assert self.store.reloads == 3
+        assert self.store.count("Yoga") == 1 and self.store.count("Study") == 5
+
+    def teardown_method(self):
+        self.db.close()
+        os.remove("test_store.db")
+
+
+class TestInstrumentation:
+
+    def setup_method(self):
+        instrumentation.enable()
+        self.db = get_db("test_instrumentation.db")
+        add_habit(self.db, "Study", 1, dt.date(2022, 5, 1))
+        increment_habits_bulk(self.db, [("Study", dt.date(2022, 5, 1) + dt.timedelta(days=i)) for i in range(10)])
+        instrumentation.reset()
+
+    def test_calls_statements_and_rows_are_counted(self):
+        measurements = []
+        hook = lambda *measurement: measurements.append(measurement)
+        instrumentation.add_hook(hook)
+        try:
+            get_habit_tracker(self.db, dt.date(2022, 5, 1), "Study")
+            get_habit_tracker(self.db, dt.date(2022, 5, 1), "Study")
+        finally:
+            instrumentation.remove_hook(hook)
+
+        [stats] = instrumentation.report()
+        assert (stats.name, stats.calls, stats.statements, stats.rows) == ('habit_db.get_habit_tracker', 2, 2, 20)
+        assert [(name, statements, rows) for name, _, statements, rows in measurements] == \
+            [('habit_db.get_habit_tracker', 1, 10)] * 2
+
+    def test_nested_calls_count_into_every_block(self):
+        with instrumentation.measure('test.block'):
+            analyse_habits.return_number_of_habit_streaks(self.db, "Study")
+        stats = {stats.name: stats for stats in instrumentation.report()}
+        block = stats.pop('test.block')
+        assert stats['analyse_habits.return_number_of_habit_streaks'].calls == 1
+        assert block.statements == max(function.statements for function in stats.values()) > 0
+        assert 'test.block' in instrumentation.format_report()
+
+    def test_nothing_is_recorded_while_disabled(self):
+        instrumentation.disable()
+        get_habit_tracker(self.db, dt.date(2022, 5, 1), "Study")
+        with instrumentation.measure('test.block'):
+            pass
+        assert instrumentation.report() == []
+
+    def test_profile_file_is_written_at_exit(self, tmp_path):
+        profile = tmp_path / 'streak.pstats'
+        result = subprocess.run([sys.executable, 'main.py', '--db', str(tmp_path / 'profile.db'), 'list'],
+                                capture_output=True, text=True, check=True,
+                                env={**os.environ, 'HABIT_PROFILE': str(profile)},
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        assert json.loads(result.stdout) == {'habits': []}
+        assert 'habit_db.get_habit_names' in result.stderr
+        assert profile.stat().st_size > 0
+
+    def test_report_is_printed_once(self, tmp_path):
+        result = subprocess.run([sys.executable, 'main.py', '--profile', '--db', str(tmp_path / 'profile.db'), 'list'],
+                                capture_output=True, text=True, check=True, env={**os.environ, 'HABIT_PROFILE': '1'},
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        assert result.stderr.count('habit_db.get_habit_names') == 1
+
+    def teardown_method(self):
+        instrumentation.disable()
+        instrumentation.reset()
+        self.db.close()
+        os.remove("test_instrumentation.db")
+
+
+class TestStartup:
+    """
+    startup benchmark: python -X importtime measures how long it takes to import main.py, which is all a command of
+    the command line interface needs before it runs
+    """
+    IMPORT_BUDGET_MS = 300
+
+    def test_startup_import_time(self):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'],
+                                capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        cumulative_us = dict()
+        for line in result.stderr.splitlines():
+            if line.startswith('import time:') and '[us]' not in line:
+                self_us, cumulative, module = line[len('import time:'):].split('|')
+                cumulative_us[module.strip()] = int(cumulative)
+
+        for module in ('numpy', 'pandas', 'PyInquirer', 'prompt_toolkit', 'menu'):
+            assert module not in cumulative_us
+        assert cumulative_us['main'] / 1000 < self.IMPORT_BUDGET_MS
+
+
+class TestCommandLine:
+
+    def run(self, capsys, *argv, stdin=None, monkeypatch=None):
+        if stdin is not None:
+            monkeypatch.setattr(sys, 'stdin', io.StringIO(stdin))
+        exit_code = main.main(['--db', 'test_cli.db', *argv])
+        return exit_code, json.loads(capsys.readouterr().out)
+
+    def test_commands(self, capsys, monkeypatch):
+        assert self.run(capsys, 'add', 'Do Yoga', '--periodicity', '7') == (0, {'habit': 'Do Yoga', 'periodicity': 7})
+        assert self.run(capsys, 'add', 'Study') == (0, {'habit': 'Study', 'periodicity': 1})
+        assert self.run(capsys, 'checkoff', 'Study', '2022-06-01', '2022-06-02', '2022-06-02') == \
+            (0, {'stored': 2, 'skipped': 1})
+        assert self.run(capsys, 'checkoff', '-', stdin='Study,2022-06-03\n\nDo Yoga,2022-06-01\n',
+                        monkeypatch=monkeypatch) == (0, {'stored': 2, 'skipped': 0})
+        assert self.run(capsys, 'streak', '--days', str((dt.date.today() - dt.date(2022, 6, 1)).days)) == \
+            (0, {'habits': ['Study'], 'longest_streak': 3})
+        weeks = (dt.date.today() - dt.date(2022, 6, 1)).days // 7 + 1
+        assert self.run(capsys, 'resets', 'Do Yoga') == (0, {'habits': ['Do Yoga'], 'resets': weeks - 1})
+        assert self.run(capsys, 'list', '--periodicity', '7') == (0, {'habits': ['Do Yoga']})
+        assert self.run(capsys, '--user', 'bob', 'list') == (0, {'habits': []})
+        assert self.run(capsys, '--as-of', '2022-06-08', 'resets', 'Do Yoga') == \
+            (0, {'habits': ['Do Yoga'], 'resets': 1})
+        assert self.run(capsys, '--as-of', '2022-06-04', 'checkoff', 'Study') == (0, {'stored': 1, 'skipped': 0})
+        assert self.run(capsys, '--as-of', '2022-06-05', 'streak', 'Study') == \
+            (0, {'habits': ['Study'], 'longest_streak': 4})
+        assert self.run(capsys, 'delete', 'Study') == (0, {'deleted': 'Study'})
+
+    def test_as_of_ignores_later_check_offs_in_the_same_period(self, capsys):
+        self.run(capsys, 'add', 'Call home', '--periodicity', 'week')
+        self.run(capsys, 'checkoff', 'Call home', '2022-06-01', '2022-06-12')
+        # 2022-06-12 lies in the week of 2022-06-09, but after it
+        assert self.run(capsys, '--as-of', '2022-06-09', 'streak') == \
+            (0, {'habits': ['Call home'], 'longest_streak': 1})
+        assert self.run(capsys, '--as-of', '2022-06-09', 'streak', '--days', '100') == \
+            (0, {'habits': ['Call home'], 'longest_streak': 1})
+        assert self.run(capsys, '--as-of', '2022-06-09', 'resets') == (0, {'habits': ['Call home'], 'resets': 1})
+
+    def test_errors(self, capsys):
+        assert self.run(capsys, 'streak') == (1, {'error': 'there are no habits to analyse'})
+        assert self.run(capsys, 'checkoff', 'Study') == (1, {'error': 'unknown habit(s): Study, nothing was checked '
+                                                                      'off'})
+        assert self.run(capsys, 'delete', 'Study') == (1, {'error': 'there is no habit "Study"'})
+
+    def teardown_method(self):
+        os.remove('test_cli.db')
+
+
+class TestBenchmarkData:
+
+    def setup_method(self):
+        self.db = get_db("test_benchmark.db")
+
+    def test_synthetic_data_is_deterministic(self):
+        end_date = dt.date(2022, 6, 30)
+        habits, check_offs = benchmark.generate_check_offs(20, 2, seed=3, end_date=end_date)
+        habits_again, check_offs_again = benchmark.generate_check_offs(20, 2, seed=3, end_date=end_date)
+        assert habits == habits_again
+        assert list(check_offs) == list(check_offs_again)
+
+    def test_populate_db(self):
+        check_offs = benchmark.populate_db(self.db, 5, 1, completion_rate=1, weekly_share=0,
+                                           end_date=dt.date(2022, 6, 30))
+        assert check_offs == 5 * 366
+        assert analyse_habits.return_number_of_habit_resets(self.db, end_date=dt.date(2022, 6, 30),
+                                                            start_date=dt.date(2021, 6, 30)) == (
+            habit_db.get_habit_names(self.db), 0)
+
+    def teardown_method(self):
+        self.db.close()
+        os.remove("test_benchmark.db")
+
+
+class TestConnectionManager:
+
+    def setup_method(self):
+        self.connections = habit_db.ConnectionManager("test_connections.db")
+        with self.connections.write() as db:
+            add_habit(db, "test_habit", 1, dt.date(2022, 3, 1))
+            increment_habit(db, "test_habit", dt.date(2022, 3, 1))
+
+    def test_connection_pragmas(self):
+        with self.connections.read() as db:
+            assert db.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+            assert db.execute("PRAGMA synchronous").fetchone()[0] == 1
+            assert db.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+
+    def test_readers_do_not_wait_for_writer(self):
+        results = []
+
+        def read():
+            with self.connections.read() as reader:
+                results.append(len(get_habit_tracker(reader, dt.date(2022, 3, 1), "test_habit")))
+
+        with self.connections.write() as db:
+            db.execute("INSERT INTO habits_tracker VALUES (?, ?, ?)",
+                       (habit_db.DEFAULT_USER, "test_habit", dt.date(2022, 3, 2).toordinal()))
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join(timeout=2)
+            db.commit()
+        read()
+        assert results == [1, 2]
+
+    def test_reader_connections_are_per_thread(self):
+        connections = []
+
+        def read():
+            with self.connections.read() as reader:
+                connections.append(reader)
+
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+        read()
+        read()
+        assert connections[0] is not connections[1] and connections[1] is connections[2]
+
+    def test_analysis_reads_do_not_wait_for_writer(self):
+        with self.connections.write() as db:
+            increment_habits_bulk(db, [("test_habit", dt.date(2022, 3, day)) for day in (3, 4)])
+            assert not db.execute("SELECT 1 FROM habit_streaks WHERE stale").fetchall()
+            # summaries marked as stale by an older version of the app
+            db.execute("UPDATE habit_streaks SET stale = 1")
+        with self.connections.write() as db:
+            db.execute("INSERT INTO habits_tracker VALUES (?, ?, ?)",
+                       (habit_db.DEFAULT_USER, "test_habit", dt.date(2022, 3, 2).toordinal()))
+            with self.connections.read() as reader:
+                assert analyse_habits.return_number_of_habit_streaks(reader, "test_habit") == ("test_habit", 2)
+                assert not reader.in_transaction
+
+    def test_open_transaction_is_committed_when_the_writer_is_released(self):
+        with self.connections.write() as db:
+            db.execute("INSERT INTO habits_tracker VALUES (?, ?, ?)",
+                       (habit_db.DEFAULT_USER, "test_habit", dt.date(2022, 3, 2).toordinal()))
+        assert not db.in_transaction
+        with self.connections.read() as reader:
+            assert len(get_habit_tracker(reader, dt.date(2022, 3, 1), "test_habit")) == 2
+
+    def teardown_method(self):
+        self.connections.close()
+        os.remove("test_connections.db")
+
+
+class TestCheckOffQueue:
+
+    def setup_method(self):
+        self.connections = habit_db.ConnectionManager("test_queue.db")
+        with self.connections.write() as db:
+            add_habit(db, "Study", 1, dt.date(2022, 1, 1))
+            add_habit(db, "Gym", 7, dt.date(2022, 1, 1))
+        self.journal = "test_queue.journal"
+
+    def stored(self):
+        with self.connections.read() as db:
+            return db.execute("SELECT habitsName, check_off_date FROM habits_tracker ORDER BY 1, 2").fetchall()
+
+    def test_check_offs_are_stored_in_batches(self):
+        start = dt.date(2022, 1, 1)
+        with check_off_queue.CheckOffQueue(self.connections, self.journal, batch_size=50, flush_interval=60) as queue:
+            for day in range(120):
+                queue.put("Study", start + dt.timedelta(days=day))
+            queue.put("Study", start)
+            habit_tracker.HabitTracker("Gym", queue=queue).add_event(None, start)
+            queue.put("Yoga", start)
+            with pytest.raises(ValueError):
+                queue.put("Study", "2022-13-01")
+            assert queue.flush(timeout=10)
+            stats = queue.stats()
+            assert os.path.exists(self.journal)
+        assert stats[:5] == (0, 123, 121, 1, 0) and 1 <= stats.batches <= 3 and not stats.errors
+        assert 0 < stats.mean_latency_seconds <= stats.max_latency_seconds and stats.max_flush_seconds > 0
+        assert len(self.stored()) == 121
+        with self.connections.read() as db:
+            assert analyse_habits.return_number_of_habit_streaks(db, "Study") == ("Study", 120)
+        assert not os.path.exists(self.journal)
+
+    def test_check_offs_are_flushed_after_the_interval(self):
+        with check_off_queue.CheckOffQueue(self.connections, flush_interval=0.05) as queue:
+            queue.put("Study", "2022-01-01")
+            for _ in range(100):
+                if queue.stats().flushed:
+                    break
+                threading.Event().wait(0.05)
+            assert queue.stats().batches == 1
+            assert self.stored() == [("Study", dt.date(2022, 1, 1).toordinal())]
+        with pytest.raises(RuntimeError):
+            queue.put("Study", "2022-01-02")
+
+    def test_journal_is_replayed_after_a_crash(self):
+        day = dt.date(2022, 1, 1).toordinal()
+        with open(self.journal + ".0", "w") as segment:
+            segment.write(json.dumps(["default", "Study", day]) + "\n")
+        with open(self.journal, "w") as journal:
+            journal.write(json.dumps(["default", "Study", day + 1]) + "\n" + json.dumps(["default", "Gym", day]) +
+                          "\n" + json.dumps(["default", "Gym", "2022-13-01"]) + "\n" + '["default", "Stu')
+        with check_off_queue.CheckOffQueue(self.connections, self.journal) as queue:
+            assert queue.stats().recovered == 3
+            assert not os.path.exists(self.journal + ".0")
+            assert self.stored() == [("Gym", day), ("Study", day), ("Study", day + 1)]
+
+    def test_flusher_survives_errors(self, monkeypatch):
+        failures = [ValueError("bad record"), OSError("disk full")]
+
+        def store(db, rows):
+            if failures:
+                raise failures.pop(0)
+            return habit_db.increment_habits_batch(db, rows)
+
+        monkeypatch.setattr(check_off_queue, 'increment_habits_batch', store)
+        with check_off_queue.CheckOffQueue(self.connections, self.journal, flush_interval=0.01) as queue:
+            queue.put("Study", "2022-01-01")
+            with pytest.raises(ValueError):
+                queue.flush(timeout=10)
+            # the batch is retried, the flusher keeps running after every error
+            for _ in range(100):
+                if queue.stats().errors == 2:
+                    break
+                threading.Event().wait(0.05)
+            assert queue.flush(timeout=10)
+            stats = queue.stats()
+        assert (stats.flushed, stats.errors, type(stats.last_error)) == (1, 2, OSError)
+        assert self.stored() == [("Study", dt.date(2022, 1, 1).toordinal())]
+
+    def teardown_method(self):
+        self.connections.close()
+        for path in ("test_queue.db", "test_queue.db-wal", "test_queue.db-shm", self.journal):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class TestAsyncHabitDB:
+
+    def setup_method(self):
+        self.habits = habit_db_aio.AsyncHabitDB("test_async.db")
+
+    def test_concurrent_check_offs_are_batched(self, monkeypatch):
+        batches = []
+        increment_habits = habit_db.increment_habits
+        monkeypatch.setattr(habit_db, 'increment_habits', lambda db, events, *args: batches.append(len(events))
+                            or increment_habits(db, events, *args))
+
+        async def check_off():
+            await self.habits.add_habit("test_habit", 1, dt.date(2022, 3, 1))
+            await asyncio.gather(*(self.habits.increment_habit("test_habit", dt.date(2022, 3, 1) + dt.timedelta(i))
+                                   for i in range(50)))
+            with pytest.raises(sqlite3.IntegrityError):
+                await asyncio.gather(self.habits.increment_habit("test_habit", dt.date(2022, 5, 1)),
+                                     self.habits.increment_habit("unknown_habit", dt.date(2022, 5, 1)))
+            return await self.habits.return_number_of_habit_streaks("test_habit")
+
+        assert asyncio.run(check_off()) == ("test_habit", 50)
+        assert batches == [50, 2]
+
+    def test_concurrent_reads_are_shared(self, monkeypatch):
+        calls = []
+        return_habit_streaks = analyse_habits.return_number_of_habit_streaks
+
+        def count_calls(db, *args, **kwargs):
+            calls.append(args)
+            return return_habit_streaks(db, *args, **kwargs)
+
+        monkeypatch.setattr(analyse_habits, 'return_number_of_habit_streaks', count_calls)
+
+        async def read():
+            await self.habits.add_habit("test_habit", 1, dt.date(2022, 3, 1))
+            await self.habits.increment_habit("test_habit", dt.date(2022, 3, 1))
+            return await asyncio.gather(*(self.habits.return_number_of_habit_streaks() for _ in range(10)))
+
+        assert asyncio.run(read()) == [(["test_habit"], 1)] * 10
+        assert len(calls) == 1
+
+    def test_reads_do_not_wait_for_a_flush_in_progress(self, monkeypatch):
+        started, release = threading.Event(), threading.Event()
+        increment_habits = habit_db.increment_habits
+
+        def hold_writer(db, events, *args):
+            # the batch keeps a write transaction open until the read is done
+            db.execute("UPDATE habits SET version = version")
+            started.set()
+            release.wait(10)
+            return increment_habits(db, events, *args)
+
+        async def read_during_flush():
+            await self.habits.add_habit("test_habit", 1, dt.date(2022, 3, 1))
+            await self.habits.increment_habit("test_habit", dt.date(2022, 3, 1))
+            # summaries marked as stale by an older version of the app
+            await self.habits._write(lambda db: db.execute("UPDATE habit_streaks SET stale = 1"))
+            monkeypatch.setattr(habit_db, 'increment_habits', hold_writer)
+            check_off = asyncio.ensure_future(self.habits.increment_habit("test_habit", dt.date(2022, 3, 2)))
+            await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+            try:
+                return await asyncio.wait_for(self.habits.return_number_of_habit_streaks("test_habit"), timeout=2)
+            finally:
+                release.set()
+                await check_off
+
+        assert asyncio.run(read_during_flush()) == ("test_habit", 1)
+
+    def test_failed_batch_releases_waiting_check_offs(self, monkeypatch):
+        def fail(events):
+            raise sqlite3.OperationalError("database is locked")
+
+        async def check_off():
+            await self.habits.add_habit("test_habit", 1, dt.date(2022, 3, 1))
+            monkeypatch.setattr(self.habits, '_write_check_offs', fail)
+            return await asyncio.wait_for(asyncio.gather(
+                *(self.habits.increment_habit("test_habit", dt.date(2022, 3, i)) for i in range(1, 4)),
+                return_exceptions=True), timeout=5)
+
+        assert [type(result) for result in asyncio.run(check_off())] == [sqlite3.OperationalError] * 3
+
+    def teardown_method(self):
+        asyncio.run(self.habits.close())
+        os.remove("test_async.db")